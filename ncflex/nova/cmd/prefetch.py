@@ -0,0 +1,64 @@
+# Copyright (c) 2014 Canonical Ltd
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+flex-image-prefetch: pull images into the flex image cache of a compute
+node ahead of the spawns booting them.
+"""
+
+import argparse
+import os
+import sys
+
+from ncflex.nova.virt.flex import prefetch
+from ncflex.nova.virt.flex import utils as container_utils
+from nova import config
+from nova import context as nova_context
+from nova.openstack.common import log as logging
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Pull images into the flex image cache')
+    parser.add_argument('--config-file', default='/etc/nova/nova.conf',
+                        help='nova configuration file')
+    parser.add_argument('--concurrency', type=int, default=None,
+                        help='number of images fetched in parallel')
+    parser.add_argument('--bandwidth', type=int, default=None,
+                        help='aggregate download limit in KiB/s')
+    parser.add_argument('--auth-token',
+                        default=os.environ.get('OS_AUTH_TOKEN'),
+                        help='token used to talk to glance')
+    parser.add_argument('images', nargs='+', metavar='image',
+                        help='id of the image to prefetch')
+    args = parser.parse_args()
+
+    config.parse_args([sys.argv[0], '--config-file', args.config_file])
+    logging.setup('nova')
+
+    context = nova_context.get_admin_context()
+    context.auth_token = args.auth_token
+    results = prefetch.prefetch_images(context, args.images,
+                                       container_utils.LXCUserIdMap(),
+                                       args.concurrency, args.bandwidth)
+
+    failed = 0
+    for image_ref in args.images:
+        error = results[image_ref]
+        if error is None:
+            print("%s: ok" % image_ref)
+        else:
+            failed += 1
+            print("%s: failed: %s" % (image_ref, error))
+    return 1 if failed else 0
@@ -0,0 +1,88 @@
+import os
+import time
+
+import fixtures
+
+from ncflex.nova.virt.flex import cgroups
+from nova import test
+
+
+class CgroupsTestCase(test.TestCase):
+    def setUp(self):
+        super(CgroupsTestCase, self).setUp()
+        self.root = self.useFixture(fixtures.TempDir()).path
+        self.flags(cgroup_root=self.root, group='lxc')
+
+    def make_cgroup(self, controller, relpath, **items):
+        path = os.path.join(self.root, controller, relpath)
+        os.makedirs(path)
+        for item, value in items.items():
+            with open(os.path.join(path, item.replace('_', '.', 1)),
+                      'w') as fp:
+                fp.write('%s\n' % value)
+
+    def test_parse_cpuset(self):
+        self.assertEqual(set([0, 1, 2, 3, 8, 10, 11]),
+                         cgroups.parse_cpuset('0-3,8,10-11\n'))
+        self.assertEqual(set(), cgroups.parse_cpuset(''))
+
+    def test_format_cpuset(self):
+        self.assertEqual('0-3,8,10-11',
+                         cgroups.format_cpuset(set([0, 1, 2, 3, 8, 10, 11])))
+        self.assertEqual('', cgroups.format_cpuset(set()))
+
+    def test_find_container_cgroups(self):
+        self.make_cgroup('memory', 'abc/lxc/c1')
+        self.make_cgroup('memory', 'abc/lxc/c1/c2')
+        self.make_cgroup('memory', 'def/lxc/c2')
+        self.assertEqual({'c1': 'abc/lxc/c1', 'c2': 'def/lxc/c2'},
+                         cgroups.find_container_cgroups(['c1', 'c2', 'c3']))
+
+    def test_read_cpu_usage_percpu_fallback(self):
+        self.make_cgroup('cpuacct', 'lxc/c1',
+                         cpuacct_usage_percpu='10 20 30')
+        self.assertEqual((60, [10, 20, 30]),
+                         cgroups.read_cpu_usage('lxc/c1'))
+
+    def test_cpu_sampler(self):
+        self.make_cgroup('memory', 'lxc/c1')
+        self.make_cgroup('cpuacct', 'lxc/c1', cpuacct_usage='1000000000')
+        sampler = cgroups.CPUSampler()
+
+        self.mox.StubOutWithMock(time, 'time')
+        time.time().AndReturn(100)
+        time.time().AndReturn(102)
+        self.mox.ReplayAll()
+
+        first = sampler.sample(['c1', 'c2'])
+        self.assertEqual({'c1': {'cpu_time': 1000000000,
+                                 'utilization': None}}, first)
+        with open(os.path.join(self.root, 'cpuacct', 'lxc/c1',
+                               'cpuacct.usage'), 'w') as fp:
+            fp.write('4000000000\n')
+        second = sampler.sample(['c1'])
+        self.assertEqual(1.5, second['c1']['utilization'])
+
+    def test_cpu_sampler_negative_cache(self):
+        sampler = cgroups.CPUSampler()
+        self.assertEqual({}, sampler.sample(['c1']))
+
+        self.mox.StubOutWithMock(cgroups, 'find_container_cgroups')
+        self.mox.ReplayAll()
+        # a stopped container costs no walk until the paths are refreshed
+        self.assertEqual({}, sampler.sample(['c1']))
+        self.mox.VerifyAll()
+        self.mox.UnsetStubs()
+
+        self.make_cgroup('cpuacct', 'lxc/c1', cpuacct_usage='42')
+        sampler.update_paths({'c1': 'lxc/c1'})
+        self.assertEqual(42, sampler.sample(['c1'])['c1']['cpu_time'])
+
+    def test_cpu_sampler_forget_clears_negative_cache(self):
+        sampler = cgroups.CPUSampler()
+        self.assertEqual({}, sampler.sample(['c1']))
+        self.make_cgroup('memory', 'lxc/c1')
+        self.make_cgroup('cpuacct', 'lxc/c1', cpuacct_usage='42')
+        self.assertEqual({}, sampler.sample(['c1']))
+        sampler.forget('c1')
+        self.assertEqual(42, sampler.sample(['c1'])['c1']['cpu_time'])
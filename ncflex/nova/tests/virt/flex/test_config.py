@@ -0,0 +1,178 @@
+import os
+
+import fixtures
+
+from ncflex.nova.virt.flex import config
+from ncflex.nova.virt.flex import host_utils
+from ncflex.nova.virt.flex import utils as container_utils
+from nova import exception
+from nova import test
+
+
+class FakeFlavor(object):
+    memory_mb = 512
+    extra_specs = {}
+
+
+class FakeIdMap(object):
+    def lxc_conf_lines(self):
+        return (('lxc.id_map', 'u 0 100000 65536'),
+                ('lxc.id_map', 'g 0 100000 65536'))
+
+
+class LXCConfigTestCase(test.TestCase):
+    def setUp(self):
+        super(LXCConfigTestCase, self).setUp()
+        self.instances_path = self.useFixture(fixtures.TempDir()).path
+        template_dir = self.useFixture(fixtures.TempDir()).path
+        open(os.path.join(template_dir, 'lxc-ubuntu-cloud'), 'w').close()
+        self.flags(instances_path=self.instances_path)
+        self.flags(lxc_template_dir=template_dir,
+                   lxc_config_dir='/usr/share/lxc/config', group='lxc')
+        self.stubs.Set(container_utils, 'get_flavor',
+                       lambda instance: FakeFlavor())
+        self.stubs.Set(container_utils, 'get_lxc_security_info',
+                       lambda instance: 'unprivileged')
+
+        self.instance = {'uuid': 'fake-uuid', 'vcpus': 2}
+        os.makedirs(os.path.join(self.instances_path, 'fake-uuid'))
+        self.network_info = [
+            {'id': '0123456789abcdef', 'type': 'ovs',
+             'address': 'aa:bb:cc:dd:ee:01', 'network': {'bridge': 'br-int'}},
+            {'id': 'fedcba9876543210', 'type': 'bridge',
+             'address': 'aa:bb:cc:dd:ee:02', 'network': {'bridge': 'br100'}}]
+
+    def test_get_config(self):
+        container = self.mox.CreateMockAnything()
+        container.load_config()
+        self.mox.ReplayAll()
+
+        config.LXCConfig(container, self.instance, {}, self.network_info,
+                         FakeIdMap()).get_config()
+
+        with open(container_utils.get_container_config(self.instance)) as fp:
+            lines = fp.read().splitlines()
+        self.assertEqual(
+            'lxc.include = /usr/share/lxc/config/ubuntu-cloud.common.conf',
+            lines[0])
+        self.assertIn('lxc.id_map = u 0 100000 65536', lines)
+        self.assertIn('lxc.cgroup.memory.limit_in_bytes = 512M', lines)
+        self.assertIn('lxc.cgroup.cpu.shares = 2048', lines)
+        self.assertIn('lxc.utsname = fake-uuid', lines)
+        self.assertEqual(['lxc.network.link = qbr0123456789a',
+                          'lxc.network.link = br100'],
+                         [line for line in lines
+                          if line.startswith('lxc.network.link')])
+
+    def test_unknown_template(self):
+        container = self.mox.CreateMockAnything()
+        self.mox.ReplayAll()
+
+        config.LXCConfig(container, self.instance,
+                         {'properties': {'template': 'missing'}},
+                         self.network_info, FakeIdMap()).get_config()
+        self.assertFalse(os.path.exists(
+            container_utils.get_container_config(self.instance)))
+
+    def test_get_extra_spec_items(self):
+        self.stubs.Set(host_utils, 'get_block_device', lambda path: '8:0')
+        items = config.get_extra_spec_items({
+            'flex:flex_privileged': 'true',
+            'flex:cpuset': '0-1',
+            'flex:memsw_limit_mb': '1024',
+            'flex:cpu_quota': '50000',
+            'flex:pids_max': '512',
+            'flex:blkio_read_iops': '100',
+            'flex:blkio_write_bps': '8:16 1048576'})
+        self.assertEqual(
+            [('lxc.cgroup.cpuset.cpus', '0-1'),
+             ('lxc.cgroup.memory.memsw.limit_in_bytes', '1024M'),
+             ('lxc.cgroup.cpu.cfs_quota_us', '50000'),
+             ('lxc.cgroup.pids.max', '512'),
+             ('lxc.cgroup.blkio.throttle.read_iops_device', '8:0 100'),
+             ('lxc.cgroup.blkio.throttle.write_bps_device',
+              '8:16 1048576')],
+            items)
+
+    def test_get_extra_spec_items_no_disk(self):
+        self.stubs.Set(host_utils, 'get_block_device', lambda path: None)
+        self.assertEqual([], config.get_extra_spec_items(
+            {'flex:blkio_read_iops': '100'}))
+
+    def _make_sysfs(self):
+        sysfs = self.useFixture(fixtures.TempDir()).path
+        disk = os.path.join(sysfs, 'devices', 'block', 'sda')
+        os.makedirs(os.path.join(disk, 'sda1'))
+        with open(os.path.join(disk, 'dev'), 'w') as fp:
+            fp.write('8:0\n')
+        with open(os.path.join(disk, 'sda1', 'partition'), 'w') as fp:
+            fp.write('1\n')
+        dev_block = os.path.join(sysfs, 'dev', 'block')
+        os.makedirs(dev_block)
+        os.symlink(disk, os.path.join(dev_block, '8:0'))
+        os.symlink(os.path.join(disk, 'sda1'),
+                   os.path.join(dev_block, '8:1'))
+        return dev_block
+
+    def test_get_whole_disk(self):
+        dev_block = self._make_sysfs()
+        self.assertEqual('8:0', host_utils.get_whole_disk('8:1', dev_block))
+        self.assertEqual('8:0', host_utils.get_whole_disk('8:0', dev_block))
+        # device mapper devices are not partitions
+        self.assertEqual('252:0',
+                         host_utils.get_whole_disk('252:0', dev_block))
+
+    def test_get_block_device_partition(self):
+        dev_block = self._make_sysfs()
+        # any device node will do as the partition mounted on /
+        rdev = os.stat('/dev/null').st_rdev
+        os.symlink(os.path.realpath(os.path.join(dev_block, '8:1')),
+                   os.path.join(dev_block, '%d:%d' % (os.major(rdev),
+                                                      os.minor(rdev))))
+        mountinfo = os.path.join(self.useFixture(fixtures.TempDir()).path,
+                                 'mountinfo')
+        with open(mountinfo, 'w') as fp:
+            fp.write('17 1 8:1 / / rw - ext4 /dev/null rw\n'
+                     '18 17 0:5 / /dev rw - devtmpfs udev rw\n')
+        self.assertEqual('8:0', host_utils.get_block_device(
+            '/var/lib/nova/instances', mountinfo, dev_block))
+
+    def test_get_extra_spec_items_invalid(self):
+        self.assertRaises(exception.InvalidInput,
+                          config.get_extra_spec_items,
+                          {'flex:pids_max': 'many'})
+        self.assertRaises(exception.InvalidInput,
+                          config.get_extra_spec_items,
+                          {'flex:cpuset': '0-x'})
+
+    def test_get_block_device_items(self):
+        self.stubs.Set(os, 'stat',
+                       lambda path: os.stat_result((0,) * 10))
+        self.stubs.Set(os, 'major', lambda rdev: 8)
+        self.stubs.Set(os, 'minor', lambda rdev: 16)
+        host_device = '/dev/disk/by-path/ip-10.0.0.1:3260-iscsi-iqn-lun-1'
+        self.assertEqual(
+            [('lxc.cgroup.devices.allow', 'b 8:16 rwm'),
+             ('lxc.mount.entry',
+              '%s dev/vdb none bind,create=file 0 0' % host_device)],
+            config.get_block_device_items([(host_device, '/dev/vdb')]))
+
+    def test_set_block_devices(self):
+        container = self.mox.CreateMockAnything()
+        container.load_config()
+        self.mox.ReplayAll()
+        config.LXCConfig(container, self.instance, {}, self.network_info,
+                         FakeIdMap()).get_config()
+        config_file = container_utils.get_container_config(self.instance)
+        with open(config_file) as fp:
+            original = fp.read()
+
+        self.stubs.Set(config, 'get_block_device_items',
+                       lambda block_devices: [
+                           ('lxc.mount.entry', '%s %s' % device)
+                           for device in block_devices])
+        config.set_block_devices(self.instance, [('/dev/a', '/dev/vdb')])
+        config.set_block_devices(self.instance, [('/dev/b', '/dev/vdc')])
+        with open(config_file) as fp:
+            self.assertEqual(original + 'lxc.mount.entry = /dev/b /dev/vdc\n',
+                             fp.read())
@@ -0,0 +1,53 @@
+import os
+
+import fixtures
+
+from ncflex.nova.virt.flex import console
+from nova import test
+
+
+class ConsoleLogTestCase(test.TestCase):
+    def setUp(self):
+        super(ConsoleLogTestCase, self).setUp()
+        self.flags(console_log_max_bytes=40, console_log_segments=3,
+                   group='lxc')
+        self.console_log = os.path.join(
+            self.useFixture(fixtures.TempDir()).path, 'container.console')
+
+    def _write(self, data):
+        with open(self.console_log, 'ab') as fp:
+            fp.write(data)
+
+    def test_rotate(self):
+        self._write(b'0123456789')
+        self.assertTrue(console.rotate(self.console_log))
+        self._write(b'abcdefghij')
+        self.assertTrue(console.rotate(self.console_log))
+        self._write(b'ABC')
+        self.assertFalse(console.rotate(self.console_log))
+
+        self.assertEqual(3, os.path.getsize(self.console_log))
+        with open('%s.1' % self.console_log, 'rb') as fp:
+            self.assertEqual(b'abcdefghij', fp.read())
+        with open('%s.2' % self.console_log, 'rb') as fp:
+            self.assertEqual(b'0123456789', fp.read())
+
+    def test_rotate_drops_oldest(self):
+        for i in range(5):
+            self._write(str(i).encode() * 10)
+            console.rotate(self.console_log)
+        self.assertFalse(os.path.exists('%s.4' % self.console_log))
+        with open('%s.3' % self.console_log, 'rb') as fp:
+            self.assertEqual(b'2' * 10, fp.read())
+
+    def test_read_tail(self):
+        self._write(b'0123456789')
+        console.rotate(self.console_log)
+        self._write(b'abcdefghij')
+        console.rotate(self.console_log)
+        self._write(b'ABC')
+
+        self.assertEqual((b'ABC', 20),
+                         console.read_tail(self.console_log, 3))
+        self.assertEqual((b'6789abcdefghijABC', 6),
+                         console.read_tail(self.console_log, 17))
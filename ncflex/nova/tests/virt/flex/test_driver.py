@@ -1,3 +1,5 @@
+import os
+
 import fixtures
 import mox
 
@@ -6,10 +8,15 @@ from oslo.config import cfg
 from ncflex.nova.virt.flex import containers
 from ncflex.nova.virt.flex import driver as lxc_connection
 from ncflex.nova.virt.flex import images
+from ncflex.nova.virt.flex import utils as container_utils
 from nova.compute import flavors
 from nova.compute import power_state
+from nova.compute import vm_states
 from nova import context
 from nova import db
+from nova import exception
+from nova.openstack.common import jsonutils
+from nova.openstack.common import processutils
 from nova import test
 
 CONF = cfg.CONF
@@ -77,8 +84,218 @@ class GraniteDriverTestCase(test.TestCase):
         pass
 
     def test_get_container_info(self):
-        self.mox.StubOutWithMock(containers.Containers, 'container_exists')
-        containers.Containers.container_exists(mox.IgnoreArg()).AndReturn(True)
+        self.mox.StubOutWithMock(containers.Containers, 'get_containers_info')
+        containers.Containers.get_containers_info().AndReturn(
+            {self.instance['uuid']: {'state': power_state.RUNNING,
+                                     'max_mem': 0, 'mem': 0,
+                                     'num_cpu': 2, 'cpu_time': 0}})
         self.mox.ReplayAll()
         state = self.lxc_connection.get_info(self.instance)
         self.assertEqual(state['state'], power_state.RUNNING)
+
+    def test_get_container_info_not_in_snapshot(self):
+        self.mox.StubOutWithMock(containers.Containers, 'get_containers_info')
+        self.mox.StubOutWithMock(containers.Containers,
+                                 '_get_single_container_info')
+        containers.Containers.get_containers_info().AndReturn({})
+        containers.Containers._get_single_container_info(
+            self.instance).AndReturn({'state': power_state.SHUTDOWN,
+                                      'max_mem': 0, 'mem': 0,
+                                      'num_cpu': 0, 'cpu_time': 0})
+        self.mox.ReplayAll()
+        state = self.lxc_connection.get_info(self.instance)
+        self.assertEqual(state['state'], power_state.SHUTDOWN)
+        self.assertEqual(state['num_cpu'], 2)
+
+    def test_power_on_instances_priority(self):
+        instances = [dict(self.instance, uuid='low'),
+                     dict(self.instance, uuid='high'),
+                     dict(self.instance, uuid='fail')]
+        priorities = {'low': 0, 'high': 10, 'fail': 0}
+        self.stubs.Set(container_utils, 'get_boot_priority',
+                       lambda instance: priorities[instance['uuid']])
+        started = []
+
+        def fake_start_container(context, instance, network_info,
+                                 block_device_info):
+            if instance['uuid'] == 'fail':
+                raise Exception('boom')
+            started.append(instance['uuid'])
+
+        self.stubs.Set(self.lxc_connection.containers, 'start_container',
+                       fake_start_container)
+        results = self.lxc_connection.power_on_instances(None, instances)
+        self.assertEqual(['high', 'low'], started)
+        self.assertEqual({'low': None, 'high': None, 'fail': 'boom'},
+                         results)
+
+    def test_init_volume_users(self):
+        class FakeBDM(object):
+            def __init__(self, is_volume, connection_info):
+                self.is_volume = is_volume
+                self.connection_info = connection_info
+
+        connection_info = {'data': {'target_portal': '10.0.0.1:3260',
+                                    'target_iqn': 'iqn', 'target_lun': 1}}
+        users = []
+        self.stubs.Set(self.lxc_connection.containers.volumes, 'init_users',
+                       users.extend)
+
+        self.lxc_connection._init_volume_users(
+            {'uuid-1': [FakeBDM(False, None),
+                        FakeBDM(True, jsonutils.dumps(connection_info))]})
+        self.assertEqual([(connection_info, 'uuid-1')], users)
+
+    def test_resume_instances(self):
+        class FakeInfoCache(object):
+            network_info = 'net'
+
+        class FakeInstance(dict):
+            def __init__(self, uuid, power_state, task_state=None):
+                super(FakeInstance, self).__init__(uuid=uuid)
+                self.uuid = uuid
+                self.power_state = power_state
+                self.vm_state = vm_states.ACTIVE
+                self.task_state = task_state
+                self.info_cache = FakeInfoCache()
+
+        instances = [FakeInstance('stopped', power_state.RUNNING),
+                     FakeInstance('running', power_state.RUNNING),
+                     FakeInstance('off', power_state.SHUTDOWN),
+                     FakeInstance('busy', power_state.RUNNING, 'rebooting')]
+        bdms = dict((instance.uuid, []) for instance in instances)
+        self.flags(resume_guests_state_on_host_boot=True)
+        self.stubs.Set(lxc_connection.lxc, 'list_containers',
+                       lambda **kwargs: ['running'])
+        calls = []
+
+        def fake_start_containers(context, instances, network_info,
+                                  block_device_info):
+            calls.append(([i.uuid for i in instances], network_info,
+                          block_device_info))
+            return {'stopped': None}
+
+        self.stubs.Set(self.lxc_connection.containers, 'start_containers',
+                       fake_start_containers)
+        self.lxc_connection._resume_instances(None, instances, bdms)
+        self.assertEqual([(['stopped'], {'stopped': 'net'},
+                           {'stopped': {'block_device_mapping': []}})],
+                         calls)
+
+        # nothing left to do when nova-compute resumes it
+        self.stubs.Set(self.lxc_connection.containers, 'start_container',
+                       lambda *args: calls.append(args))
+        self.lxc_connection.resume_state_on_host_boot(
+            None, instances[0], 'net')
+        self.assertEqual(1, len(calls))
+
+    def _stub_container_ops(self, init_pids=None, op_results=None):
+        class FakeContainer(object):
+            name = self.instance['uuid']
+            running = True
+            defined = True
+            controllable = True
+
+        ops = []
+        self.op_args = []
+        op_results = op_results or {}
+
+        def fake_container_op(container, lxc_type, op, *args):
+            ops.append(op)
+            self.op_args.append(args)
+            result = op_results.get(op, True)
+            if isinstance(result, Exception):
+                raise result
+            return result
+
+        conn = self.lxc_connection.containers
+        self.stubs.Set(conn, 'get_container_root',
+                       lambda instance: (FakeContainer(), 'unprivileged'))
+        self.stubs.Set(conn, '_container_op', fake_container_op)
+        self.stubs.Set(conn, '_get_init_pid',
+                       lambda container, lxc_type: init_pids.pop(0))
+        self.stubs.Set(containers.eventlet, 'sleep', lambda seconds: None)
+        return ops
+
+    def test_soft_reboot_waits_for_new_init(self):
+        init_pids = [100, 100, -1, 200]
+        ops = self._stub_container_ops(init_pids)
+        self.lxc_connection.containers.reboot_container(
+            None, self.instance, None, 'SOFT', None, None)
+        self.assertEqual(['reboot', 'wait'], ops)
+        self.assertEqual([], init_pids)
+
+    def test_soft_reboot_timeout(self):
+        self.flags(container_state_timeout=0, group='lxc')
+        self._stub_container_ops([100])
+        self.assertRaises(exception.InstanceRebootFailure,
+                          self.lxc_connection.containers.reboot_container,
+                          None, self.instance, None, 'SOFT', None, None)
+
+    def test_start_running_container(self):
+        ops = self._stub_container_ops([100])
+        self.lxc_connection.containers.start_container(
+            None, self.instance, None, None)
+        self.assertEqual([], ops)
+
+    def _make_memory_cgroup(self, soft_limit):
+        cgroup_root = self.useFixture(fixtures.TempDir()).path
+        self.flags(cgroup_root=cgroup_root, group='lxc')
+        path = os.path.join(cgroup_root, 'memory', 'lxc',
+                            self.instance['uuid'])
+        os.makedirs(path)
+        with open(os.path.join(path, 'memory.soft_limit_in_bytes'),
+                  'w') as fp:
+            fp.write('%d\n' % soft_limit)
+        os.makedirs(container_utils.get_instance_path(self.instance))
+
+    def test_pause_does_not_reclaim(self):
+        self.flags(suspend_memory_reclaim='soft_limit', group='lxc')
+        ops = self._stub_container_ops()
+        self.lxc_connection.pause(self.instance)
+        self.assertEqual(['freeze'], ops)
+
+    def test_suspend_soft_limit_is_restored(self):
+        self.flags(suspend_memory_reclaim='soft_limit', group='lxc')
+        self._make_memory_cgroup(512 * 1024 * 1024)
+        ops = self._stub_container_ops()
+        conn = self.lxc_connection.containers
+
+        conn.suspend_container(self.instance)
+        self.assertEqual(['freeze', 'set_cgroup_item'], ops)
+        self.assertEqual(('memory.soft_limit_in_bytes', '0'),
+                         self.op_args[1])
+
+        conn.resume_container(None, self.instance, None, None)
+        self.assertEqual(['freeze', 'set_cgroup_item', 'set_cgroup_item',
+                          'unfreeze'], ops)
+        self.assertEqual(('memory.soft_limit_in_bytes', '536870912'),
+                         self.op_args[2])
+        self.assertFalse(os.path.exists(
+            container_utils.get_container_soft_limit(self.instance)))
+
+    def test_resume_without_saved_soft_limit(self):
+        self.flags(suspend_memory_reclaim='soft_limit', group='lxc')
+        ops = self._stub_container_ops()
+        self.lxc_connection.containers.resume_container(
+            None, self.instance, None, None)
+        self.assertEqual(['unfreeze'], ops)
+
+    def test_suspend_force_empty_busy(self):
+        self.flags(suspend_memory_reclaim='force_empty', group='lxc')
+        ops = self._stub_container_ops(op_results={
+            'set_cgroup_item': processutils.ProcessExecutionError(
+                exit_code=1, stderr='Device or resource busy')})
+        self.lxc_connection.containers.suspend_container(self.instance)
+        self.assertEqual(['freeze', 'set_cgroup_item'], ops)
+        self.assertEqual(('memory.force_empty', '0'), self.op_args[1])
+
+    def test_suspend_to_disk(self):
+        self.flags(suspend_to_disk=True, group='lxc')
+        ops = self._stub_container_ops()
+        checkpointed = []
+        self.stubs.Set(self.lxc_connection.containers,
+                       'checkpoint_container', checkpointed.append)
+        self.lxc_connection.suspend(self.instance)
+        self.assertEqual([self.instance], checkpointed)
+        self.assertEqual([], ops)
@@ -0,0 +1,124 @@
+import os
+import time
+
+import fixtures
+from oslo.serialization import jsonutils
+
+from ncflex.nova.virt.flex import host_utils
+from ncflex.nova.virt.flex import hostops
+from ncflex.nova.virt.flex import numa
+from nova import test
+from nova.virt import hardware
+
+
+class FakePlacement(object):
+    def get_usage(self):
+        return {0: {'memory_mb': 512, 'vcpus': 2}}
+
+
+class HostOpsTestCase(test.TestCase):
+    def setUp(self):
+        super(HostOpsTestCase, self).setUp()
+        self.stubs.Set(host_utils, 'get_memory_info',
+                       lambda: {'total': 8192, 'free': 6144, 'used': 2048})
+        self.stubs.Set(host_utils, 'get_disk_info',
+                       lambda: {'total': 100 * 1024 ** 3,
+                                'available': 90 * 1024 ** 3,
+                                'used': 10 * 1024 ** 3})
+        self.cpu_counts = []
+        self.stubs.Set(host_utils, 'get_cpu_count',
+                       lambda: self.cpu_counts.append(8) or 8)
+        self.topology = [{'id': 0, 'cpus': [0, 1, 2, 3], 'memory_mb': 4096},
+                         {'id': 1, 'cpus': [4, 5, 6, 7], 'memory_mb': 4096}]
+        self.stubs.Set(numa, 'get_host_topology', lambda: self.topology)
+
+        self.cgroup_root = self.useFixture(fixtures.TempDir()).path
+        self.flags(cgroup_root=self.cgroup_root, group='lxc')
+        self.running = []
+        self.stubs.Set(hostops.lxc, 'list_containers',
+                       lambda **kwargs: list(self.running))
+
+    def make_container(self, name, vcpus, usage_mb, rss_mb, cpuset='0-7'):
+        items = {'cpu': {'cpu.shares': vcpus * 1024},
+                 'memory': {'memory.usage_in_bytes': usage_mb * 1024 ** 2,
+                            'memory.stat': 'cache 0\ntotal_rss %d'
+                                           % (rss_mb * 1024 ** 2)},
+                 'cpuset': {'cpuset.cpus': cpuset}}
+        for controller, files in items.items():
+            path = os.path.join(self.cgroup_root, controller, 'lxc', name)
+            os.makedirs(path)
+            for item, value in files.items():
+                with open(os.path.join(path, item), 'w') as fp:
+                    fp.write('%s\n' % value)
+        self.running.append(name)
+
+    def test_static_resources_computed_once(self):
+        host = hostops.HostOps()
+        host.init_host()
+        self.flags(resource_refresh_interval=0, group='lxc')
+        for i in range(3):
+            stats = host.get_available_resource('fake-node')
+            time.sleep(0.01)
+        self.assertEqual(1, len(self.cpu_counts))
+        self.assertEqual(8, stats['vcpus'])
+        self.assertEqual(8192, stats['memory_mb'])
+        self.assertEqual(100, stats['local_gb'])
+
+    def test_refresh_interval(self):
+        host = hostops.HostOps()
+        self.flags(resource_refresh_interval=60, group='lxc')
+        self.assertEqual(0, host.get_available_resource('n')['vcpus_used'])
+        self.make_container('c1', 2, 512, 256)
+        # cached
+        self.assertEqual(0, host.get_available_resource('n')['vcpus_used'])
+
+        self.flags(resource_refresh_interval=0, group='lxc')
+        time.sleep(0.01)
+        self.assertEqual(2, host.get_available_resource('n')['vcpus_used'])
+
+    def test_container_usage(self):
+        self.make_container('c1', 2, 512, 256)
+        self.make_container('c2', 1, 1024, 768, cpuset='2-3')
+        stats = hostops.HostOps().get_available_resource('fake-node')
+
+        self.assertEqual(3, stats['vcpus_used'])
+        # the 2048MB used on the host minus the 1024MB of container rss,
+        # plus the 1536MB charged to the containers
+        self.assertEqual(2560, stats['memory_mb_used'])
+        self.assertEqual({'pinned_cpus': [2, 3]},
+                         jsonutils.loads(stats['cpu_info']))
+
+    def test_container_paths_reused(self):
+        self.make_container('c1', 2, 512, 256)
+        host = hostops.HostOps()
+        host.init_host()
+        self.assertEqual({'c1': 'lxc/c1'}, host._get_container_paths())
+
+        self.make_container('c2', 1, 512, 256)
+        walked = []
+        self.stubs.Set(hostops.cgroups, 'find_container_cgroups',
+                       lambda names: walked.append(names) or
+                       {'c2': 'lxc/c2'})
+        self.assertEqual({'c1': 'lxc/c1', 'c2': 'lxc/c2'},
+                         host._get_container_paths())
+        self.assertEqual([['c2']], walked)
+
+    def test_numa_topology(self):
+        host = hostops.HostOps(FakePlacement())
+        stats = host.get_available_resource('fake-node')
+
+        self.assertEqual({'pinned_cpus': []},
+                         jsonutils.loads(stats['cpu_info']))
+        topology = hardware.VirtNUMAHostTopology.from_json(
+            stats['numa_topology'])
+        self.assertEqual([0, 1], [cell.id for cell in topology.cells])
+        self.assertEqual(set([0, 1, 2, 3]), topology.cells[0].cpuset)
+        self.assertEqual(4096, topology.cells[0].memory)
+        self.assertEqual(2, topology.cells[0].cpu_usage)
+        self.assertEqual(512, topology.cells[0].memory_usage)
+        self.assertEqual(0, topology.cells[1].cpu_usage)
+
+    def test_no_numa_topology(self):
+        self.topology = []
+        stats = hostops.HostOps().get_available_resource('fake-node')
+        self.assertIsNone(stats['numa_topology'])
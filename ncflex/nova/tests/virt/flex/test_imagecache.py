@@ -0,0 +1,63 @@
+import os
+import time
+
+import fixtures
+import mox
+
+from oslo.config import cfg
+
+from ncflex.nova.virt.flex import imagecache
+from nova import test
+
+CONF = cfg.CONF
+
+
+class ImageCacheManagerTestCase(test.TestCase):
+    def setUp(self):
+        super(ImageCacheManagerTestCase, self).setUp()
+        self.flags(instances_path=self.useFixture(fixtures.TempDir()).path)
+        self.flags(remove_unused_base_images=True,
+                   remove_unused_original_minimum_age_seconds=60)
+        self.base_dir = os.path.join(CONF.instances_path,
+                                     CONF.image_cache_subdirectory_name)
+        os.makedirs(self.base_dir)
+        with open(os.path.join(self.base_dir, 'new.tar.gz.part'), 'wb'):
+            pass
+
+    def add_image(self, image_ref, size, age):
+        path = os.path.join(self.base_dir, '%s.tar.gz' % image_ref)
+        with open(path, 'wb') as fp:
+            fp.write(b'\0' * size)
+        last_used = time.time() - age
+        os.utime(path, (last_used, last_used))
+
+    def update(self):
+        manager = imagecache.ImageCacheManager()
+        self.mox.StubOutWithMock(manager, '_list_running_instances')
+        manager._list_running_instances(
+            mox.IgnoreArg(), mox.IgnoreArg()).AndReturn(
+                {'used_images': {'used': (1, 0, ['inst'])}})
+        self.mox.ReplayAll()
+        manager.update(None, [])
+        return sorted(os.listdir(self.base_dir))
+
+    def test_evict_all_unused(self):
+        self.add_image('used', 1024, 3600)
+        self.add_image('old', 1024, 3600)
+        self.add_image('recent', 1024, 10)
+        self.assertEqual(['new.tar.gz.part', 'recent.tar.gz', 'used.tar.gz'],
+                         self.update())
+
+    def test_evict_lru_within_budget(self):
+        self.flags(image_cache_max_size_mb=1, group='lxc')
+        self.add_image('used', 300 * 1024, 3600)
+        self.add_image('old', 300 * 1024, 3600)
+        self.add_image('older', 300 * 1024, 7200)
+        self.add_image('recent', 300 * 1024, 10)
+        self.assertEqual(['new.tar.gz.part', 'old.tar.gz', 'recent.tar.gz',
+                          'used.tar.gz'], self.update())
+
+    def test_keep_when_disabled(self):
+        self.flags(remove_unused_base_images=False)
+        self.add_image('old', 1024, 3600)
+        self.assertEqual(['new.tar.gz.part', 'old.tar.gz'], self.update())
@@ -0,0 +1,202 @@
+import gzip
+import io
+import os
+import shutil
+import stat
+import tarfile
+
+import fixtures
+
+from ncflex.nova.virt.flex import images
+from ncflex.nova.virt.flex import utils as container_utils
+from nova import exception
+from nova.image import glance
+from nova import test
+
+
+def make_tarball(files):
+    data = io.BytesIO()
+    with tarfile.open(fileobj=data, mode='w') as tar:
+        for name, content in files.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(content)
+            tar.addfile(info, io.BytesIO(content))
+    return data.getvalue()
+
+
+def gzip_bytes(data):
+    out = io.BytesIO()
+    with gzip.GzipFile(fileobj=out, mode='wb') as fp:
+        fp.write(data)
+    return out.getvalue()
+
+
+def chunked(data, size=100):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+class FakeImageService(object):
+    def __init__(self, data):
+        self.data = data
+
+    def download(self, context, image_id):
+        return iter(chunked(self.data))
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+class BandwidthThrottleTestCase(test.TestCase):
+    def setUp(self):
+        super(BandwidthThrottleTestCase, self).setUp()
+        self.clock = FakeClock()
+        self.stubs.Set(images.time, 'time', self.clock.time)
+        self.stubs.Set(images.eventlet, 'sleep', self.clock.sleep)
+
+    def test_unlimited(self):
+        throttle = images.BandwidthThrottle(0)
+        throttle.consume(10 ** 9)
+        self.assertEqual([], self.clock.sleeps)
+
+    def test_consume_sleeps_for_the_budget(self):
+        throttle = images.BandwidthThrottle(1000)
+        throttle.consume(500)
+        throttle.consume(1500)
+        self.assertEqual([0.5, 1.5], self.clock.sleeps)
+        self.assertEqual(1002.0, self.clock.now)
+
+    def test_slow_consumer_is_not_delayed(self):
+        throttle = images.BandwidthThrottle(1000)
+        self.clock.now += 10
+        throttle.consume(1000)
+        self.assertEqual([1.0], self.clock.sleeps)
+
+    def test_shared_by_several_consumers(self):
+        # two downloads reserving slots at the same instant share the rate
+        throttle = images.BandwidthThrottle(1000)
+        sleeps = []
+        self.stubs.Set(images.eventlet, 'sleep', sleeps.append)
+        throttle.consume(1000)
+        throttle.consume(1000)
+        self.assertEqual([1.0, 2.0], sleeps)
+
+
+class TarGzValidatorTestCase(test.TestCase):
+    def _feed(self, data):
+        validator = images.TarGzValidator()
+        for chunk in chunked(data, 7):
+            if validator.valid:
+                break
+            validator.feed(chunk)
+        return validator
+
+    def test_valid(self):
+        data = gzip_bytes(make_tarball({'etc/hostname': b'flex\n'}))
+        self.assertTrue(self._feed(data).valid)
+
+    def test_truncated(self):
+        data = gzip_bytes(make_tarball({'etc/hostname': b'flex\n'}))
+        # not enough data for a tar header yet, but nothing wrong either
+        self.assertFalse(self._feed(data[:20]).valid)
+
+    def test_not_gzip(self):
+        self.assertRaises(ValueError, self._feed,
+                          make_tarball({'etc/hostname': b'flex\n'}))
+
+    def test_corrupt_gzip(self):
+        data = bytearray(gzip_bytes(make_tarball({'a': b'x' * 1000})))
+        for i in range(10, 40):
+            data[i] ^= 0xff
+        self.assertRaises(ValueError, self._feed, bytes(data))
+
+    def test_gzip_not_tar(self):
+        self.assertRaises(ValueError, self._feed,
+                          gzip_bytes(b'not a tarball' * 100))
+
+
+class StreamImageTestCase(test.TestCase):
+    def setUp(self):
+        super(StreamImageTestCase, self).setUp()
+        self.flags(image_decompressors=['gzip'], group='lxc')
+        self.tmp = self.useFixture(fixtures.TempDir()).path
+        self.base = os.path.join(self.tmp, 'image.tar.gz')
+        self.image_dir = os.path.join(self.tmp, 'image.partial')
+        self.instance = {'image_ref': 'image'}
+
+        self.stubs.Set(images, 'get_nsexec', lambda idmap: [])
+        self.stubs.Set(images, '_create_image_dir',
+                       lambda image_dir, idmap: os.mkdir(image_dir))
+        self.stubs.Set(images, 'delete_image_dir',
+                       lambda image_dir: shutil.rmtree(image_dir))
+        self.stubs.Set(container_utils, 'execute', lambda *cmd, **kw: None)
+
+    def _stream(self, data):
+        self.stubs.Set(glance, 'get_remote_image_service',
+                       lambda context, image_ref: (FakeImageService(data),
+                                                   image_ref))
+        images._stream_image(None, self.instance,
+                             {'disk_format': 'root-tar'}, self.base,
+                             self.image_dir, None)
+
+    def _assert_cleaned_up(self):
+        self.assertFalse(os.path.exists(self.base))
+        self.assertFalse(os.path.exists('%s.part' % self.base))
+        self.assertFalse(os.path.exists(self.image_dir))
+
+    def test_stream(self):
+        data = gzip_bytes(make_tarball({'etc/hostname': b'flex\n'}))
+        self._stream(data)
+        with open(os.path.join(self.image_dir, 'etc', 'hostname')) as fp:
+            self.assertEqual('flex\n', fp.read())
+        with open(self.base, 'rb') as fp:
+            self.assertEqual(data, fp.read())
+
+    def test_stream_truncated(self):
+        data = gzip_bytes(make_tarball({'etc/hostname': b'flex\n'}))
+        self.assertRaises(exception.ImageUnacceptable, self._stream,
+                          data[:20])
+        self._assert_cleaned_up()
+
+    def test_stream_corrupt(self):
+        self.assertRaises(exception.InvalidDiskFormat, self._stream,
+                          b'\0' * 4096)
+        self._assert_cleaned_up()
+
+
+class DecompressorTestCase(test.TestCase):
+    def setUp(self):
+        super(DecompressorTestCase, self).setUp()
+        self.bin_dir = self.useFixture(fixtures.TempDir()).path
+        self.useFixture(fixtures.EnvironmentVariable('PATH', self.bin_dir))
+
+    def _install(self, program):
+        path = os.path.join(self.bin_dir, program)
+        open(path, 'w').close()
+        os.chmod(path, stat.S_IRWXU)
+
+    def test_prefers_pigz(self):
+        self._install('gzip')
+        self._install('pigz')
+        self.assertEqual('pigz', images.get_decompressor())
+
+    def test_falls_back_to_gzip(self):
+        self._install('gzip')
+        self.assertEqual('gzip', images.get_decompressor())
+        os.unlink(os.path.join(self.bin_dir, 'gzip'))
+        self.assertEqual('gzip', images.get_decompressor())
+
+    def test_configured_order(self):
+        self.flags(image_decompressors=['gzip', 'pigz'], group='lxc')
+        self._install('gzip')
+        self._install('pigz')
+        self.assertEqual('gzip', images.get_decompressor())
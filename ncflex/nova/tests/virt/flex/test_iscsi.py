@@ -0,0 +1,152 @@
+import os
+import socket
+
+import eventlet
+import fixtures
+
+from ncflex.nova.virt.flex import iscsi
+from nova import test
+
+
+class FakeDevice(object):
+    def __init__(self, sys_path, subsystem, action):
+        self.sys_path = sys_path
+        self.subsystem = subsystem
+        self.action = action
+
+
+class FakeMonitor(object):
+    """A pyudev monitor sending its devices through a socket pair."""
+
+    def __init__(self):
+        self.reader, self.writer = socket.socketpair()
+        self.devices = []
+
+    def fileno(self):
+        return self.reader.fileno()
+
+    def filter_by(self, subsystem):
+        pass
+
+    def start(self):
+        pass
+
+    def send(self, device):
+        self.devices.append(device)
+        self.writer.send(b'.')
+
+    def poll(self, timeout=None):
+        if not self.devices:
+            return None
+        self.reader.recv(1)
+        return self.devices.pop(0)
+
+    def close(self):
+        self.reader.close()
+        self.writer.close()
+
+
+class FakePyudev(object):
+    def __init__(self, monitor):
+        self.Monitor = self
+        self.monitor = monitor
+
+    def Context(self):
+        return None
+
+    def from_netlink(self, context):
+        return self.monitor
+
+
+class ISCSIIndexTestCase(test.TestCase):
+    def setUp(self):
+        super(ISCSIIndexTestCase, self).setUp()
+        self.stubs.Set(iscsi, 'pyudev', None)
+        self.sysfs = self.useFixture(fixtures.TempDir()).path
+        self.session_dir = os.path.join(self.sysfs, 'class', 'iscsi_session')
+        os.makedirs(self.session_dir)
+        self._add_session(1, '10.0.0.1', 'iqn.2014-01.org:vol', {1: 'sdb',
+                                                                 2: 'sdc'})
+        self.index = iscsi.ISCSIIndex(self.session_dir)
+        self.props = {'target_portal': '10.0.0.1:3260,1',
+                      'target_iqn': 'iqn.2014-01.org:vol',
+                      'target_lun': 1}
+
+    def _add_session(self, num, address, iqn, luns):
+        device = os.path.join(self.sysfs, 'devices', 'host%d' % num,
+                              'session%d' % num)
+        conn = os.path.join(device, 'connection%d:0' % num,
+                            'iscsi_connection', 'connection%d:0' % num)
+        os.makedirs(conn)
+        with open(os.path.join(conn, 'persistent_address'), 'w') as fp:
+            fp.write('%s\n' % address)
+        with open(os.path.join(conn, 'persistent_port'), 'w') as fp:
+            fp.write('3260\n')
+        for lun, name in luns.items():
+            os.makedirs(os.path.join(device, 'target%d:0:0' % num,
+                                     '%d:0:0:%d' % (num, lun),
+                                     'block', name))
+
+        session = os.path.join(self.session_dir, 'session%d' % num)
+        os.makedirs(session)
+        with open(os.path.join(session, 'targetname'), 'w') as fp:
+            fp.write('%s\n' % iqn)
+        os.symlink(device, os.path.join(session, 'device'))
+
+    def test_lookup(self):
+        self.assertTrue(self.index.has_session(self.props))
+        self.assertEqual('/dev/sdb', self.index.get_device(self.props))
+        self.assertFalse(self.index.has_session(
+            dict(self.props, target_portal='10.0.0.2:3260')))
+        self.assertIsNone(self.index.get_device(
+            dict(self.props, target_lun=3)))
+
+    def test_refcount(self):
+        self.index.set_users([])
+        self.index.attach(self.props, 'uuid-1')
+        self.index.attach(self.props, 'uuid-2')
+        self.assertFalse(self.index.detach(self.props, 'uuid-1'))
+        self.assertTrue(self.index.detach(self.props, 'uuid-2'))
+
+    def test_unknown_users_in_use(self):
+        # a restart forgot who used the LUN
+        self.assertFalse(self.index.detach(self.props, 'uuid-1'))
+        self.index.set_users([(self.props, 'uuid-2')])
+        self.assertFalse(self.index.detach(self.props, 'uuid-1'))
+        self.assertTrue(self.index.detach(self.props, 'uuid-2'))
+
+    def _delete_lun(self, lun):
+        device = os.path.join(self.sysfs, 'devices', 'host1', 'session1',
+                              'target1:0:0', '1:0:0:%d' % lun)
+        os.rmdir(os.path.join(device, 'block', os.listdir(
+            os.path.join(device, 'block'))[0]))
+
+    def test_remove_lun(self):
+        self._delete_lun(1)
+        self.assertFalse(self.index.remove_lun(self.props))
+        self._delete_lun(2)
+        self.assertTrue(self.index.remove_lun(dict(self.props,
+                                                   target_lun=2)))
+
+    def test_wait_for_uevents_without_monitor(self):
+        self.assertFalse(self.index.wait_for_uevents(10))
+
+    def test_concurrent_waiters(self):
+        monitor = FakeMonitor()
+        self.addCleanup(monitor.close)
+        self.stubs.Set(iscsi, 'pyudev', FakePyudev(monitor))
+        index = iscsi.ISCSIIndex(self.session_dir)
+        self.assertTrue(index.has_session(self.props))
+        self.addCleanup(index._reader.kill)
+
+        # both wait on the uevents of the same monitor
+        waiters = [eventlet.spawn(index.wait_for_uevents, 10)
+                   for i in range(2)]
+        eventlet.sleep(0)
+        monitor.send(FakeDevice(
+            '/devices/platform/host1/session1/iscsi_session/session1',
+            'iscsi_session', 'remove'))
+        with eventlet.Timeout(5):
+            self.assertEqual([True, True],
+                             [waiter.wait() for waiter in waiters])
+        self.assertFalse(index.has_session(self.props))
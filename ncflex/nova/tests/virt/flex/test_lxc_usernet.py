@@ -1,5 +1,7 @@
-from ncflex.nova.virt.flex.lxc_usernet import (lfilter, load_usernet,
-                                               update_usernet, UserNetLine)
+from ncflex.nova.virt.flex.lxc_usernet import (batch_update, lfilter,
+                                               load_usernet, parse_batch,
+                                               update_usernet, UserNetFile,
+                                               UserNetLine)
 
 import tempfile
 import os
@@ -54,3 +56,40 @@ class TestOps(TestCase):
         update_usernet("user1", "br100", "dec", count=4, fname=self.tmpf)
         found = lfilter(self.tmpf, user="user1", bridge="br100", count=124)
         self.assertEqual(len(found), 1)
+
+    def test_del_existing(self):
+        self.setup_conf_1()
+        update_usernet("user1", "br100", "set", count=0, fname=self.tmpf)
+        self.assertFalse(self.tmpfHas("user1 veth br100 128"))
+        self.assertTrue(self.tmpfHas("foo bar zeebridge 1"))
+
+    def test_batch(self):
+        self.setup_conf_1()
+        batch_update(parse_batch(["inc user1 br100 2",
+                                  "set user2 br101",
+                                  "set user2 br102 3",
+                                  "del user2 br102"]),
+                     fname=self.tmpf)
+        self.assertTrue(self.tmpfHas("user1 veth br100 130"))
+        self.assertTrue(self.tmpfHas("user2 veth br101 1"))
+        self.assertEqual(lfilter(self.tmpf, user="user2", bridge="br102"),
+                         [])
+
+    def test_batch_failure_writes_nothing(self):
+        self.setup_conf_1()
+        self.assertRaises(ValueError, batch_update,
+                          [("inc", "user1", "br100", 1),
+                           ("inc", "user9", "br100", 1)],
+                          strict=True, fname=self.tmpf)
+        self.assertTrue(self.tmpfHas("user1 veth br100 128"))
+
+    def test_index_duplicates(self):
+        self.setup_conf_1()
+        with open(self.tmpf, "a") as fp:
+            fp.write("user1 veth br100 2\n")
+        usernet = UserNetFile(self.tmpf)
+        self.assertEqual(usernet.get("user1", "br100").count, "2")
+        usernet.update("user1", "br100", "inc")
+        usernet.save()
+        self.assertEqual([str(l) for l in load_usernet(self.tmpf)],
+                         ["foo bar zeebridge 1", "user1 veth br100 3"])
@@ -0,0 +1,90 @@
+import errno
+import os
+
+import fixtures
+
+from ncflex.nova.virt.flex import netdev
+from ncflex.nova.virt.flex import utils as container_utils
+from nova import test
+
+
+class NetDevTestCase(test.TestCase):
+    def setUp(self):
+        super(NetDevTestCase, self).setUp()
+        self.calls = []
+        self.stderr = ''
+
+        def fake_execute(*cmd, **kwargs):
+            self.calls.append((cmd, kwargs.get('process_input')))
+            return '', self.stderr
+
+        self.stubs.Set(container_utils, 'execute', fake_execute)
+        self.stubs.Set(os, 'geteuid', lambda: 1000)
+        self.warnings = []
+        self.stubs.Set(netdev.LOG, 'warn',
+                       lambda *args: self.warnings.append(args))
+
+    def test_ensure_hybrid_bridges_batched(self):
+        self.stubs.Set(netdev, 'device_exists', lambda device: False)
+        created = netdev.ExecNetDev().ensure_hybrid_bridges(
+            [('qbr1', 'qvb1', 'qvo1'), ('qbr2', 'qvb2', 'qvo2')], mtu=9000)
+
+        self.assertEqual(['qvo1', 'qvo2'], created)
+        self.assertEqual(['ip', 'tee'],
+                         [cmd[0] for cmd, process_input in self.calls])
+        ip_cmds = self.calls[0][1].splitlines()
+        self.assertIn('link add qbr1 type bridge', ip_cmds)
+        self.assertIn('link add qvb2 type veth peer name qvo2', ip_cmds)
+        self.assertIn('link set qvb1 master qbr1', ip_cmds)
+        self.assertEqual(netdev.get_bridge_attr_paths(['qbr1', 'qbr2']),
+                         list(self.calls[1][0][1:]))
+
+    def test_ensure_hybrid_bridges_existing(self):
+        self.stubs.Set(netdev, 'device_exists', lambda device: True)
+        self.assertEqual([], netdev.ExecNetDev().ensure_hybrid_bridges(
+            [('qbr1', 'qvb1', 'qvo1')]))
+        self.assertEqual([], self.calls)
+
+    def test_set_bridge_attrs_not_root(self):
+        self.stderr = ('tee: /sys/class/net/qbr1/bridge/multicast_snooping: '
+                       '%s\ntee: /sys/class/net/qbr1/bridge/stp_state: %s\n'
+                       % (os.strerror(errno.ENOENT),
+                          os.strerror(errno.EACCES)))
+        netdev.set_bridge_attrs(['qbr1'])
+        self.assertEqual('tee', self.calls[0][0][0])
+        self.assertEqual('0', self.calls[0][1])
+        self.assertEqual(1, len(self.warnings))
+
+    def test_set_bridge_attrs_root(self):
+        self.stubs.Set(os, 'geteuid', lambda: 0)
+        errors = {'forward_delay': None,
+                  'stp_state': errno.EACCES,
+                  'multicast_snooping': errno.ENOENT}
+        written = []
+
+        class FakeFile(object):
+            def __init__(self, path):
+                self.path = path
+
+            def __enter__(self):
+                return self
+
+            def __exit__(self, *args):
+                pass
+
+            def write(self, data):
+                written.append((self.path, data))
+
+        def fake_open(path, mode):
+            error = errors[os.path.basename(path)]
+            if error:
+                raise IOError(error, os.strerror(error))
+            return FakeFile(path)
+
+        self.useFixture(fixtures.MonkeyPatch(
+            'ncflex.nova.virt.flex.netdev.open', fake_open))
+        netdev.set_bridge_attrs(['qbr1'])
+        self.assertEqual([('/sys/class/net/qbr1/bridge/forward_delay', '0')],
+                         written)
+        self.assertEqual(1, len(self.warnings))
+        self.assertEqual([], self.calls)
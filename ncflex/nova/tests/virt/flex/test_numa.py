@@ -0,0 +1,83 @@
+import os
+
+import fixtures
+
+from ncflex.nova.virt.flex import numa
+from nova import test
+
+
+class FakeFlavor(object):
+    def __init__(self, memory_mb, extra_specs=None):
+        self.memory_mb = memory_mb
+        self.extra_specs = extra_specs or {}
+
+
+class NUMATestCase(test.TestCase):
+    def setUp(self):
+        super(NUMATestCase, self).setUp()
+        self.node_dir = self.useFixture(fixtures.TempDir()).path
+        self.make_node(0, '0-3', 4096)
+        self.make_node(1, '4-7', 4096)
+        os.makedirs(os.path.join(self.node_dir, 'power'))
+
+    def make_node(self, node, cpulist, memory_mb):
+        path = os.path.join(self.node_dir, 'node%d' % node)
+        os.makedirs(path)
+        with open(os.path.join(path, 'cpulist'), 'w') as fp:
+            fp.write('%s\n' % cpulist)
+        with open(os.path.join(path, 'meminfo'), 'w') as fp:
+            fp.write('Node %d MemTotal:       %d kB\n'
+                     'Node %d MemFree:        1024 kB\n'
+                     % (node, memory_mb * 1024, node))
+
+    def test_get_host_topology(self):
+        self.assertEqual(
+            [{'id': 0, 'cpus': [0, 1, 2, 3], 'memory_mb': 4096},
+             {'id': 1, 'cpus': [4, 5, 6, 7], 'memory_mb': 4096}],
+            numa.get_host_topology(self.node_dir))
+
+    def test_place(self):
+        placement = numa.NUMAPlacement()
+        placement.cells = numa.get_host_topology(self.node_dir)
+
+        first = placement.place({'uuid': 'a', 'vcpus': 2}, FakeFlavor(2048))
+        second = placement.place({'uuid': 'b', 'vcpus': 2}, FakeFlavor(2048))
+        self.assertEqual(set([('0-3', '0'), ('4-7', '1')]),
+                         set([first, second]))
+
+        # does not fit in any node anymore
+        self.assertIsNone(placement.place({'uuid': 'c', 'vcpus': 1},
+                                          FakeFlavor(3072)))
+        placement.release({'uuid': 'a'})
+        self.assertEqual(first, placement.place({'uuid': 'c', 'vcpus': 1},
+                                                FakeFlavor(3072)))
+
+    def test_place_pinned_flavor(self):
+        placement = numa.NUMAPlacement()
+        placement.cells = numa.get_host_topology(self.node_dir)
+        self.assertIsNone(placement.place(
+            {'uuid': 'a', 'vcpus': 1},
+            FakeFlavor(512, {'flex:cpuset': '0'})))
+
+    def test_load_counts_flavor_vcpus(self):
+        cgroup_root = self.useFixture(fixtures.TempDir()).path
+        self.flags(cgroup_root=cgroup_root, group='lxc')
+        for controller, items in (('memory', {'memory.limit_in_bytes':
+                                              1024 * 1024 * 1024}),
+                                  ('cpu', {'cpu.shares': 2048}),
+                                  ('cpuset', {'cpuset.cpus': '4-7',
+                                              'cpuset.mems': '1'})):
+            path = os.path.join(cgroup_root, controller, 'lxc', 'a')
+            os.makedirs(path)
+            for item, value in items.items():
+                with open(os.path.join(path, item), 'w') as fp:
+                    fp.write('%s\n' % value)
+        topology = numa.get_host_topology(self.node_dir)
+        self.stubs.Set(numa, 'get_host_topology', lambda: topology)
+        self.stubs.Set(numa.lxc, 'list_containers',
+                       lambda **kwargs: ['a'])
+
+        placement = numa.NUMAPlacement()
+        self.assertEqual({0: {'memory_mb': 0, 'vcpus': 0},
+                          1: {'memory_mb': 1024, 'vcpus': 2}},
+                         placement.get_usage())
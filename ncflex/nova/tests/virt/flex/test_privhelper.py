@@ -0,0 +1,171 @@
+import os
+import pwd
+
+import fixtures
+import mox
+from oslo.rootwrap import filters
+
+from ncflex.nova.virt.flex import privhelper
+from nova.openstack.common import processutils
+from nova import test
+
+FILTERS = """
+[Filters]
+btrfs: CommandFilter, btrfs, root
+lxc-stop: CommandFilter, %(bin)s/lxc-stop, root
+lxc-missing: CommandFilter, %(bin)s/lxc-missing, root
+kill_lxc: KillFilter, root, /usr/bin/lxc-start, -9
+rm: PathFilter, %(bin)s/rm, root, -rf, %(instances)s/
+unknown: UnknownFilter, %(bin)s/lxc-stop, root
+flex-priv-helper: RegExpFilter, flex-priv-helper, root, flex-priv-helper
+"""
+
+
+class PrivHelperTestCase(test.TestCase):
+    def setUp(self):
+        super(PrivHelperTestCase, self).setUp()
+        tmpdir = self.useFixture(fixtures.TempDir()).path
+        self.bin_dir = os.path.join(tmpdir, 'bin')
+        self.evil_dir = os.path.join(tmpdir, 'evil')
+        self.instances_path = os.path.realpath(
+            os.path.join(tmpdir, 'instances'))
+        for path in (os.path.join(self.bin_dir, 'btrfs'),
+                     os.path.join(self.bin_dir, 'lxc-stop'),
+                     os.path.join(self.bin_dir, 'rm'),
+                     os.path.join(self.bin_dir, 'flex-priv-helper'),
+                     os.path.join(self.evil_dir, 'btrfs')):
+            self._make_executable(path)
+        self.filters = os.path.join(tmpdir, 'flex.filters')
+        with open(self.filters, 'w') as fp:
+            fp.write(FILTERS % {'bin': self.bin_dir,
+                                'instances': self.instances_path})
+        self.user = pwd.getpwuid(os.getuid()).pw_name
+
+    def _make_executable(self, path):
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as fp:
+            fp.write('#!/bin/sh\necho %s\n' % path)
+        os.chmod(path, 0o755)
+
+    def _helper(self, *filter_list):
+        return privhelper.PrivHelper(list(filter_list), self.instances_path,
+                                     exec_dirs=[self.bin_dir])
+
+    def test_load_filters(self):
+        filter_list = privhelper.load_filters(self.filters)
+        self.assertEqual(['btrfs', 'lxc-stop', 'lxc-missing', 'kill_lxc',
+                          'rm'],
+                         [f.name for f in filter_list])
+        self.assertIsInstance(filter_list[4], filters.PathFilter)
+
+    def test_execute_not_allowed(self):
+        helper = self._helper(filters.CommandFilter('btrfs', self.user))
+        self.assertRaises(privhelper.PrivHelperError,
+                          helper.execute, ['rm', '-rf', '/'])
+        self.assertRaises(privhelper.PrivHelperError, helper.execute, [])
+
+    def test_execute_path_filter(self):
+        helper = self._helper(*privhelper.load_filters(self.filters))
+        for cmd in (['rm', '-rf', '/'], ['rm', '-rf', self.instances_path],
+                    ['rm', '-rf', os.path.join(self.instances_path, '..')],
+                    ['rm', '-rf', '--', os.path.join(self.instances_path,
+                                                     'uuid')]):
+            self.assertRaises(privhelper.PrivHelperError,
+                              helper.execute, cmd)
+        self.assertEqual(
+            ([os.path.join(self.bin_dir, 'rm'), '-rf',
+              os.path.join(self.instances_path, 'uuid')], 'root', None),
+            helper._resolve(['rm', '-rf',
+                             os.path.join(self.instances_path, 'uuid')]))
+
+    def test_execute_same_basename_refused(self):
+        btrfs = os.path.join(self.bin_dir, 'btrfs')
+        helper = self._helper(filters.CommandFilter(btrfs, self.user))
+        for cmd in (os.path.join(self.evil_dir, 'btrfs'), './btrfs',
+                    'bin/btrfs'):
+            self.assertRaises(privhelper.PrivHelperError,
+                              helper.execute, [cmd])
+        self.assertEqual('%s\n' % btrfs,
+                         helper.execute(['btrfs'])['stdout'])
+        self.assertEqual('%s\n' % btrfs,
+                         helper.execute([btrfs])['stdout'])
+
+    def test_container_op_outside_instances_path(self):
+        helper = self._helper()
+        for name, config_path in (
+                ('uuid', '/'),
+                ('uuid', os.path.join(self.instances_path, 'uuid')),
+                ('uuid', os.path.join(self.instances_path, '..')),
+                ('../uuid', self.instances_path),
+                ('..', self.instances_path)):
+            self.assertRaises(privhelper.PrivHelperError,
+                              helper.container_op, name, config_path,
+                              'start')
+
+    def test_check_root_owned(self):
+        self.useFixture(fixtures.MonkeyPatch(
+            'os.lstat', lambda path: os.stat_result(
+                (0o100664, 0, 0, 1, 0, 0, 0, 0, 0, 0))))
+        self.assertRaises(privhelper.PrivHelperError,
+                          privhelper._check_root_owned, self.filters)
+
+    def test_dispatch_private(self):
+        helper = self._helper()
+        for method in ('_get_netdev', 'dispatch', 'filters', 'missing'):
+            self.assertRaises(privhelper.PrivHelperError,
+                              helper.dispatch, {'method': method})
+
+    def test_client_execute_exit_code(self):
+        client = privhelper.PrivHelperClient('/nonexistent')
+        self.mox.StubOutWithMock(client, 'call')
+        client.call('execute', cmd=['btrfs', 'sub', 'list', '/'],
+                    process_input=None).AndReturn(
+            {'exit_code': 1, 'stdout': '', 'stderr': 'error'})
+        client.call('execute', cmd=['btrfs', 'sub', 'list', '/'],
+                    process_input=None).AndReturn(
+            {'exit_code': 1, 'stdout': 'out', 'stderr': ''})
+        self.mox.ReplayAll()
+
+        self.assertRaises(processutils.ProcessExecutionError,
+                          client.execute, 'btrfs', 'sub', 'list', '/')
+        self.assertEqual(('out', ''),
+                         client.execute('btrfs', 'sub', 'list', '/',
+                                        check_exit_code=[0, 1]))
+
+    def test_client_execute_attempts(self):
+        client = privhelper.PrivHelperClient('/nonexistent')
+        self.mox.StubOutWithMock(client, 'call')
+        self.mox.StubOutWithMock(privhelper.time, 'sleep')
+        for exit_code in (1, 1, 0):
+            client.call('execute', cmd=['iscsiadm', '-m', 'session'],
+                        process_input=None).AndReturn(
+                {'exit_code': exit_code, 'stdout': 'out', 'stderr': ''})
+        privhelper.time.sleep(mox.IsA(float))
+        privhelper.time.sleep(mox.IsA(float))
+        self.mox.ReplayAll()
+
+        self.assertEqual(('out', ''),
+                         client.execute('iscsiadm', '-m', 'session',
+                                        attempts=3))
+
+    def test_client_execute_attempts_exhausted(self):
+        client = privhelper.PrivHelperClient('/nonexistent')
+        self.mox.StubOutWithMock(client, 'call')
+        for i in range(2):
+            client.call('execute', cmd=['iscsiadm', '-m', 'session'],
+                        process_input=None).AndReturn(
+                {'exit_code': 1, 'stdout': '', 'stderr': 'error'})
+        self.mox.ReplayAll()
+
+        self.assertRaises(processutils.ProcessExecutionError,
+                          client.execute, 'iscsiadm', '-m', 'session',
+                          attempts=2, delay_on_retry=False)
+
+    def test_client_execute_unsupported_kwargs(self):
+        client = privhelper.PrivHelperClient('/nonexistent')
+        self.mox.StubOutWithMock(client, 'call')
+        self.mox.ReplayAll()
+
+        self.assertRaises(TypeError, client.execute, 'btrfs', 'sub', 'list',
+                          '/', cwd='/tmp')
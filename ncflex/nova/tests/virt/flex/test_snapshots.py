@@ -0,0 +1,89 @@
+import os
+
+import fixtures
+from oslo.config import cfg
+
+from ncflex.nova.virt.flex import images
+from ncflex.nova.virt.flex import snapshots
+from ncflex.nova.virt.flex import utils as container_utils
+from nova.image import glance
+from nova import test
+
+CONF = cfg.CONF
+
+
+class FakeImageService(object):
+    def show(self, context, image_id):
+        return {'name': 'snap'}
+
+
+class SnapshotsTestCase(test.TestCase):
+    def setUp(self):
+        super(SnapshotsTestCase, self).setUp()
+        self.instances_path = self.useFixture(fixtures.TempDir()).path
+        self.flags(instances_path=self.instances_path)
+        self.instance = {'uuid': 'fake-uuid', 'project_id': 'fake'}
+        self.snapshot_dir = snapshots.get_snapshot_dir(self.instance)
+
+        self.commands = []
+        self.deleted = []
+
+        def fake_execute(*cmd, **kwargs):
+            self.commands.append(cmd)
+            if cmd[:3] == ('btrfs', 'subvolume', 'snapshot'):
+                os.makedirs(cmd[-1])
+
+        def fake_delete_image_dir(image_dir):
+            self.deleted.append(image_dir)
+            os.rmdir(image_dir)
+
+        self.stubs.Set(container_utils, 'execute', fake_execute)
+        self.stubs.Set(container_utils, 'get_lxc_security_info',
+                       lambda instance: 'unprivileged')
+        self.stubs.Set(images, 'delete_image_dir', fake_delete_image_dir)
+        self.stubs.Set(glance, 'get_remote_image_service',
+                       lambda context, image_id: (FakeImageService(),
+                                                  image_id))
+
+    def _snapshot(self, image_id='image-1'):
+        snapshots.snapshot_container(None, self.instance, image_id,
+                                     lambda **kwargs: None, None)
+
+    def test_snapshot_is_deleted_after_upload(self):
+        uploads = []
+        self.stubs.Set(snapshots, '_upload_snapshot',
+                       lambda *args: uploads.append(args[4]))
+        self._snapshot()
+        self.assertEqual([os.path.join(self.snapshot_dir, 'image-1')],
+                         uploads)
+        self.assertEqual(uploads, self.deleted)
+        self.assertFalse(os.path.exists(self.snapshot_dir))
+
+    def test_snapshot_is_deleted_after_failed_upload(self):
+        def fake_upload(*args):
+            raise test.TestingException()
+
+        self.stubs.Set(snapshots, '_upload_snapshot', fake_upload)
+        self.assertRaises(test.TestingException, self._snapshot)
+        self.assertFalse(os.path.exists(self.snapshot_dir))
+
+    def test_snapshot_seeds_image_cache(self):
+        self.flags(snapshot_seed_image_cache=True, group='lxc')
+        self.stubs.Set(snapshots, '_upload_snapshot', lambda *args: None)
+        self._snapshot()
+        self.assertTrue(os.path.isdir(os.path.join(
+            self.instances_path, CONF.image_cache_subdirectory_name,
+            'image-1')))
+        self.assertFalse(os.path.exists(self.snapshot_dir))
+
+    def test_delete_snapshots(self):
+        leftover = os.path.join(self.snapshot_dir, 'image-0')
+        os.makedirs(leftover)
+        snapshots.delete_snapshots(self.instance)
+        self.assertEqual([leftover], self.deleted)
+        self.assertFalse(os.path.exists(self.snapshot_dir))
+
+    def test_delete_snapshots_none(self):
+        snapshots.delete_snapshots(self.instance)
+        self.assertEqual([], self.deleted)
+
@@ -0,0 +1,53 @@
+import time
+
+import mox
+
+from oslo.config import cfg
+
+from ncflex.nova.virt.flex import utils as container_utils
+from nova import objects
+from nova import test
+
+CONF = cfg.CONF
+
+
+class FlavorCacheTestCase(test.TestCase):
+    def setUp(self):
+        super(FlavorCacheTestCase, self).setUp()
+        container_utils.invalidate_flavor_cache()
+        self.addCleanup(container_utils.invalidate_flavor_cache)
+        self.instance = {'uuid': '32dfcb37-5af1-552b-357c-be8c3aa38310',
+                         'instance_type_id': '5'}
+        self.flavor = objects.Flavor(id=5, extra_specs={})
+
+    def test_get_flavor_cached(self):
+        self.mox.StubOutWithMock(objects.Flavor, 'get_by_id')
+        objects.Flavor.get_by_id(mox.IgnoreArg(), 5).AndReturn(self.flavor)
+        self.mox.ReplayAll()
+        self.assertEqual(self.flavor,
+                         container_utils.get_flavor(self.instance))
+        self.assertEqual(self.flavor,
+                         container_utils.get_flavor(self.instance))
+        self.assertEqual('unprivileged',
+                         container_utils.get_lxc_security_info(self.instance))
+
+    def test_get_flavor_expired(self):
+        self.flags(flavor_cache_ttl=10, group='lxc')
+        self.mox.StubOutWithMock(objects.Flavor, 'get_by_id')
+        self.mox.StubOutWithMock(time, 'time')
+        time.time().AndReturn(100)
+        objects.Flavor.get_by_id(mox.IgnoreArg(), 5).AndReturn(self.flavor)
+        time.time().AndReturn(111)
+        objects.Flavor.get_by_id(mox.IgnoreArg(), 5).AndReturn(self.flavor)
+        self.mox.ReplayAll()
+        container_utils.get_flavor(self.instance)
+        container_utils.get_flavor(self.instance)
+
+    def test_invalidate_flavor_cache(self):
+        self.mox.StubOutWithMock(objects.Flavor, 'get_by_id')
+        objects.Flavor.get_by_id(mox.IgnoreArg(), 5).AndReturn(self.flavor)
+        objects.Flavor.get_by_id(mox.IgnoreArg(), 5).AndReturn(self.flavor)
+        self.mox.ReplayAll()
+        container_utils.get_flavor(self.instance)
+        container_utils.invalidate_flavor_cache('5')
+        container_utils.get_flavor(self.instance)
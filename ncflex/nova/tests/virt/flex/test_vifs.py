@@ -0,0 +1,72 @@
+import os
+
+from ncflex.nova.virt.flex import netdev
+from ncflex.nova.virt.flex import utils as container_utils
+from ncflex.nova.virt.flex import vifs
+from nova.network import model as network_model
+from nova import test
+
+
+class LXCGenericDriverTestCase(test.TestCase):
+    def setUp(self):
+        super(LXCGenericDriverTestCase, self).setUp()
+        self.flags(netdev_driver='ncflex.nova.virt.flex.netdev.ExecNetDev',
+                   use_priv_helper=False, group='lxc')
+        self.calls = []
+
+        def fake_execute(*cmd, **kwargs):
+            self.calls.append((cmd, kwargs.get('process_input')))
+            return '', ''
+
+        self.stubs.Set(container_utils, 'execute', fake_execute)
+        self.stubs.Set(netdev, 'device_exists', lambda device: False)
+        self.stubs.Set(os, 'geteuid', lambda: 1000)
+        self.instance = {'uuid': 'fake-uuid'}
+
+    def _make_vif(self, vif_id):
+        return {'id': vif_id,
+                'type': network_model.VIF_TYPE_OVS,
+                'address': 'fa:16:3e:00:00:01',
+                'network': {'bridge': 'br-int'}}
+
+    def test_plug_vifs_batches_ovs_vifs(self):
+        network_info = [self._make_vif(vif_id)
+                        for vif_id in ('a', 'bb', 'ccc')]
+        vifs.LXCGenericDriver().plug_vifs(self.instance, network_info)
+
+        self.assertEqual(['ip', 'tee', 'ovs-vsctl', 'lxc-usernet-manage'],
+                         [cmd[0] for cmd, process_input in self.calls])
+
+        ip_cmds = self.calls[0][1].splitlines()
+        for vif_id in ('a', 'bb', 'ccc'):
+            self.assertIn('link add qbr%s type bridge' % vif_id, ip_cmds)
+            self.assertIn('link add qvb%s type veth peer name qvo%s'
+                          % (vif_id, vif_id), ip_cmds)
+
+        self.assertEqual(
+            netdev.get_bridge_attr_paths(['qbra', 'qbrbb', 'qbrccc']),
+            list(self.calls[1][0][1:]))
+
+        ovs_cmd = self.calls[2][0]
+        # add-port <bridge> <port>, all in one ovs-vsctl transaction
+        self.assertEqual(['qvoa', 'qvobb', 'qvoccc'],
+                         [ovs_cmd[i + 2] for i, arg in enumerate(ovs_cmd)
+                          if arg == 'add-port'])
+
+        usernet = self.calls[3][1].splitlines()
+        self.assertEqual(3, len(usernet))
+
+    def test_plug_vifs_raises_failed_plug(self):
+        bridge_vif = {'id': 'b', 'type': network_model.VIF_TYPE_BRIDGE,
+                      'network': {'bridge': 'br100'}}
+        driver = vifs.LXCGenericDriver()
+        plugged = []
+
+        def fake_plug_bridge(instance, vif):
+            plugged.append(vif['id'])
+            raise test.TestingException()
+
+        self.stubs.Set(driver, 'plug_bridge', fake_plug_bridge)
+        self.assertRaises(test.TestingException, driver.plug_vifs,
+                          self.instance, [self._make_vif('a'), bridge_vif])
+        self.assertEqual(['b'], plugged)
@@ -0,0 +1,67 @@
+import os
+
+import fixtures
+
+from ncflex.nova.virt.flex import volumes
+from nova import test
+
+
+class WaitForDevicesTestCase(test.TestCase):
+    def setUp(self):
+        super(WaitForDevicesTestCase, self).setUp()
+        self.dev_dir = self.useFixture(fixtures.TempDir()).path
+        self.paths = [os.path.join(self.dev_dir, name)
+                      for name in ('sda', 'sdb')]
+
+    def test_devices_present(self):
+        for path in self.paths:
+            open(path, 'w').close()
+        self.assertEqual(self.paths,
+                         volumes.wait_for_devices(self.paths, 2, 10))
+
+    def test_timeout_rescans(self):
+        rescans = []
+
+        def rescan():
+            rescans.append(True)
+            open(self.paths[1], 'w').close()
+
+        self.assertEqual([self.paths[1]],
+                         volumes.wait_for_devices(self.paths, 2, 0.4,
+                                                  rescan=rescan))
+        self.assertEqual([True], rescans)
+
+    def test_woken_by_uevents(self):
+        waits = []
+
+        class FakeIndex(object):
+            def wait_for_uevents(index, timeout):
+                waits.append(timeout)
+                open(self.paths[len(waits) - 1], 'w').close()
+                return True
+
+        self.stubs.Set(volumes.eventlet, 'sleep', self.fail)
+        self.assertEqual(self.paths,
+                         volumes.wait_for_devices(self.paths, 2, 10,
+                                                  index=FakeIndex()))
+        self.assertEqual(2, len(waits))
+
+
+class VolumeOpsTestCase(test.TestCase):
+    def test_get_iscsi_paths(self):
+        props = {'target_portal': '10.0.0.1:3260', 'target_iqn': 'iqn-a',
+                 'target_lun': 1,
+                 'target_portals': ['10.0.0.1:3260', '10.0.0.2:3260'],
+                 'target_iqns': ['iqn-a', 'iqn-b'],
+                 'target_luns': [1, 2]}
+        ops = volumes.VolumeOps()
+
+        self.flags(iscsi_use_multipath=False, group='lxc')
+        self.assertEqual([props], ops._get_iscsi_paths(props))
+
+        self.flags(iscsi_use_multipath=True, group='lxc')
+        paths = ops._get_iscsi_paths(props)
+        self.assertEqual([('10.0.0.1:3260', 'iqn-a', 1),
+                          ('10.0.0.2:3260', 'iqn-b', 2)],
+                         [(path['target_portal'], path['target_iqn'],
+                           path['target_lun']) for path in paths])
@@ -0,0 +1,213 @@
+# Copyright (c) 2014 Canonical Ltd
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Read container accounting straight from the cgroup filesystem.
+
+Going through lxc.Container.get_cgroup_item() costs a container object
+and a liblxc round trip per value; for host wide queries it is much
+cheaper to find every container cgroup in one walk and read the files.
+"""
+
+import os
+import time
+
+from oslo.config import cfg
+
+from nova.openstack.common import log as logging
+
+cgroup_opts = [
+    cfg.StrOpt('cgroup_root',
+               default='/sys/fs/cgroup',
+               help='Mount point of the cgroup controllers'),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(cgroup_opts, 'lxc')
+
+LOG = logging.getLogger(__name__)
+
+
+def get_cgroup_path(controller, relpath=''):
+    return os.path.join(CONF.lxc.cgroup_root, controller, relpath)
+
+
+def find_container_cgroups(names, controller='memory'):
+    """Walk a controller hierarchy once and locate container cgroups.
+
+    Returns a dict of container name to the cgroup path relative to the
+    controller mount point. cgmanager creates the same relative path in
+    every controller, so the result can be used with any of them.
+    """
+    names = set(names)
+    found = {}
+    if not names:
+        return found
+
+    root = get_cgroup_path(controller)
+    for dirpath, dirnames, filenames in os.walk(root):
+        for dirname in list(dirnames):
+            if dirname in names and dirname not in found:
+                found[dirname] = os.path.relpath(
+                    os.path.join(dirpath, dirname), root)
+                # nothing of interest below a container cgroup
+                dirnames.remove(dirname)
+        if len(found) == len(names):
+            break
+    return found
+
+
+def read_cgroup_item(controller, relpath, item):
+    """Return the stripped content of a cgroup file, or None."""
+    try:
+        with open(os.path.join(get_cgroup_path(controller, relpath),
+                               item), 'r') as fp:
+            return fp.read().strip()
+    except (IOError, OSError):
+        return None
+
+
+def read_cgroup_int(controller, relpath, item, default=0):
+    value = read_cgroup_item(controller, relpath, item)
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return default
+
+
+def read_cgroup_stat(controller, relpath, item):
+    """Return the values of a flat keyed file such as memory.stat."""
+    stats = {}
+    for line in (read_cgroup_item(controller, relpath, item) or
+                 '').splitlines():
+        fields = line.split()
+        if len(fields) == 2 and fields[1].isdigit():
+            stats[fields[0]] = int(fields[1])
+    return stats
+
+
+def parse_cpuset(cpuset):
+    """Parse a cpuset list such as '0-3,8,10-11' into a set of ints."""
+    cpus = set()
+    for part in (cpuset or '').split(','):
+        part = part.strip()
+        if not part:
+            continue
+        if '-' in part:
+            start, end = part.split('-', 1)
+            cpus.update(range(int(start), int(end) + 1))
+        else:
+            cpus.add(int(part))
+    return cpus
+
+
+def format_cpuset(cpus):
+    """Format a set of ints as a cpuset list such as '0-3,8,10-11'."""
+    ranges = []
+    for cpu in sorted(cpus):
+        if ranges and cpu == ranges[-1][1] + 1:
+            ranges[-1][1] = cpu
+        else:
+            ranges.append([cpu, cpu])
+    return ','.join(str(start) if start == end else '%d-%d' % (start, end)
+                    for start, end in ranges)
+
+
+def read_cpu_usage(relpath):
+    """Return (cpu_time, per-cpu times) of a cgroup in nanoseconds.
+
+    cpuacct.usage is preferred; on kernels where it cannot be read the
+    total is summed up from cpuacct.usage_percpu.
+    """
+    percpu = read_cgroup_item('cpuacct', relpath, 'cpuacct.usage_percpu')
+    percpu = [int(t) for t in (percpu or '').split()]
+    usage = read_cgroup_int('cpuacct', relpath, 'cpuacct.usage', None)
+    if usage is None:
+        usage = sum(percpu)
+    return usage, percpu
+
+
+class CPUSampler(object):
+    """Incrementally sample container cpu usage.
+
+    The cgroup of every container is remembered after it has been found
+    once, so a sample only reads one cpuacct.usage file per container.
+    The hierarchy is walked again only for containers that are new or
+    whose cgroup went away (e.g. after a restart). A container that is
+    not found by such a walk is not looked for again until the paths are
+    refreshed by update_paths() or it is forgotten, so stopped containers
+    do not cost a walk on every poll. Utilization is the number of cpu
+    seconds used per wall clock second since the previous sample, so 1.5
+    means one and a half cpus were busy.
+    """
+
+    def __init__(self):
+        self._paths = {}
+        self._samples = {}
+        # containers without a cgroup at the last walk
+        self._missing = set()
+
+    def update_paths(self, paths):
+        """Take the result of a host wide walk of the hierarchy."""
+        self._paths.update(paths)
+        self._missing = set()
+
+    def get_path(self, name):
+        return self._paths.get(name)
+
+    def forget(self, name):
+        self._paths.pop(name, None)
+        self._samples.pop(name, None)
+        self._missing.discard(name)
+
+    def sample(self, names):
+        now = time.time()
+        usage = {}
+        missing = []
+        for name in names:
+            if name in self._missing:
+                continue
+            relpath = self._paths.get(name)
+            value = None
+            if relpath is not None:
+                value = read_cgroup_int('cpuacct', relpath, 'cpuacct.usage',
+                                        None)
+            if value is None:
+                missing.append(name)
+            else:
+                usage[name] = value
+
+        if missing:
+            found = find_container_cgroups(missing)
+            self._paths.update(found)
+            for name, relpath in found.items():
+                usage[name] = read_cpu_usage(relpath)[0]
+
+        result = {}
+        for name in names:
+            if name not in usage:
+                self._paths.pop(name, None)
+                self._samples.pop(name, None)
+                self._missing.add(name)
+                continue
+            utilization = None
+            previous = self._samples.get(name)
+            if previous is not None and now > previous[0]:
+                delta = usage[name] - previous[1]
+                if delta >= 0:
+                    utilization = delta / ((now - previous[0]) * 1e9)
+            self._samples[name] = (now, usage[name])
+            result[name] = {'cpu_time': usage[name],
+                            'utilization': utilization}
+        return result
@@ -12,37 +12,118 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+"""
+Generate the LXC configuration of containers.
+
+The part of a configuration that only depends on the template and the
+flavor is compiled once per combination and cached; the per instance
+part (name, paths and network) is appended to it and the whole file is
+written at once, then renamed into place.
+
+The items of the volumes come last, after VOLUMES_MARKER. The kernel
+name and number of a volume's device change across logins and host
+reboots, so the mount entries use the stable by-path or multipath name
+and the items are rewritten by set_block_devices() before each start.
+"""
+
 import os
 
 from oslo.config import cfg
 
+from . import cgroups
+from . import host_utils
 from . import utils as container_utils
 
-from nova.openstack.common import fileutils
+from nova import exception
 from nova.openstack.common.gettextutils import _ # noqa
-from nova.openstack.common import importutils
 from nova.openstack.common import log as logging
-from nova import exception
-from nova import context as nova_context
-from nova import objects
-from nova import utils
 
 LOG = logging.getLogger(__name__)
 
 CONF = cfg.CONF
 
+# flavor extra_specs setting a cgroup item to an integer
+CGROUP_EXTRA_SPECS = {
+    'flex:cpu_quota': 'cpu.cfs_quota_us',
+    'flex:cpu_period': 'cpu.cfs_period_us',
+    'flex:blkio_weight': 'blkio.weight',
+    'flex:pids_max': 'pids.max',
+}
+
+# flavor extra_specs throttling the disk of the instances, as
+# "<value>" or "<major>:<minor> <value>"
+BLKIO_THROTTLE_EXTRA_SPECS = {
+    'flex:blkio_read_bps': 'blkio.throttle.read_bps_device',
+    'flex:blkio_write_bps': 'blkio.throttle.write_bps_device',
+    'flex:blkio_read_iops': 'blkio.throttle.read_iops_device',
+    'flex:blkio_write_iops': 'blkio.throttle.write_iops_device',
+}
+
+# starts the items of the volumes, at the end of the config
+VOLUMES_MARKER = '# volumes'
+
+# (template, lxc type, memory_mb, vcpus, extra_specs) -> compiled config
+_COMPILED = {}
+# (template directory, mtime, template names)
+_TEMPLATES = [None, None, frozenset()]
+
+
+def get_templates():
+    """Return the names of the available LXC templates.
+
+    The listing of CONF.lxc.lxc_template_dir is cached until the mtime
+    of the directory changes.
+    """
+    template_dir = CONF.lxc.lxc_template_dir
+    mtime = os.stat(template_dir).st_mtime
+    if _TEMPLATES[0] != template_dir or _TEMPLATES[1] != mtime:
+        _TEMPLATES[:] = [template_dir, mtime,
+                         frozenset(name.replace('lxc-', '')
+                                   for name in os.listdir(template_dir))]
+    return _TEMPLATES[2]
+
+
+def render_items(items):
+    return ''.join('%s = %s\n' % item for item in items)
+
+
+def render_block_devices(block_devices):
+    return '%s\n%s' % (VOLUMES_MARKER,
+                       render_items(get_block_device_items(block_devices)))
+
+
+def write_config(config_file, data):
+    tmp_file = '%s.tmp' % config_file
+    with open(tmp_file, 'w') as fp:
+        fp.write(data)
+    os.rename(tmp_file, config_file)
+
+
+def set_block_devices(instance, block_devices):
+    """Rewrite the volume items of the config of an instance."""
+    config_file = container_utils.get_container_config(instance)
+    with open(config_file, 'r') as fp:
+        data = fp.read()
+    marker = data.find('\n%s\n' % VOLUMES_MARKER)
+    if marker >= 0:
+        data = data[:marker + 1]
+    write_config(config_file, data + render_block_devices(block_devices))
+
 
 class LXCConfig(object):
-    def __init__(self, container, instance, image_meta, network_info, idmap):
+    def __init__(self, container, instance, image_meta, network_info, idmap,
+                 placement=None, block_devices=None):
         self.container = container
         self.instance = instance
         self.image_meta = image_meta
         self.network_info = network_info
         self.idmap = idmap
+        # (cpus, mems) chosen by numa.NUMAPlacement
+        self.placement = placement
+        # (host device, mountpoint) of the attached volumes
+        self.block_devices = block_devices or []
 
-        self.flavor = objects.Flavor.get_by_id(
-            nova_context.get_admin_context(read_deleted='yes'),
-            instance['instance_type_id'])
+        self.flavor = container_utils.get_flavor(instance)
         self.lxc_type = container_utils.get_lxc_security_info(self.instance)
 
     def get_config(self):
@@ -50,81 +131,153 @@ class LXCConfig(object):
 
         lxc_template = self._get_lxc_template()
         if lxc_template:
-            self._write_lxc_template(lxc_template)
-
+            write_config(container_utils.get_container_config(self.instance),
+                         self._get_compiled(lxc_template) +
+                         render_items(self.get_instance_items()) +
+                         render_block_devices(self.block_devices))
             self.container.load_config()
-            self.config_lxc_name()
-            self.config_lxc_rootfs()
-            self.config_lxc_user()
-            self.config_lxc_logging()
-            self.config_lxc_network()
-            self.config_lxc_console()
-            self.config_lxc_limits()
-            self.container.save_config()
 
     def _get_lxc_template(self):
         LOG.debug('Fetching LXC template')
 
-        templates = []
-        if (self.image_meta and
-            self.image_meta.get('properties', {}).get('template')):
-                lxc_template = self.image_meta['propeties'].get('template')
-        else:
-                lxc_template = CONF.lxc.lxc_default_template
-        path = os.listdir(CONF.lxc.lxc_template_dir)
-        for line in path:
-            templates.append(line.replace('lxc-', ''))
-        if lxc_template in templates:
+        lxc_template = ((self.image_meta or {}).get('properties', {})
+                        .get('template') or CONF.lxc.lxc_default_template)
+        if lxc_template in get_templates():
             return lxc_template
 
-    def _write_lxc_template(self, template_name):
-        config_file = container_utils.get_container_config(self.instance)
-        f = open(config_file, 'w')
-        f.write('lxc.include = %s/%s.common.conf\n' % (CONF.lxc.lxc_config_dir,
-                                                       template_name))
-        f.write('lxc.include = %s/%s.userns.conf\n' % (CONF.lxc.lxc_config_dir,
-                                                       template_name))
-        f.close()
-
-    def config_lxc_name(self):
-        if self.instance:
-            self.container.append_config_item('lxc.utsname',
-                                              self.instance['uuid'])
-
-    def config_lxc_rootfs(self):
+    def _get_compiled(self, template_name):
+        key = (template_name, self.lxc_type, self.flavor.memory_mb,
+               self.instance['vcpus'],
+               tuple(sorted(self.flavor.extra_specs.items())))
+        compiled = _COMPILED.get(key)
+        if compiled is None:
+            compiled = render_items(self.get_template_items(template_name))
+            _COMPILED[key] = compiled
+        return compiled
+
+    def get_template_items(self, template_name):
+        """The configuration items shared by a template and flavor."""
+        items = [('lxc.include', '%s/%s.common.conf' %
+                  (CONF.lxc.lxc_config_dir, template_name)),
+                 ('lxc.include', '%s/%s.userns.conf' %
+                  (CONF.lxc.lxc_config_dir, template_name))]
+        if self.lxc_type == 'unprivileged':
+            items.extend(self.idmap.lxc_conf_lines())
+        items.extend(self.get_limits_items())
+        return items
+
+    def get_instance_items(self):
+        """The configuration items specific to the instance."""
+        items = [('lxc.utsname', self.instance['uuid'])]
         container_rootfs = container_utils.get_container_rootfs(self.instance)
         if os.path.exists(container_rootfs):
-            self.container.append_config_item('lxc.rootfs', container_rootfs)
-
-    def config_lxc_logging(self):
-        self.container.append_config_item('lxc.logfile',
-                        container_utils.get_container_logfile(self.instance))
+            items.append(('lxc.rootfs', container_rootfs))
+        items.append(('lxc.logfile',
+                      container_utils.get_container_logfile(self.instance)))
+        items.extend(self.get_network_items())
+        if self.placement:
+            items.extend([('lxc.cgroup.cpuset.cpus', self.placement[0]),
+                          ('lxc.cgroup.cpuset.mems', self.placement[1])])
+        items.append(('lxc.console.logfile',
+                      container_utils.get_container_console(self.instance)))
+        return items
 
-    def config_lxc_network(self):
-        for vif in self.network_info:
-            vif_id = vif['id'][:11]
-            vif_type = vif['type']
+    def get_network_items(self):
+        items = []
+        for vif in self.network_info or []:
             bridge = vif['network']['bridge']
-            mac = vif['address']
+            if vif['type'] == 'ovs':
+                bridge = 'qbr%s' % vif['id'][:11]
+            items.extend([('lxc.network.type', 'veth'),
+                          ('lxc.network.hwaddr', vif['address']),
+                          ('lxc.network.link', bridge)])
+        return items
 
-        if vif_type == 'ovs':
-            bridge = 'qbr%s' % vif_id
+    def get_limits_items(self):
+        items = [('lxc.cgroup.memory.limit_in_bytes',
+                  '%sM' % self.flavor.memory_mb),
+                 ('lxc.cgroup.cpu.shares',
+                  '%s' % container_utils.get_container_cores(self.instance))]
+        items.extend(get_extra_spec_items(self.flavor.extra_specs))
+        return items
 
-        self.container.append_config_item('lxc.network.type', 'veth')
-        self.container.append_config_item('lxc.network.hwaddr', mac)
-        self.container.append_config_item('lxc.network.link', bridge)
 
-    def config_lxc_console(self):
-        self.container.append_config_item('lxc.console.logfile',
-                    container_utils.get_container_console(self.instance))
+def get_block_device_items(block_devices):
+    """Allow and create the device nodes of volumes in the container.
 
-    def config_lxc_limits(self):
-        self.container.append_config_item('lxc.cgroup.memory.limit_in_bytes','%sM' % self.flavor.memory_mb)
-        self.container.append_config_item('lxc.cgroup.cpu.shares', '%s'
-                                           % container_utils.get_container_cores(self.instance))
-        #self.container.append_config_item('lxc.cgroup.lxc.cgroup.cpuset.cpubind', '100')
+    host_device is the stable name of the device, the by-path or
+    multipath link. It is resolved to its current number for the
+    devices cgroup.
+    """
+    items = []
+    for host_device, mountpoint in block_devices:
+        rdev = os.stat(host_device).st_rdev
+        items.extend([('lxc.cgroup.devices.allow', 'b %d:%d rwm' %
+                       (os.major(rdev), os.minor(rdev))),
+                      ('lxc.mount.entry', '%s %s none bind,create=file 0 0' %
+                       (host_device, mountpoint.lstrip('/')))])
+    return items
 
-    def config_lxc_user(self):
-        if self.lxc_type == 'unprivileged':
-            for ent in self.idmap.lxc_conf_lines():
-                self.container.append_config_item(*ent)
+
+def _get_int_spec(extra_specs, key):
+    try:
+        return int(extra_specs[key])
+    except ValueError:
+        raise exception.InvalidInput(
+            reason=_('%(key)s must be an integer, not %(value)s') %
+            {'key': key, 'value': extra_specs[key]})
+
+
+def get_extra_spec_items(extra_specs):
+    """Map the flex: cgroup extra_specs of a flavor to config items.
+
+    flex:cpuset and flex:cpuset_mems pin the container to cpus and
+    memory nodes, flex:memsw_limit_mb limits memory plus swap and the
+    keys of CGROUP_EXTRA_SPECS and BLKIO_THROTTLE_EXTRA_SPECS set the
+    corresponding cgroup items.
+    """
+    items = []
+    for key, item in (('flex:cpuset', 'cpuset.cpus'),
+                      ('flex:cpuset_mems', 'cpuset.mems')):
+        if key in extra_specs:
+            try:
+                cgroups.parse_cpuset(extra_specs[key])
+            except ValueError:
+                raise exception.InvalidInput(
+                    reason=_('%(key)s is not a cpu list: %(value)s') %
+                    {'key': key, 'value': extra_specs[key]})
+            items.append(('lxc.cgroup.%s' % item, extra_specs[key]))
+
+    if 'flex:memsw_limit_mb' in extra_specs:
+        items.append(('lxc.cgroup.memory.memsw.limit_in_bytes',
+                      '%sM' % _get_int_spec(extra_specs,
+                                            'flex:memsw_limit_mb')))
+
+    for key, item in sorted(CGROUP_EXTRA_SPECS.items()):
+        if key in extra_specs:
+            items.append(('lxc.cgroup.%s' % item,
+                          '%d' % _get_int_spec(extra_specs, key)))
+
+    for key, item in sorted(BLKIO_THROTTLE_EXTRA_SPECS.items()):
+        if key not in extra_specs:
+            continue
+        value = extra_specs[key].split()
+        if len(value) == 1:
+            device = host_utils.get_block_device(CONF.instances_path)
+            if device is None:
+                LOG.warn(_('No disk found for %(path)s, ignoring '
+                           '%(key)s'),
+                         {'path': CONF.instances_path, 'key': key})
+                continue
+            value.insert(0, device)
+        try:
+            device, rate = value[0], int(value[1])
+            if len(value) != 2:
+                raise ValueError()
+        except (IndexError, ValueError):
+            raise exception.InvalidInput(
+                reason=_('%(key)s must be "[<major>:<minor> ]<value>", '
+                         'not %(value)s') %
+                {'key': key, 'value': extra_specs[key]})
+        items.append(('lxc.cgroup.%s' % item, '%s %d' % (device, rate)))
+    return items
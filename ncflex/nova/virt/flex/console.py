@@ -0,0 +1,136 @@
+# Copyright (c) 2014 Canonical Ltd
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Bounded console logs of containers.
+
+liblxc appends the console of a container to container.console. Once
+the file is larger than a segment it is copied to container.console.1,
+the older segments are shifted up to console_log_segments and the live
+file is truncated, so that the console of an instance never takes more
+than about console_log_max_bytes on disk. liblxc opens the file in
+append mode, so it keeps writing at the start of the truncated file.
+Output written between the copy and the truncation is lost.
+"""
+
+import os
+import shutil
+
+import lxc
+from oslo.config import cfg
+from oslo.utils import units
+
+from nova.openstack.common.gettextutils import _  # noqa
+from nova.openstack.common import log as logging
+from nova import utils
+
+console_opts = [
+    cfg.IntOpt('console_log_max_bytes',
+               default=2 * units.Mi,
+               help='Disk space the console log of a container may use, '
+                    'split between the live log and its rotated segments. '
+                    '0 lets the log grow without limit.'),
+    cfg.IntOpt('console_log_segments',
+               default=3,
+               help='Number of rotated console log segments kept per '
+                    'container'),
+    cfg.IntOpt('console_rotate_interval',
+               default=10,
+               help='Number of seconds between checks of the size of the '
+                    'console logs'),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(console_opts, 'lxc')
+
+LOG = logging.getLogger(__name__)
+
+
+def get_segment_size():
+    return CONF.lxc.console_log_max_bytes // (CONF.lxc.console_log_segments
+                                               + 1)
+
+
+def get_segments(console_log):
+    """Return the paths of the segments of a console log, newest first."""
+    return ['%s.%d' % (console_log, i)
+            for i in range(1, CONF.lxc.console_log_segments + 1)]
+
+
+def rotate(console_log, segment_size=None):
+    """Rotate a console log larger than segment_size.
+
+    Returns True if the log was rotated.
+    """
+    if segment_size is None:
+        segment_size = get_segment_size()
+    try:
+        if os.path.getsize(console_log) < segment_size:
+            return False
+    except OSError:
+        return False
+
+    segments = get_segments(console_log)
+    if segments:
+        for older, newer in reversed(list(zip(segments[1:], segments[:-1]))):
+            if os.path.exists(newer):
+                os.rename(newer, older)
+        with open(console_log, 'rb') as src:
+            with open(segments[0], 'wb') as dst:
+                shutil.copyfileobj(src, dst)
+    # truncate through a new descriptor, liblxc keeps appending to its own
+    with open(console_log, 'r+b') as fp:
+        fp.truncate(0)
+    return True
+
+
+def read_tail(console_log, max_bytes):
+    """Return the last max_bytes of a console log and its segments.
+
+    Only the tail of each file is read, so the cost does not depend on
+    the size of the log. Returns the data and the number of older bytes
+    left out.
+    """
+    chunks = []
+    remaining = 0
+    wanted = max_bytes
+    for path in [console_log] + get_segments(console_log):
+        if not os.path.exists(path):
+            # the segments are created in order
+            break
+        if wanted <= 0:
+            remaining += os.path.getsize(path)
+            continue
+        with open(path, 'rb') as fp:
+            data, left = utils.last_bytes(fp, wanted)
+        chunks.append(data)
+        remaining += left
+        wanted -= len(data)
+    return b''.join(reversed(chunks)), remaining
+
+
+def rotate_all():
+    """Rotate the console logs of the running containers."""
+    if not CONF.lxc.console_log_max_bytes:
+        return
+    segment_size = get_segment_size()
+    for name in lxc.list_containers(active=True, defined=False,
+                                    config_path=CONF.instances_path):
+        console_log = os.path.join(CONF.instances_path, name,
+                                   'container.console')
+        try:
+            if rotate(console_log, segment_size):
+                LOG.debug('Rotated console log of %s', name)
+        except (IOError, OSError):
+            LOG.exception(_('Failed to rotate the console log of %s'), name)
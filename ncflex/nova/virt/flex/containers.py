@@ -12,30 +12,41 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import functools
+import inspect
 import os
 import pwd
+import time
 import uuid
 
 import eventlet
+from eventlet import tpool
 import lxc
 
 from oslo.config import cfg
 from oslo.utils import units
 
+from . import cgroups
 from . import config
+from . import console
 from . import images
+from . import numa
+from . import privhelper
+from . import snapshots
 from . import utils as container_utils
 from . import volumes
 
 from nova import exception
 from nova.compute import power_state
+from nova.openstack.common import excutils
 from nova.openstack.common.gettextutils import _  # noqa
 from nova.openstack.common import importutils
 from nova.openstack.common import log as logging
-from nova import context as nova_context
+from nova.openstack.common import loopingcall
+from nova.openstack.common import processutils
 from nova import exception
-from nova import objects
 from nova import utils
+from nova.virt import driver
 
 MAX_CONSOLE_BYTES = 100 * units.Ki
 
@@ -54,9 +65,66 @@ lxc_opts = [
                help='Default vif driver'),
     cfg.IntOpt('num_iscsi_scan_tries',
                default=5,
-               help='Number of times to rescan iSCSI target to find volume'),
+               help='Deprecated, iSCSI volumes are now waited for up to '
+                    'iscsi_device_timeout seconds'),
+    cfg.IntOpt('container_info_ttl',
+               default=30,
+               help='Number of seconds the host wide snapshot of container '
+                    'state and usage is used to answer get_info before it '
+                    'is rebuilt'),
+    cfg.IntOpt('bulk_power_concurrency',
+               default=16,
+               help='Number of containers started or stopped in parallel '
+                    'by host wide power operations'),
+    cfg.StrOpt('suspend_memory_reclaim',
+               default='none',
+               help='How the memory of suspended containers is given back '
+                    'to the host: none, soft_limit (drop the memory soft '
+                    'limit so the kernel reclaims the frozen container '
+                    'first, swapping it out under pressure) or force_empty '
+                    '(reclaim as much as possible right away). The kernel '
+                    'can only empty a frozen cgroup by swapping it out, '
+                    'without enough swap force_empty fails with EBUSY and '
+                    'the container is suspended as with none.'),
+    cfg.BoolOpt('suspend_to_disk',
+                default=False,
+                help='Suspend containers by checkpointing them to disk '
+                     'with CRIU instead of freezing them, so that they '
+                     'use no memory until they are restored'),
+    cfg.IntOpt('container_state_timeout',
+               default=30,
+               help='Number of seconds to wait for a container to reach '
+                    'the state requested by a lifecycle operation'),
 ]
 
+LXC_POWER_STATE = {
+    'RUNNING': power_state.RUNNING,
+    'FROZEN': power_state.PAUSED,
+    'FREEZING': power_state.PAUSED,
+}
+
+# lxc-* commands matching the lxc.Container methods, used for privileged
+# containers when the privileged helper is disabled.
+LXC_COMMANDS = {
+    'start': ['lxc-start', '-d'],
+    'stop': ['lxc-stop', '-k'],
+    'shutdown': ['lxc-stop', '--nokill', '-t', '%s'],
+    'reboot': ['lxc-stop', '-r'],
+    'freeze': ['lxc-freeze'],
+    'unfreeze': ['lxc-unfreeze'],
+    'destroy': ['lxc-destroy', '-f'],
+    'wait': ['lxc-wait', '-s', '%s', '-t', '%s'],
+    'set_cgroup_item': ['lxc-cgroup', '%s', '%s'],
+    'checkpoint': ['lxc-checkpoint', '-s', '-D', '%s'],
+    'restore': ['lxc-checkpoint', '-r', '-d', '-D', '%s'],
+}
+
+# lxc.Container methods that return False when their timeout expires
+TIMED_OPS = ('shutdown', 'wait')
+
+# seconds between checks of the init pid of a rebooting container
+REBOOT_POLL_INTERVAL = 1
+
 LOG = logging.getLogger(__name__)
 
 CONF = cfg.CONF
@@ -65,9 +133,23 @@ CONF.import_opt('vif_plugging_is_fatal', 'nova.virt.driver')
 CONF.register_opts(lxc_opts, 'lxc')
 
 
+def invalidates_info(function):
+    """Drop the cached info of the instance a lifecycle method acts on."""
+    @functools.wraps(function)
+    def decorated(self, *args, **kwargs):
+        instance = inspect.getcallargs(function, self, *args,
+                                       **kwargs)['instance']
+        self._invalidate_container_info(instance)
+        try:
+            return function(self, *args, **kwargs)
+        finally:
+            self._invalidate_container_info(instance)
+    return decorated
+
+
 class Containers(object):
     def __init__(self, virtapi):
-	self.virtapi = virtapi
+        self.virtapi = virtapi
         self.instance_path = None
         self.container_rootfs = None
 
@@ -76,25 +158,41 @@ class Containers(object):
         self.volumes = volumes.VolumeOps()
         self.idmap = container_utils.LXCUserIdMap()
 
+        self._info_snapshot = {}
+        self._info_timestamp = 0
+        self.cpu_sampler = cgroups.CPUSampler()
+        self.numa = numa.NUMAPlacement()
+        self._console_rotator = None
+
     def init_container(self):
         if not lxc.version:
             raise Exception('LXC is not installed')
 
-	    # set up cgroups
+        # set up cgroups
         lxc_cgroup = uuid.uuid4()
-        utils.execute('cgm', 'create', 'all', lxc_cgroup,
-                      run_as_root=True)
-        utils.execute('cgm', 'chown', 'all', lxc_cgroup,
-                      pwd.getpwuid(os.getuid()).pw_uid,
-                      pwd.getpwuid(os.getuid()).pw_gid,
-                      run_as_root=True)
-        utils.execute('cgm', 'movepid', 'all', lxc_cgroup, os.getpid())
-
-    	# setup network namespaces
+        container_utils.execute('cgm', 'create', 'all', lxc_cgroup,
+                                run_as_root=True)
+        container_utils.execute('cgm', 'chown', 'all', lxc_cgroup,
+                                pwd.getpwuid(os.getuid()).pw_uid,
+                                pwd.getpwuid(os.getuid()).pw_gid,
+                                run_as_root=True)
+        container_utils.execute('cgm', 'movepid', 'all', lxc_cgroup,
+                                os.getpid())
+
+        # setup network namespaces
         if not os.path.exists('/var/run/netnss'):
-            utils.execute('mkdir', '-p', '/var/run/netns',
-                          run_as_root=True)
-
+            container_utils.execute('mkdir', '-p', '/var/run/netns',
+                                    run_as_root=True)
+
+        # keep the console logs bounded
+        if (CONF.lxc.console_log_max_bytes and
+                CONF.lxc.console_rotate_interval > 0):
+            self._console_rotator = loopingcall.FixedIntervalLoopingCall(
+                console.rotate_all)
+            self._console_rotator.start(
+                interval=CONF.lxc.console_rotate_interval)
+
+    @invalidates_info
     def spawn(self, context, instance, image_meta, injected_files,
               admin_password, network_info, block_device_info=None):
         LOG.debug('Spawning containers')
@@ -111,9 +209,7 @@ class Containers(object):
 
         # Grab the flavor information to determine
         # what kind of conatiner we are running
-        flavor = objects.Flavor.get_by_id(
-            nova_context.get_admin_context(read_deleted='yes'),
-            instance['instance_type_id'])
+        flavor = container_utils.get_flavor(instance)
 
         lxc_type = container_utils.get_lxc_security_info(instance)
 
@@ -121,49 +217,90 @@ class Containers(object):
         images.create_container(context, instance, image_meta,
                                container_image, self.idmap, flavor)
 
-        # Write the LXC confgiuration file
-        cfg = config.LXCConfig(container, instance, image_meta, network_info,
-                               self.idmap)
-
-
-        timeout = CONF.vif_plugging_timeout
-        # check to see if neturon is ready before
-        # doing anything else
-        if (not container.running and
-             utils.is_neutron() and timeout):
-             events = self._get_neutron_events(network_info)
-        else:
-            evevnts = {}
-
+        # Connect the volumes to boot with before the config is written
+        block_devices = self._connect_block_devices(instance, lxc_type,
+                                                    block_device_info)
         try:
-            with self.virtapi.wait_for_instance_event(
-                instance, events, deadline=timeout,
-                error_callback=self._neutron_failed_callback):
-                    cfg.get_config()
-                    self.start_network(instance, network_info)
-        except exception.VirtualInterfaceCreateException:
-            self.destroy_container(context, instance, network_info,
-                                   block_device_info, destroy_disks)
-
-        # Startint the container
-        if not container.running:
-            if lxc_type == 'unprivileged':
-                LOG.info(_('Starting unprivileged container'))
-                if container.start():
-                    LOG.info(_('Container started'))
-            elif lxc_type == 'privileged':
-                try:
-                    LOG.info(_('Starting privileged container'))
-                    utils.execute('lxc-start', '-n', instance['uuid'], '-d',
-                                  '-P', CONF.instances_path,
-                                  run_as_root=True)
-                    if container.start():
-                        LOG.info(_('Container started'))
-                except OSError as exc:
-                    LOG.warn(_("Container failed to start"))
-
+            # Write the LXC confgiuration file
+            cfg = config.LXCConfig(container, instance, image_meta,
+                                   network_info, self.idmap,
+                                   self.numa.place(instance, flavor),
+                                   block_devices)
+
+            timeout = CONF.vif_plugging_timeout
+            # check to see if neturon is ready before
+            # doing anything else
+            if (not container.running and
+                 utils.is_neutron() and timeout):
+                 events = self._get_neutron_events(network_info)
+            else:
+                events = {}
+
+            try:
+                with self.virtapi.wait_for_instance_event(
+                    instance, events, deadline=timeout,
+                    error_callback=self._neutron_failed_callback):
+                        cfg.get_config()
+                        self.start_network(instance, network_info)
+            except exception.VirtualInterfaceCreateException:
+                self.destroy_container(context, instance, network_info,
+                                       block_device_info, destroy_disks)
+
+            # Startint the container
+            if not container.running:
+                LOG.info(_('Starting %s container'), lxc_type)
+                if not self._start(container, lxc_type):
+                    raise exception.InstanceDeployFailure(
+                        reason=_('container did not reach the RUNNING '
+                                 'state'))
+                LOG.info(_('Container started'))
+        except Exception:
+            with excutils.save_and_reraise_exception():
+                self._disconnect_block_devices(instance, block_device_info)
+
+    def _connect_block_devices(self, instance, lxc_type, block_device_info):
+        """Connect the volumes of block_device_info all at once.
+
+        Returns the (host device, mountpoint) of each volume.
+        """
+        mappings = driver.block_device_info_get_mapping(block_device_info)
+        if not mappings:
+            return []
+        if lxc_type == 'unprivileged':
+            raise exception.NovaException(
+                _('Volumes are not supported by Unprivileged containers.'))
+        try:
+            host_devices = self.volumes.connect_volumes(
+                [bdm['connection_info'] for bdm in mappings], instance)
+        except Exception:
+            with excutils.save_and_reraise_exception():
+                self._disconnect_block_devices(instance, block_device_info)
+        return [(host_device, bdm['mount_device'])
+                for host_device, bdm in zip(host_devices, mappings)]
+
+    def _disconnect_block_devices(self, instance, block_device_info):
+        """Disconnect the volumes of block_device_info, as far as possible."""
+        for bdm in driver.block_device_info_get_mapping(block_device_info):
+            try:
+                self.volumes.disconnect_volume(bdm['connection_info'],
+                                               instance, bdm['mount_device'])
+            except Exception:
+                LOG.exception(_('Failed to disconnect volume %s'),
+                              bdm['mount_device'], instance=instance)
+
+    def _refresh_block_devices(self, instance, lxc_type, block_device_info):
+        """Connect the volumes and update their devices in the config."""
+        if block_device_info is None:
+            return
+        config.set_block_devices(
+            instance, self._connect_block_devices(instance, lxc_type,
+                                                  block_device_info))
 
     def start_network(self, instance, network_info):
+        if hasattr(self.vif_driver, 'plug_vifs'):
+            self.vif_driver.plug_vifs(instance, network_info)
+            return
+
         for vif in network_info:
             self.vif_driver.plug(instance, vif)
 
@@ -172,98 +309,366 @@ class Containers(object):
         for vif in network_info:
             self.vif_driver.unplug(instance, vif)
 
+    @invalidates_info
     def destroy_container(self, context, instance, network_info,
                           block_device_info, destroy_disks):
         LOG.debug('Destroying container')
         (container, lxc_type) = self.get_container_root(instance)
+        self.numa.release(instance)
 
         self.teardown_network(instance, network_info)
+        snapshots.delete_snapshots(instance)
         if lxc_type == 'unprivileged':
             if container.running:
                 container.stop()
             if container.defined:
                 # work around for segfaulting api call
-                utils.execute('lxc-destroy', '-n', instance['uuid'],
-                              '-P', CONF.instances_path)
+                container_utils.execute('lxc-destroy', '-n', instance['uuid'],
+                                        '-P', CONF.instances_path)
         elif lxc_type == 'privileged':
-                utils.execute('lxc-destroy', '-f', '-n', instance['uuid'],
-                              '-P', CONF.instances_path,
-                              run_as_root=True)
-                
+            self._container_op(container, lxc_type, 'destroy')
+        self._disconnect_block_devices(instance, block_device_info)
 
+    @invalidates_info
     def reboot_container(self, context, instance, network_info, reboot_type,
                          block_device_info, bad_volumes_callback):
         LOG.debug('Rebooting container')
         (container, lxc_type) = self.get_container_root(instance)
-        if lxc_type == 'unprivileged':
-            if container.running:
-                if container.reboot():
-                    LOG.info(_('Container rebooted'))
-        elif lxc_type == 'privileged':
-            utils.execute('lxc-stop', '-n', instance['uuid'],
-                          '-r', '-P', CONF.instances_path,
-                          run_as_root=True)
-            
+        if lxc_type == 'unprivileged' and not container.running:
+            return
 
-    def stop_container(self, instance):
+        if reboot_type == 'HARD':
+            self._stop(instance, container, lxc_type)
+            self._refresh_block_devices(instance, lxc_type, block_device_info)
+            started = self._start(container, lxc_type)
+        else:
+            started = self._soft_reboot(container, lxc_type)
+        if not started:
+            raise exception.InstanceRebootFailure(
+                reason=_('container is not running after the reboot'))
+        LOG.info(_('Container rebooted'), instance=instance)
+
+    @invalidates_info
+    def stop_container(self, instance, timeout=0, retry_interval=0):
+        """Stop a container, cleanly first if timeout is given.
+
+        The container is asked to shut down every retry_interval seconds
+        until timeout seconds have passed, then it is killed. Returns once
+        the container is stopped.
+        """
         LOG.debug('Stopping container')
         (container, lxc_type) = self.get_container_root(instance)
-        if lxc_type == 'unprivileged':
-            if container.running:
-                if container.stop():
-                    LOG.info(_('Container stopped'))
-        elif lxc_type == 'privileged':
-            utils.execute('lxc-stop', '-n', instance['uuid'],
-                          '-P', CONF.instances_path,
-                          run_as_root=True)
+        if lxc_type == 'unprivileged' and not container.running:
+            return
 
+        if timeout and self._shutdown(container, lxc_type, timeout,
+                                      retry_interval):
+            LOG.info(_('Container shut down cleanly'), instance=instance)
+            return
+        self._stop(instance, container, lxc_type)
+        LOG.info(_('Container stopped'), instance=instance)
 
+    @invalidates_info
     def start_container(self, context, instance, network_info,
                         block_device_info):
         LOG.debug('Starting container')
         (container, lxc_type) = self.get_container_root(instance)
-        if lxc_type == 'unprivileged':
-            if container.start():
-                LOG.info(_('Container started'))
-        elif lxc_type == 'privileged':
-            utils.execute('lxc-start', '-n', instance['uuid'],
-                          '-P', CONF.instances_path,
-                          run_as_root=True)
-
-    def suspend_container(self, instance):
+        if network_info:
+            # the bridges do not survive a host reboot
+            self.start_network(instance, network_info)
+        self._refresh_block_devices(instance, lxc_type, block_device_info)
+        if not self._start(container, lxc_type):
+            raise exception.InstancePowerOnFailure(
+                reason=_('container did not reach the RUNNING state'))
+        LOG.info(_('Container started'), instance=instance)
+
+    def start_containers(self, context, instances, network_info=None,
+                         concurrency=None, block_device_info=None):
+        """Start many containers, highest flex:boot_priority first.
+
+        network_info and block_device_info optionally map instance uuids
+        to their network and block device info. Returns a dict of
+        instance uuid to None on success or the error message.
+        """
+        network_info = network_info or {}
+        block_device_info = block_device_info or {}
+
+        def _start(instance):
+            self.start_container(context, instance,
+                                 network_info.get(instance['uuid']),
+                                 block_device_info.get(instance['uuid']))
+
+        return self._bulk_power(instances, _start, concurrency,
+                                highest_first=True)
+
+    def stop_containers(self, instances, timeout=0, retry_interval=0,
+                        concurrency=None):
+        """Stop many containers, lowest flex:boot_priority first.
+
+        timeout and retry_interval are those of stop_container. Returns
+        a dict of instance uuid to None on success or the error message.
+        """
+        def _stop(instance):
+            self.stop_container(instance, timeout, retry_interval)
+
+        return self._bulk_power(instances, _stop, concurrency,
+                                highest_first=False)
+
+    def _bulk_power(self, instances, function, concurrency, highest_first):
+        """Apply function to instances, one boot priority at a time.
+
+        The containers sharing a priority run in parallel on up to
+        concurrency green threads; the next priority starts once they
+        are all done.
+        """
+        if concurrency is None:
+            concurrency = CONF.lxc.bulk_power_concurrency
+        pool = eventlet.GreenPool(max(concurrency, 1))
+
+        by_priority = {}
+        for instance in instances:
+            by_priority.setdefault(container_utils.get_boot_priority(instance),
+                                   []).append(instance)
+
+        def _apply(instance):
+            try:
+                function(instance)
+            except Exception as ex:
+                LOG.exception(_('Power operation failed'), instance=instance)
+                return (instance['uuid'], str(ex))
+            return (instance['uuid'], None)
+
+        results = {}
+        for priority in sorted(by_priority, reverse=highest_first):
+            results.update(pool.imap(_apply, by_priority[priority]))
+        return results
+
+    @invalidates_info
+    def suspend_container(self, instance, reclaim=True):
+        """Freeze a container, then reclaim its memory if configured.
+
+        See CONF.lxc.suspend_memory_reclaim; pause uses reclaim=False.
+        """
         LOG.debug('Suspend container')
         (container, lxc_type) = self.get_container_root(instance)
-        if lxc_type == 'unprivileged':
-            if container.defined and container.controllable:
-                container.freeze()
-        elif lxc_type == 'privileged':
-            utils.execute('lxc-freeze', '-n', instance['uuid'],
-                          '-P', CONF.instances_path,
-                          run_as_root=True)
-
+        if reclaim and CONF.lxc.suspend_to_disk:
+            self.checkpoint_container(instance)
+            return
+        if lxc_type == 'privileged' or (container.defined and
+                                        container.controllable):
+            self._container_op(container, lxc_type, 'freeze')
+            if reclaim:
+                self._reclaim_memory(instance, container, lxc_type)
+
+    @invalidates_info
     def resume_container(self, context, instance, network_info,
                          block_device_info):
-        LOG.debug('Suspend container')
+        LOG.debug('Resume container')
+        (container, lxc_type) = self.get_container_root(instance)
+        if os.path.isdir(container_utils.get_container_checkpoint(instance)):
+            self.restore_container(instance)
+            return
+        if lxc_type == 'privileged' or (container.defined and
+                                        container.controllable):
+            self._restore_soft_limit(instance, container, lxc_type)
+            self._container_op(container, lxc_type, 'unfreeze')
+
+    def _reclaim_memory(self, instance, container, lxc_type):
+        """Give back the memory of a frozen container.
+
+        The soft limit in place is saved next to the container config
+        and put back by _restore_soft_limit on resume. force_empty is
+        refused by the kernel with EBUSY when the frozen tasks cannot be
+        swapped out; the container then stays suspended, just not any
+        smaller.
+        """
+        mode = CONF.lxc.suspend_memory_reclaim
+        if mode == 'soft_limit':
+            item, value = 'memory.soft_limit_in_bytes', '0'
+            path = cgroups.find_container_cgroups([instance['uuid']]).get(
+                instance['uuid'])
+            soft_limit = None
+            if path is not None:
+                soft_limit = cgroups.read_cgroup_item('memory', path, item)
+            if soft_limit is None:
+                LOG.warn(_('Failed to read the memory soft limit of the '
+                           'suspended container'), instance=instance)
+                return
+            with open(container_utils.get_container_soft_limit(instance),
+                      'w') as fp:
+                fp.write(soft_limit)
+        elif mode == 'force_empty':
+            item, value = 'memory.force_empty', '0'
+        else:
+            return
+
+        try:
+            reclaimed = self._container_op(container, lxc_type,
+                                           'set_cgroup_item', item, value)
+        except (processutils.ProcessExecutionError,
+                privhelper.PrivHelperError):
+            reclaimed = False
+        if reclaimed is False:
+            LOG.warn(_('Failed to reclaim the memory of the suspended '
+                       'container with %s'), mode, instance=instance)
+
+    def _restore_soft_limit(self, instance, container, lxc_type):
+        """Put back the soft limit saved by _reclaim_memory, if any."""
+        saved = container_utils.get_container_soft_limit(instance)
+        if not os.path.exists(saved):
+            return
+        with open(saved, 'r') as fp:
+            soft_limit = fp.read().strip()
+        self._container_op(container, lxc_type, 'set_cgroup_item',
+                           'memory.soft_limit_in_bytes', soft_limit)
+        os.unlink(saved)
+
+    @invalidates_info
+    def checkpoint_container(self, instance):
+        """Dump a running container to disk with CRIU and stop it."""
         (container, lxc_type) = self.get_container_root(instance)
+        directory = container_utils.get_container_checkpoint(instance)
+        # CRIU needs root, whatever the type of the container
+        if not self._container_op(container, 'privileged', 'checkpoint',
+                                  directory, True):
+            raise exception.NovaException(
+                _('Failed to checkpoint container %s') % instance['uuid'])
+        LOG.info(_('Container checkpointed'), instance=instance)
+
+    @invalidates_info
+    def restore_container(self, instance):
+        """Restore a container from its checkpoint and drop the dump."""
+        (container, lxc_type) = self.get_container_root(instance)
+        directory = container_utils.get_container_checkpoint(instance)
+        if not self._container_op(container, 'privileged', 'restore',
+                                  directory):
+            raise exception.NovaException(
+                _('Failed to restore container %s') % instance['uuid'])
+        container_utils.execute('rm', '-rf', directory, run_as_root=True)
+        LOG.info(_('Container restored'), instance=instance)
+
+    def snapshot_container(self, context, instance, image_id,
+                           update_task_state):
+        LOG.debug('Snapshotting container')
+        snapshots.snapshot_container(context, instance, image_id,
+                                     update_task_state, self.idmap)
+
+    def _container_op(self, container, lxc_type, op, *args):
+        """Call a lxc.Container method, with root for privileged containers.
+
+        Privileged containers are driven through the same API inside the
+        privileged helper, or with the matching lxc-* command through
+        rootwrap when the helper is disabled.
+        """
         if lxc_type == 'unprivileged':
-            if container.defined and container.controllable:
-                container.unfreeze()
-        elif lxc_type == 'privileged':
-            utils.execute('lxc-unfreeze', '-n', instance['uuid'],
-                          '-P', CONF.instances_path,
-                          run_as_root=True)
+            if op in TIMED_OPS or op in ('stop', 'set_cgroup_item'):
+                # liblxc blocks the calling thread, keep the hub running
+                return tpool.execute(getattr(container, op), *args)
+            return getattr(container, op)(*args)
+        if CONF.lxc.use_priv_helper:
+            return privhelper.get_client().call(
+                'container_op', name=container.name,
+                config_path=CONF.instances_path, op=op, args=list(args))
+
+        args = list(args)
+        cmd = [arg % args.pop(0) if arg == '%s' else arg
+               for arg in LXC_COMMANDS[op]]
+        check_exit_code = [0]
+        if op in ('stop', 'shutdown'):
+            # lxc-stop exits with 2 when the container is not running
+            check_exit_code.append(2)
+        try:
+            container_utils.execute(cmd[0], '-n', container.name,
+                                    '-P', CONF.instances_path, *cmd[1:],
+                                    run_as_root=True,
+                                    check_exit_code=check_exit_code)
+        except processutils.ProcessExecutionError:
+            if op in TIMED_OPS:
+                return False
+            raise
+        return True
+
+    def _get_init_pid(self, container, lxc_type):
+        """Return the pid of the init of a container, -1 if stopped."""
+        if lxc_type == 'unprivileged':
+            return container.init_pid
+        if CONF.lxc.use_priv_helper:
+            return privhelper.get_client().call(
+                'container_op', name=container.name,
+                config_path=CONF.instances_path, op='init_pid')
+        out = container_utils.execute('lxc-info', '-n', container.name,
+                                      '-P', CONF.instances_path, '-p', '-H',
+                                      run_as_root=True,
+                                      check_exit_code=[0, 1])[0]
+        try:
+            return int(out.strip())
+        except ValueError:
+            return -1
+
+    def _start(self, container, lxc_type):
+        """Start a container and wait for it to be running.
+
+        A container that is already running counts as started.
+        """
+        if self._get_init_pid(container, lxc_type) > 0:
+            return True
+        if not self._container_op(container, lxc_type, 'start'):
+            return False
+        return self._container_op(container, lxc_type, 'wait', 'RUNNING',
+                                  CONF.lxc.container_state_timeout)
+
+    def _soft_reboot(self, container, lxc_type):
+        """Reboot a container from the inside and wait for its new init.
+
+        reboot() only signals init and the container stays RUNNING while
+        it shuts down, so the reboot is over once another init pid shows
+        up.
+        """
+        old_pid = self._get_init_pid(container, lxc_type)
+        if not self._container_op(container, lxc_type, 'reboot'):
+            return False
+        deadline = time.time() + CONF.lxc.container_state_timeout
+        while time.time() < deadline:
+            pid = self._get_init_pid(container, lxc_type)
+            if pid > 0 and pid != old_pid:
+                return self._container_op(
+                    container, lxc_type, 'wait', 'RUNNING',
+                    max(int(deadline - time.time()), 1))
+            eventlet.sleep(REBOOT_POLL_INTERVAL)
+        return False
+
+    def _shutdown(self, container, lxc_type, timeout, retry_interval):
+        """Request clean shutdowns until the container stops or timeout."""
+        deadline = time.time() + timeout
+        retry_interval = retry_interval or timeout
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            if self._container_op(container, lxc_type, 'shutdown',
+                                  max(int(min(retry_interval, remaining)),
+                                      1)):
+                return True
+
+    def _stop(self, instance, container, lxc_type):
+        """Kill a container and wait for it to be stopped."""
+        self._container_op(container, lxc_type, 'stop')
+        if not self._container_op(container, lxc_type, 'wait', 'STOPPED',
+                                  CONF.lxc.container_state_timeout):
+            raise exception.InstancePowerOffFailure(
+                reason=_('container did not reach the STOPPED state'))
 
     def get_container_console(self, instance):
         LOG.debug('Container console log')
 
         console_log = container_utils.get_container_console(instance)
-        with open(console_log, 'rb') as fp:
-            log_data, remaining = utils.last_bytes(fp, MAX_CONSOLE_BYTES)
-            if remaining > 0:
-                LOG.info(_('Truncated console log returned, '
-                           '%d bytes ignored'),
-                           remaining, instance=instance)
-            return log_data
+        log_data, remaining = console.read_tail(console_log,
+                                                MAX_CONSOLE_BYTES)
+        if remaining > 0:
+            LOG.info(_('Truncated console log returned, '
+                       '%d bytes ignored'),
+                     remaining, instance=instance)
+        return log_data
 
     def attach_container_volume(self, context, connection_info, instance,
                                 mountpoint, disk_bus=None, device_type=None,
@@ -276,9 +681,9 @@ class Containers(object):
             host_device = self.volumes.connect_volume(connection_info, instance,
                                                       mountpoint)
             if host_device:
-                utils.execute('lxc-device', '-P', CONF.instances_path,
-                              '-n', instance['uuid'], 'add', host_device,
-                               mount_point, run_as_root=True)
+                container_utils.execute('lxc-device', '-P', CONF.instances_path,
+                                        '-n', instance['uuid'], 'add', host_device,
+                                        mountpoint, run_as_root=True)
 
     def detach_container_volume(self, connection_info, instance, mountpoint,
                                 encryption):
@@ -303,23 +708,133 @@ class Containers(object):
             return False
 
     def get_container_info(self, instance):
-        (container,lxc_type) = self.get_container_root(instance)
+        """Return the state and usage of a container.
+
+        Answered from the host wide snapshot built by get_containers_info,
+        which is rebuilt once it is older than CONF.lxc.container_info_ttl.
+        Containers missing from the snapshot (just spawned, or changed by
+        a lifecycle operation since) are queried on their own.
+        """
+        snapshot = self._info_snapshot
+        if (time.time() - self._info_timestamp >
+                CONF.lxc.container_info_ttl):
+            snapshot = self.get_containers_info()
+
+        info = snapshot.get(instance['uuid'])
+        if info is None:
+            info = self._get_single_container_info(instance)
+
+        # a container never gets more cpus than its flavor, but its
+        # cpuset may pin it to fewer.
+        info = dict(info)
+        if info['num_cpu']:
+            info['num_cpu'] = min(instance['vcpus'], info['num_cpu'])
+        else:
+            info['num_cpu'] = instance['vcpus']
+        return info
+
+    def get_containers_info(self):
+        """Return the state and usage of every container in one pass.
+
+        The defined and running containers are listed once from
+        CONF.instances_path and the cgroup hierarchy is walked once to
+        find the accounting of all running containers.
+        """
+        defined = lxc.list_containers(active=False, defined=True,
+                                      config_path=CONF.instances_path)
+        running = set(lxc.list_containers(active=True, defined=False,
+                                          config_path=CONF.instances_path))
+        paths = cgroups.find_container_cgroups(
+            [name for name in defined if name in running])
+
+        snapshot = {}
+        for name in defined:
+            path = paths.get(name)
+            if path is None:
+                snapshot[name] = self._build_container_info(
+                    self._get_stopped_state({'uuid': name}))
+                continue
+
+            freezer = cgroups.read_cgroup_item('freezer', path,
+                                               'freezer.state')
+            mem = cgroups.read_cgroup_int('memory', path,
+                                          'memory.usage_in_bytes')
+            cpu_time, percpu = cgroups.read_cpu_usage(path)
+            cpuset = cgroups.parse_cpuset(
+                cgroups.read_cgroup_item('cpuset', path, 'cpuset.cpus'))
+            snapshot[name] = self._build_container_info(
+                LXC_POWER_STATE.get(freezer, power_state.RUNNING),
+                mem / units.Mi, cpu_time, len(cpuset) or len(percpu))
+
+        self.cpu_sampler.update_paths(paths)
+        self._info_snapshot = snapshot
+        self._info_timestamp = time.time()
+        return snapshot
+
+    def _get_single_container_info(self, instance):
+        container = lxc.Container(instance['uuid'])
+        container.set_config_path(CONF.instances_path)
+        if not container.running:
+            return self._build_container_info(
+                self._get_stopped_state(instance))
 
         mem = container_utils.get_container_mem_info(instance, container)
-        cores = int(container_utils.get_container_cores(instance)) / 1024
-        state = self.container_exists(instance)
-        if state:
-            pstate = power_state.RUNNING
-        elif state is False:
-            pstate = power_state.SHUTDOWN
-        else:
-            pstate = power_state.RUNNING
-        return {'state': pstate,
+        try:
+            cpu_time = int(container.get_cgroup_item('cpuacct.usage'))
+        except KeyError:
+            cpu_time = 0
+        try:
+            num_cpu = len(cgroups.parse_cpuset(
+                container.get_cgroup_item('cpuset.cpus')))
+        except KeyError:
+            num_cpu = 0
+        return self._build_container_info(
+            LXC_POWER_STATE.get(container.state, power_state.RUNNING),
+            mem, cpu_time, num_cpu)
+
+    def _get_stopped_state(self, instance):
+        # a checkpointed container is suspended to disk
+        if os.path.isdir(container_utils.get_container_checkpoint(instance)):
+            return power_state.SUSPENDED
+        return power_state.SHUTDOWN
+
+    def _build_container_info(self, state, mem=0, cpu_time=0, num_cpu=0):
+        return {'state': state,
                 'max_mem': mem,
                 'mem': mem,
-                'num_cpu': 2,
-                'cpu_time': 0}
-
+                'num_cpu': num_cpu,
+                'cpu_time': cpu_time}
+
+    def sample_cpu_usage(self, instances):
+        """Return cpu_time and utilization since the previous sample.
+
+        Only the cpuacct.usage file of each container is read; see
+        cgroups.CPUSampler.
+        """
+        return self.cpu_sampler.sample([i['uuid'] for i in instances])
+
+    def get_container_diagnostics(self, instance):
+        sample = self.sample_cpu_usage([instance]).get(instance['uuid'])
+        path = self.cpu_sampler.get_path(instance['uuid'])
+        if sample is None or path is None:
+            return {}
+
+        cpu_time, percpu = cgroups.read_cpu_usage(path)
+        diags = {'cpu_time': cpu_time,
+                 'memory': cgroups.read_cgroup_int(
+                     'memory', path, 'memory.usage_in_bytes'),
+                 'memory-limit': cgroups.read_cgroup_int(
+                     'memory', path, 'memory.limit_in_bytes')}
+        if sample['utilization'] is not None:
+            # cpus busy since the previous diagnostics of the instance
+            diags['cpu_utilization'] = sample['utilization']
+        for cpu, usage in enumerate(percpu):
+            diags['cpu%d_time' % cpu] = usage
+        return diags
+
+    def _invalidate_container_info(self, instance):
+        self._info_snapshot.pop(instance['uuid'], None)
+        self.cpu_sampler.forget(instance['uuid'])
 
     def get_container_pid(self, instance):
         (container, lxc_type) = self.get_container_root(instance)
@@ -27,15 +27,25 @@ from oslo.config import cfg
 
 from . import containers
 from . import hostops
+from . import imagecache
+from . import migration
+from . import prefetch
 
 from nova.compute import power_state
+from nova.compute import vm_states
+from nova import context as nova_context
+from nova import objects
+from nova.openstack.common.gettextutils import _  # noqa
+from nova.openstack.common import jsonutils
 from nova.openstack.common import log as logging
+from nova.virt import block_device as driver_block_device
 from nova.virt import driver
 from nova.virt import volumeutils
 
 CONF = cfg.CONF
 CONF.import_opt('host', 'nova.netconf')
 CONF.import_opt('my_ip', 'nova.netconf')
+CONF.import_opt('resume_guests_state_on_host_boot', 'nova.compute.manager')
 
 LOG = logging.getLogger(__name__)
 
@@ -44,10 +54,75 @@ class LXCDriver(driver.ComputeDriver):
     def __init__(self, virtapi, read_only=False):
         super(LXCDriver, self).__init__(virtapi)
         self.containers = containers.Containers(virtapi)
-        self.hostops = hostops.HostOps()
+        self.hostops = hostops.HostOps(self.containers.numa)
+        self.image_cache_manager = imagecache.ImageCacheManager()
+        self.migrationops = migration.MigrationOps(self.containers)
+        # instances init_host started, see _resume_instances
+        self._resumed = set()
 
     def init_host(self, host):
         self.containers.init_container()
+        self.hostops.init_host()
+
+        context = nova_context.get_admin_context()
+        instances = self._get_host_instances(context, host)
+        bdms = dict((instance.uuid,
+                     objects.BlockDeviceMappingList.get_by_instance_uuid(
+                         context, instance.uuid))
+                    for instance in instances)
+        self._init_volume_users(bdms)
+        self._resume_instances(context, instances, bdms)
+
+    def _get_host_instances(self, context, host):
+        return objects.InstanceList.get_by_host(
+            context, host, expected_attrs=['system_metadata', 'info_cache'])
+
+    def _init_volume_users(self, bdms):
+        """Tell the volume layer which instances use which volumes."""
+        users = []
+        for instance_uuid, instance_bdms in bdms.items():
+            for bdm in instance_bdms:
+                if bdm.is_volume and bdm.connection_info:
+                    users.append((jsonutils.loads(bdm.connection_info),
+                                  instance_uuid))
+        self.containers.volumes.init_users(users)
+
+    def _resume_instances(self, context, instances, bdms):
+        """Start the instances that were running before the host booted.
+
+        nova-compute resumes them one at a time after init_host, through
+        resume_state_on_host_boot. Starting them here with
+        start_containers boots them in parallel, by boot priority, and
+        resume_state_on_host_boot then has nothing left to do for them.
+        """
+        if not CONF.resume_guests_state_on_host_boot:
+            return
+        running = set(lxc.list_containers(active=True, defined=False,
+                                          config_path=CONF.instances_path))
+        instances = [instance for instance in instances
+                     if instance.power_state == power_state.RUNNING and
+                     instance.vm_state == vm_states.ACTIVE and
+                     instance.task_state is None and
+                     instance.uuid not in running]
+        if not instances:
+            return
+
+        LOG.info(_('Resuming %d instances after the host boot'),
+                 len(instances))
+        network_info = {}
+        block_device_info = {}
+        for instance in instances:
+            if instance.info_cache is not None:
+                network_info[instance.uuid] = (
+                    instance.info_cache.network_info)
+            block_device_info[instance.uuid] = {
+                'block_device_mapping': driver_block_device.convert_volumes(
+                    bdms[instance.uuid])}
+        results = self.containers.start_containers(
+            context, instances, network_info,
+            block_device_info=block_device_info)
+        self._resumed = set(uuid for uuid, error in results.items()
+                            if error is None)
 
     def list_instances(self):
         return lxc.list_containers(config_path=CONF.instances_path)
@@ -61,7 +136,8 @@ class LXCDriver(driver.ComputeDriver):
                               admin_password, network_info, block_device_info)
 
     def snapshot(self, context, instance, name, update_task_state):
-        pass
+        self.containers.snapshot_container(context, instance, name,
+                                           update_task_state)
 
     def reboot(self, context, instance, network_info, reboot_type,
                block_device_info=None, bad_volumes_callback=None):
@@ -77,17 +153,52 @@ class LXCDriver(driver.ComputeDriver):
         pass
 
     def power_off(self, instance, timeout=0, retry_interval=0):
-        self.containers.stop_container(instance)
+        self.containers.stop_container(instance, timeout, retry_interval)
 
     def power_on(self, context, instance, network_info, block_device_info):
         self.containers.start_container(context, instance, network_info,
                                         block_device_info)
 
+    def power_on_instances(self, context, instances, network_info=None,
+                           concurrency=None):
+        """Start many instances in parallel, e.g. after host maintenance.
+
+        network_info optionally maps instance uuids to their network info.
+        Returns a dict of instance uuid to None or the error message.
+        """
+        return self.containers.start_containers(context, instances,
+                                                network_info, concurrency)
+
+    def power_off_instances(self, instances, timeout=0, retry_interval=0,
+                            concurrency=None):
+        """Stop many instances in parallel, e.g. before host maintenance.
+
+        Returns a dict of instance uuid to None or the error message.
+        """
+        return self.containers.stop_containers(instances, timeout,
+                                               retry_interval, concurrency)
+
+    def resume_state_on_host_boot(self, context, instance, network_info,
+                                  block_device_info=None):
+        if instance['uuid'] in self._resumed:
+            # already started in bulk by init_host
+            self._resumed.discard(instance['uuid'])
+            return
+        self.containers.start_container(context, instance, network_info,
+                                        block_device_info)
+
+    def pause(self, instance):
+        self.containers.suspend_container(instance, reclaim=False)
+
+    def unpause(self, instance):
+        self.containers.resume_container(None, instance, None, None)
+
     def suspend(self, instance):
-        pass
+        self.containers.suspend_container(instance)
 
     def resume(self, context, instance, network_info, block_device_info=None):
-        pass
+        self.containers.resume_container(context, instance, network_info,
+                                         block_device_info)
 
     def destroy(self, context, instance, network_info, block_device_info=None,
                 destroy_disks=True):
@@ -96,9 +207,59 @@ class LXCDriver(driver.ComputeDriver):
     
     def cleanup(self, context, instance, network_info, block_device_info=None,
                 destroy_disks=True, migrate_data=None, destroy_vifs=True):
-        self.containers.cleanup_container(context, instance, network_info,
+        self.containers.container_cleanup(context, instance, network_info,
                                           block_device_info, destroy_disks,
-                                          destory_vifs)
+                                          migrate_data, destroy_vifs)
+
+    def check_can_live_migrate_destination(self, context, instance,
+                                           src_compute_info, dst_compute_info,
+                                           block_migration=False,
+                                           disk_over_commit=False):
+        # the root filesystem is always copied with btrfs send
+        return {'block_migration': True}
+
+    def check_can_live_migrate_destination_cleanup(self, context,
+                                                   dest_check_data):
+        pass
+
+    def check_can_live_migrate_source(self, context, instance,
+                                      dest_check_data):
+        return dest_check_data
+
+    def get_instance_disk_info(self, instance_name, block_device_info=None):
+        return jsonutils.dumps([])
+
+    def pre_live_migration(self, context, instance, block_device_info,
+                           network_info, disk_info, migrate_data=None):
+        self.migrationops.pre_live_migration(context, instance, network_info)
+
+    def live_migration(self, context, instance, dest, post_method,
+                       recover_method, block_migration=False,
+                       migrate_data=None):
+        self.migrationops.live_migration(context, instance, dest,
+                                         post_method, recover_method,
+                                         block_migration, migrate_data)
+
+    def post_live_migration_at_destination(self, context, instance,
+                                           network_info,
+                                           block_migration=False,
+                                           block_device_info=None):
+        self.migrationops.post_live_migration_at_destination(
+            context, instance, network_info)
+
+    def rollback_live_migration_at_destination(self, context, instance,
+                                               network_info,
+                                               block_device_info,
+                                               destroy_disks=True,
+                                               migrate_data=None):
+        self.migrationops.rollback_live_migration_at_destination(
+            context, instance, network_info)
+
+    def ensure_filtering_rules_for_instance(self, instance, network_info):
+        pass
+
+    def unfilter_instance(self, instance, network_info):
+        pass
 
     def attach_volume(self, context, connection_info, instance, mountpoint,
                       disk_bus=None, device_type=None, encryption=None):
@@ -123,6 +284,13 @@ class LXCDriver(driver.ComputeDriver):
     def get_info(self, instance):
         return self.containers.get_container_info(instance)
 
+    def get_all_info(self):
+        """Return get_info style dicts for every container, by uuid."""
+        return self.containers.get_containers_info()
+
+    def get_diagnostics(self, instance):
+        return self.containers.get_container_diagnostics(instance)
+
     def get_console_output(self, context, instance):
         return self.containers.get_container_console(instance)
 
@@ -136,5 +304,15 @@ class LXCDriver(driver.ComputeDriver):
             'host': CONF.host
         }
 
+    def manage_image_cache(self, context, all_instances):
+        self.image_cache_manager.update(context, all_instances)
+
+    def prefetch_images(self, context, image_refs, concurrency=None,
+                        bandwidth=None):
+        """Pull images into the image cache before they are spawned."""
+        return prefetch.prefetch_images(context, image_refs,
+                                        self.containers.idmap,
+                                        concurrency, bandwidth)
+
     def get_available_nodes(self, refresh=False):
         return [platform.node()]
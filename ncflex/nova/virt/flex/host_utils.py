@@ -59,3 +59,41 @@ def get_disk_info():
 
 def get_cpu_count():
     return multiprocessing.cpu_count()
+
+def get_block_device(path, mountinfo='/proc/self/mountinfo',
+                     sysfs_dev='/sys/dev/block'):
+    """Return the major:minor of the disk a path is stored on.
+
+    st_dev cannot be used as btrfs reports an anonymous device, so the
+    source of the mount holding the path is looked up instead. A
+    partition is mapped to its whole disk, the blkio.throttle.* items
+    of the cgroups refuse partitions.
+    """
+    path = os.path.realpath(path)
+    best = None
+    with open(mountinfo, 'r') as fp:
+        for line in fp:
+            fields = line.split()
+            mount_point = fields[4]
+            source = fields[fields.index('-') + 2]
+            if ((path == mount_point or
+                 path.startswith(mount_point.rstrip('/') + '/')) and
+                    (best is None or len(mount_point) >= len(best[0]))):
+                best = (mount_point, source)
+    if best is None or not best[1].startswith('/dev/'):
+        return None
+    rdev = os.stat(best[1]).st_rdev
+    return get_whole_disk('%d:%d' % (os.major(rdev), os.minor(rdev)),
+                          sysfs_dev)
+
+def get_whole_disk(device, sysfs_dev='/sys/dev/block'):
+    """Return the major:minor of the disk of a partition, or device."""
+    device_dir = os.path.realpath(os.path.join(sysfs_dev, device))
+    if not os.path.exists(os.path.join(device_dir, 'partition')):
+        return device
+    try:
+        with open(os.path.join(os.path.dirname(device_dir), 'dev')) as fp:
+            return fp.read().strip()
+    except (IOError, OSError):
+        log.warn(_('Failed to find the disk of partition %s'), device)
+        return None
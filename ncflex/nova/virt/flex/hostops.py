@@ -12,7 +12,9 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import os
 import re
+import time
 
 from oslo.config import cfg
 from oslo.utils import units
@@ -20,12 +22,24 @@ from oslo.serialization import jsonutils
 
 import lxc
 
+from . import cgroups
 from . import host_utils
+from . import numa
 from nova.openstack.common.gettextutils import _   # noqa
 from nova.openstack.common import log as logging
 from nova import utils
+from nova.virt import hardware
+
+hostops_opts = [
+    cfg.IntOpt('resource_refresh_interval',
+               default=60,
+               help='Number of seconds the host resource usage reported to '
+                    'the resource tracker is cached before it is '
+                    'recomputed'),
+]
 
 CONF = cfg.CONF
+CONF.register_opts(hostops_opts, 'lxc')
 
 log = logging.getLogger(__name__)
 
@@ -44,30 +58,125 @@ def parse_version(version):
 
 
 class HostOps(object):
-    def __init__(self):
+    def __init__(self, numa_placement=None):
+        self.numa_placement = numa_placement
+        self._static = None
+        self._stats = None
+        self._topology = []
+        self._updated_at = 0
+        # container name -> cgroup path, see _get_container_paths
+        self._paths = {}
+
+    def init_host(self):
+        """Compute the resources that do not change while we run."""
+        memory = host_utils.get_memory_info()
+        disk = host_utils.get_disk_info()
+        self._topology = numa.get_host_topology()
+
+        self._static = {
+            'vcpus': host_utils.get_cpu_count(),
+            'memory_mb': memory['total'],
+            'local_gb': disk['total'] / units.Gi,
+            'hypervisor_type': 'lxc',
+            'hypervisor_version': parse_version(lxc.version),
+            'hypervisor_hostname': CONF.host,
+            'cpu_info': '?',
+            'supported_instances': jsonutils.dumps([
+                                   ('i686', 'lxc', 'lxc'),
+                                   ('x86_64', 'lxc', 'lxc'),
+                                 ])}
         self._stats = None
 
     def get_available_resource(self, nodename):
-        return self._update_status()
+        if (self._stats is None or time.time() - self._updated_at >
+                CONF.lxc.resource_refresh_interval):
+            self._update_status()
+        # the resource tracker updates the dict it gets in place
+        return dict(self._stats)
 
     def _update_status(self):
-        memory = host_utils.get_memory_info()
+        if self._static is None:
+            self.init_host()
+
         disk = host_utils.get_disk_info()
+        memory = host_utils.get_memory_info()
+        vcpus_used, memory_used, rss, pinned = self._get_container_usage()
+        # /proc/meminfo counts the anonymous memory of the containers
+        # as used but not their page cache, which is charged to them
+        host_used = max(memory['used'] * units.Mi - rss, 0)
 
-        dic = {'vcpus': host_utils.get_cpu_count(),
-               'memory_mb': memory['total'],
-               'local_gb': disk['total'] / units.Gi,
-               'vcpus_used': 0,
-               'memory_mb_used': memory['used'],
-               'local_gb_used': disk['used'] / units.Gi,
-               'hypervisor_type': 'lxc',
-               'hypervisor_version': parse_version(lxc.version),
-               'hypervisor_hostname': CONF.host,
-               'cpu_info': '?',
-               'supported_instances': jsonutils.dumps([
-                                      ('i686', 'lxc', 'lxc'),
-                                      ('x86_64', 'lxc', 'lxc'),
-                                    ])}
+        dic = dict(self._static)
+        dic.update({'vcpus_used': vcpus_used,
+                    'memory_mb_used': (host_used + memory_used) // units.Mi,
+                    'local_gb_used': disk['used'] / units.Gi,
+                    'cpu_info': jsonutils.dumps(
+                        {'pinned_cpus': sorted(pinned)}),
+                    'numa_topology': self._get_numa_topology()})
 
         self._stats = dic
+        self._updated_at = time.time()
         return self._stats
+
+    def _get_numa_topology(self):
+        """Return the serialized VirtNUMAHostTopology of the host.
+
+        The usage of each cell is what the NUMA placement of containers
+        allocated on it. Hosts without NUMA support report None.
+        """
+        if not self._topology:
+            return None
+        usage = {}
+        if self.numa_placement is not None:
+            usage = self.numa_placement.get_usage()
+        cells = []
+        for cell in self._topology:
+            cell_usage = usage.get(cell['id'], {})
+            cells.append(hardware.VirtNUMATopologyCellUsage(
+                cell['id'], set(cell['cpus']), cell['memory_mb'],
+                cpu_usage=cell_usage.get('vcpus', 0),
+                memory_usage=cell_usage.get('memory_mb', 0)))
+        return hardware.VirtNUMAHostTopology(cells=cells).to_json()
+
+    def _get_container_paths(self):
+        """Return the cgroups of the running containers.
+
+        The cgroups found by the previous refresh are reused, the
+        hierarchy is only walked for the containers started since or
+        whose cgroup went away.
+        """
+        running = lxc.list_containers(active=True, defined=False,
+                                      config_path=CONF.instances_path)
+        paths = dict((name, self._paths[name]) for name in running
+                     if name in self._paths and os.path.isdir(
+                         cgroups.get_cgroup_path('memory',
+                                                 self._paths[name])))
+        paths.update(cgroups.find_container_cgroups(
+            [name for name in running if name not in paths]))
+        self._paths = paths
+        return paths
+
+    def _get_container_usage(self):
+        """Sum up cpu and memory usage of the running containers.
+
+        vcpus are derived from cpu.shares, which is set to 1024 per
+        flavor vcpu, and memory from memory.usage_in_bytes. Also returns
+        the resident memory of the containers and the cpus they are
+        pinned to with flex:cpuset.
+        """
+        all_cpus = set(range(self._static['vcpus']))
+        shares = 0
+        memory = 0
+        rss = 0
+        pinned = set()
+        for path in self._get_container_paths().values():
+            shares += cgroups.read_cgroup_int('cpu', path, 'cpu.shares')
+            memory += cgroups.read_cgroup_int('memory', path,
+                                              'memory.usage_in_bytes')
+            # total_rss includes the cgroups created inside the container
+            stat = cgroups.read_cgroup_stat('memory', path, 'memory.stat')
+            rss += stat.get('total_rss', stat.get('rss', 0))
+            cpus = cgroups.parse_cpuset(
+                cgroups.read_cgroup_item('cpuset', path, 'cpuset.cpus'))
+            if cpus and cpus != all_cpus:
+                pinned |= cpus
+        return int(round(shares / 1024.0)), memory, rss, pinned
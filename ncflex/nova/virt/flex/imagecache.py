@@ -0,0 +1,145 @@
+# Copyright (c) 2014 Canonical Ltd
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Image cache management for the flex driver.
+
+Every image used by a container lives twice in the cache directory: as
+the <image_ref>.tar.gz downloaded from glance and as the <image_ref>
+btrfs subvolume the container root filesystems are snapshotted from.
+Containers keep working when their base image is removed, so unused
+images are evicted least recently used first until the cache fits in
+CONF.lxc.image_cache_max_size_mb.
+"""
+
+import os
+import time
+
+from oslo.config import cfg
+from oslo.utils import units
+
+from . import images
+from nova.openstack.common.gettextutils import _  # noqa
+from nova.openstack.common import log as logging
+from nova.virt import imagecache
+
+imagecache_opts = [
+    cfg.IntOpt('image_cache_max_size_mb',
+               default=0,
+               help='Size the image cache is trimmed down to by evicting '
+                    'unused images, least recently used first. 0 evicts '
+                    'every unused image.'),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(imagecache_opts, 'lxc')
+CONF.import_opt('image_cache_subdirectory_name', 'nova.virt.imagecache')
+CONF.import_opt('remove_unused_base_images', 'nova.virt.imagecache')
+CONF.import_opt('remove_unused_original_minimum_age_seconds',
+                'nova.virt.imagecache')
+
+LOG = logging.getLogger(__name__)
+
+TARBALL_SUFFIX = '.tar.gz'
+IN_PROGRESS_SUFFIXES = ('.part', '.partial')
+
+
+class ImageCacheManager(imagecache.ImageCacheManager):
+    def __init__(self):
+        super(ImageCacheManager, self).__init__()
+        # extracted images never change, so their size is computed once
+        self._sizes = {}
+
+    def update(self, context, all_instances):
+        base_dir = os.path.join(CONF.instances_path,
+                                CONF.image_cache_subdirectory_name)
+        if not os.path.isdir(base_dir):
+            return
+
+        running = self._list_running_instances(context, all_instances)
+        used = set(running['used_images'])
+        cached = self._list_cached_images(base_dir)
+
+        total = sum(entry['size'] for entry in cached.values())
+        LOG.debug('Image cache holds %(count)d images, %(size)d bytes',
+                  {'count': len(cached), 'size': total})
+        if not self.remove_unused_base_images:
+            return
+
+        budget = CONF.lxc.image_cache_max_size_mb * units.Mi
+        min_age = CONF.remove_unused_original_minimum_age_seconds
+        now = time.time()
+        unused = sorted((entry for image_ref, entry in cached.items()
+                         if image_ref not in used and
+                         now - entry['last_used'] > min_age),
+                        key=lambda entry: entry['last_used'])
+        for entry in unused:
+            if budget > 0 and total <= budget:
+                break
+            if self._remove_image(base_dir, entry):
+                total -= entry['size']
+
+    def _list_cached_images(self, base_dir):
+        cached = {}
+        for name in os.listdir(base_dir):
+            if name.endswith(IN_PROGRESS_SUFFIXES):
+                continue
+            if name.endswith(TARBALL_SUFFIX):
+                image_ref = name[:-len(TARBALL_SUFFIX)]
+            else:
+                image_ref = name
+            path = os.path.join(base_dir, name)
+            entry = cached.setdefault(image_ref, {'image_ref': image_ref,
+                                                  'size': 0,
+                                                  'last_used': 0})
+            entry['last_used'] = max(entry['last_used'],
+                                     os.stat(path).st_mtime)
+            if os.path.isdir(path):
+                entry['size'] += self._get_image_size(path)
+            else:
+                entry['size'] += os.path.getsize(path)
+        return cached
+
+    def _get_image_size(self, image_dir):
+        if image_dir not in self._sizes:
+            size = 0
+            for dirpath, dirnames, filenames in os.walk(image_dir):
+                for filename in filenames:
+                    try:
+                        size += os.lstat(os.path.join(dirpath,
+                                                      filename)).st_size
+                    except OSError:
+                        pass
+            self._sizes[image_dir] = size
+        return self._sizes[image_dir]
+
+    def _remove_image(self, base_dir, entry):
+        image_ref = entry['image_ref']
+        image_dir = os.path.join(base_dir, image_ref)
+        tarball = image_dir + TARBALL_SUFFIX
+        LOG.info(_('Removing unused base image %(image)s, last used '
+                   '%(last_used)s'),
+                 {'image': image_ref,
+                  'last_used': time.ctime(entry['last_used'])})
+        try:
+            with images.image_lock(image_ref):
+                if os.path.isdir(image_dir):
+                    images.delete_image_dir(image_dir)
+                if os.path.exists(tarball):
+                    os.unlink(tarball)
+        except Exception:
+            LOG.exception(_('Failed to remove base image %s'), image_ref)
+            return False
+        self._sizes.pop(image_dir, None)
+        return True
@@ -1,60 +1,261 @@
 import os
 import tarfile
+import tempfile
+import time
+import zlib
 
+import eventlet
+from eventlet.green import subprocess
 from oslo.config import cfg
 
 from . import utils as container_utils
 from nova import exception
 from nova.compute import flavors
+from nova.image import glance
+from nova.openstack.common import excutils
 from nova.openstack.common import fileutils
+from nova.openstack.common import lockutils
 from nova.openstack.common import log as logging
 from nova.openstack.common.gettextutils import _
-from nova import utils
+from nova.openstack.common import processutils
 from nova.virt import images
 
+image_opts = [
+    cfg.BoolOpt('stream_images',
+                default=True,
+                help='Extract images while they are downloaded from glance '
+                     'instead of downloading them completely first'),
+    cfg.ListOpt('image_decompressors',
+                default=['pigz', 'gzip'],
+                help='gzip compatible programs used to decompress images, '
+                     'the first one found in PATH is used'),
+]
+
 CONF = cfg.CONF
+CONF.register_opts(image_opts, 'lxc')
 
 LOG = logging.getLogger(__name__)
 
 def create_container(context, instance, image_meta, container_image, idmap, flavor):
     try:
-        _fetch_image(context, instance, image_meta, container_image, idmap, flavor)
+        fetch_image(context, instance, image_meta, container_image, idmap, flavor)
         _setup_container(instance, container_image, idmap)
     except Exception as ex:
         LOG.error(_('Failed: %s') % ex)
 
-def _fetch_image(context, instance, image_meta, container_image, idmap, flavor):
-    """Fetch the image from a glance image server."""
-    LOG.debug("Downloading image from glance")
+def fetch_image(context, instance, image_meta, container_image, idmap, flavor,
+                throttle=None):
+    """Fetch the image from a glance image server.
 
+    The extracted image is published under the cache directory with an
+    atomic rename, so once it exists it is complete. Concurrent spawns of
+    the same image serialize on a per image lock: the first one fetches
+    and extracts it, the others wait and then use the published copy.
+    """
     base_dir = os.path.join(CONF.instances_path,
                             CONF.image_cache_subdirectory_name)
     image_dir = os.path.join(base_dir, instance['image_ref'])
+    if os.path.exists(image_dir):
+        return
+
     if not os.path.exists(base_dir):
         fileutils.ensure_tree(base_dir)
     base = os.path.join(base_dir, container_image)
-    if not os.path.exists(base):
-        images.fetch_to_raw(context, instance['image_ref'], base,
-                            instance['user_id'], instance['project_id'])
-        if not tarfile.is_tarfile(base):
-            os.unlink(base)
-            raise exeception.InvalidDiskFormat(
-                disk_format=container_utils.get_disk_format(image_meta))
-        
-    if not os.path.exists(image_dir):
-        (user, group) = idmap.get_user()
-        utils.execute('btrfs', 'sub', 'create', image_dir)
 
-        utils.execute('chown', '%s:%s' % (user, group), image_dir, run_as_root=True)
+    with image_lock(instance['image_ref']):
+        if os.path.exists(image_dir):
+            LOG.debug('Image %s was fetched while waiting for the lock',
+                      instance['image_ref'])
+            return
+
+        LOG.debug("Downloading image from glance")
+        staging = '%s.partial' % image_dir
+        if os.path.exists(staging):
+            # left behind by an interrupted fetch
+            delete_image_dir(staging)
+
+        if CONF.lxc.stream_images and not os.path.exists(base):
+            _stream_image(context, instance, image_meta, base, staging,
+                          idmap, throttle)
+        else:
+            if not os.path.exists(base):
+                images.fetch_to_raw(context, instance['image_ref'], base,
+                                    instance['user_id'],
+                                    instance['project_id'])
+                if not tarfile.is_tarfile(base):
+                    os.unlink(base)
+                    raise exception.InvalidDiskFormat(
+                        disk_format=container_utils.get_disk_format(
+                            image_meta))
+            _extract_image(base, staging, idmap)
+
+        os.rename(staging, image_dir)
+
+def image_lock(image_ref):
+    """Lock serializing the population and removal of a cached image."""
+    return lockutils.lock('image-%s' % image_ref, lock_file_prefix='flex-',
+                          external=True,
+                          lock_path=os.path.join(CONF.instances_path,
+                                                 'locks'))
+
+def record_image_use(base_dir, container_image):
+    """Mark a cached image as used, for the image cache manager's LRU."""
+    base = os.path.join(base_dir, container_image)
+    if os.path.exists(base):
+        os.utime(base, None)
+
+def _extract_image(base, image_dir, idmap):
+    _create_image_dir(image_dir, idmap)
+    try:
+        args = tuple(get_nsexec(idmap) + _get_tar_extract(image_dir, base))
+        container_utils.execute(*args, check_exit_code=[0,2])
+        container_utils.execute(*tuple(get_nsexec(idmap) + ['chown', '0:0', image_dir]))
+    except Exception:
+        with excutils.save_and_reraise_exception():
+            delete_image_dir(image_dir)
+
+def _stream_image(context, instance, image_meta, base, image_dir, idmap,
+                  throttle=None):
+    """Download, validate and extract an image in a single pass.
+
+    The chunks coming from glance are written to the cached tarball and
+    to the stdin of tar at the same time, and the first tar header is
+    checked as soon as it has been received.
+    """
+    image_service, image_id = glance.get_remote_image_service(
+        context, instance['image_ref'])
+    chunks = image_service.download(context, image_id)
+
+    _create_image_dir(image_dir, idmap)
+    part = '%s.part' % base
+    validator = TarGzValidator()
+    stderr = tempfile.TemporaryFile()
+    cmd = get_nsexec(idmap) + _get_tar_extract(image_dir, '-')
+    proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stderr=stderr,
+                            close_fds=True)
+    try:
+        with open(part, 'wb') as fp:
+            for chunk in chunks:
+                if not validator.valid:
+                    try:
+                        validator.feed(chunk)
+                    except ValueError as ex:
+                        LOG.error(_('Image %(image)s is not a tarball: '
+                                    '%(reason)s'),
+                                  {'image': instance['image_ref'],
+                                   'reason': ex})
+                        raise exception.InvalidDiskFormat(
+                            disk_format=container_utils.get_disk_format(
+                                image_meta))
+                fp.write(chunk)
+                proc.stdin.write(chunk)
+                if throttle is not None:
+                    throttle.consume(len(chunk))
+        if not validator.valid:
+            raise exception.ImageUnacceptable(
+                image_id=instance['image_ref'],
+                reason=_('image is too short to be a tarball'))
+
+        proc.stdin.close()
+        exit_code = proc.wait()
+        if exit_code not in (0, 2):
+            stderr.seek(0)
+            raise processutils.ProcessExecutionError(
+                exit_code=exit_code, stderr=stderr.read(),
+                cmd=' '.join(cmd))
+    except Exception:
+        with excutils.save_and_reraise_exception():
+            if proc.poll() is None:
+                proc.kill()
+                proc.wait()
+            if os.path.exists(part):
+                os.unlink(part)
+            delete_image_dir(image_dir)
+    finally:
+        stderr.close()
+
+    os.rename(part, base)
+    container_utils.execute(*tuple(get_nsexec(idmap) + ['chown', '0:0', image_dir]))
+
+def _create_image_dir(image_dir, idmap):
+    (user, group) = idmap.get_user()
+    container_utils.execute('btrfs', 'sub', 'create', image_dir)
+    container_utils.execute('chown', '%s:%s' % (user, group), image_dir, run_as_root=True)
+
+def delete_image_dir(image_dir):
+    container_utils.execute('btrfs', 'subvolume', 'delete', image_dir,
+                            run_as_root=True, check_exit_code=[0, 1])
+
+def get_nsexec(idmap):
+    """Return the prefix running a command in the user namespace of idmap."""
+    return (['lxc-usernsexec'] + idmap.usernsexec_margs(with_read="user") +
+            ['--'])
+
+def _get_tar_extract(image_dir, source):
+    return ['tar', '--directory', image_dir, '--anchored', '--numeric-owner',
+            '--use-compress-program', get_decompressor(), '-xpf', source]
+
+def get_decompressor():
+    """Return the first of the image_decompressors found in PATH."""
+    paths = os.environ.get('PATH', os.defpath).split(os.pathsep)
+    for program in CONF.lxc.image_decompressors:
+        for path in paths:
+            if os.access(os.path.join(path, program), os.X_OK):
+                return program
+    return 'gzip'
+
+
+class BandwidthThrottle(object):
+    """Limit the rate at which downloads consume data.
+
+    One throttle can be shared by several green threads; each consume()
+    reserves the next slot of the byte budget, so the limit applies to
+    their aggregate rate.
+    """
+
+    def __init__(self, rate):
+        # bytes per second, 0 disables the throttle
+        self.rate = rate
+        self._next = time.time()
+
+    def consume(self, nbytes):
+        if not self.rate:
+            return
+        now = time.time()
+        self._next = max(self._next, now) + float(nbytes) / self.rate
+        if self._next > now:
+            eventlet.sleep(self._next - now)
+
+
+class TarGzValidator(object):
+    """Check that a stream is a gzip'ed tarball from its first bytes.
+
+    feed() the leading chunks of the stream until valid is True; a
+    ValueError is raised as soon as the data cannot be a tarball.
+    """
+
+    def __init__(self):
+        self.valid = False
+        self._header = b''
+        self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    def feed(self, chunk):
+        data = self._decompressor.unconsumed_tail + chunk
+        try:
+            self._header += self._decompressor.decompress(
+                data, tarfile.BLOCKSIZE - len(self._header))
+        except zlib.error as ex:
+            raise ValueError(_('not a gzip stream: %s') % ex)
 
-        tar = ['tar', '--directory', image_dir,
-               '--anchored', '--numeric-owner', '-xpzf', base]
-        nsexec = (['lxc-usernsexec'] + idmap.usernsexec_margs(with_read="user") +
-                  ['--'])
-            
-        args = tuple(nsexec + tar)
-        utils.execute(*args, check_exit_code=[0,2])
-        utils.execute(*tuple(nsexec + ['chown', '0:0', image_dir]))
+        if len(self._header) < tarfile.BLOCKSIZE:
+            return
+        try:
+            chksum = tarfile.nti(self._header[148:156])
+        except (ValueError, tarfile.HeaderError):
+            chksum = None
+        if chksum not in tarfile.calc_chksums(self._header):
+            raise ValueError(_('invalid tar header checksum'))
+        self.valid = True
 
 def _setup_container(instance, comtainer_image, idmap):
     container_rootfs = container_utils.get_container_rootfs(instance)
@@ -73,26 +274,27 @@ def _setup_container(instance, comtainer_image, idmap):
 
     if not os.path.exists(container_rootfs):
         flavor = flavors.extract_flavor(instance)
+        record_image_use(base_dir, comtainer_image)
         if os.path.exists(image_dir):
             try:
-                utils.execute('btrfs', 'subvolume', 'snapshot', image_dir, container_rootfs,
-                              run_as_root=True)
+                container_utils.execute('btrfs', 'subvolume', 'snapshot', image_dir, container_rootfs,
+                                        run_as_root=True)
             except:
-                utils.execute('btrfs', 'subvolume', 'delete', container_rootfs,
-                              run_as_root=True)
+                container_utils.execute('btrfs', 'subvolume', 'delete', container_rootfs,
+                                        run_as_root=True)
 
         if not os.path.exists(console_log):
-            utils.execute('touch', console_log)
+            container_utils.execute('touch', console_log)
 
         lxc_type = container_utils.get_lxc_security_info(instance)
         if lxc_type == 'privileged':
-            utils.execute('chown', '-R', 'root:root', container_rootfs,
-                           run_as_root=True)
+            container_utils.execute('chown', '-R', 'root:root', container_rootfs,
+                                     run_as_root=True)
 
         # setup the user quotas
         size = instance['root_gb']
         if size != 0:
-            utils.execute('btrfs', 'quota', 'enable', container_rootfs,
-                          run_as_root=True)
-            utils.execute('btrfs', 'qgroup', 'limit', '%sG' % size, container_rootfs,
-                          run_as_root=True)
+            container_utils.execute('btrfs', 'quota', 'enable', container_rootfs,
+                                    run_as_root=True)
+            container_utils.execute('btrfs', 'qgroup', 'limit', '%sG' % size, container_rootfs,
+                                    run_as_root=True)
@@ -0,0 +1,284 @@
+# Copyright (c) 2014 Canonical Ltd
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+In memory index of the iSCSI sessions and LUNs of the host.
+
+The index is built from /sys/class/iscsi_session and the SCSI devices
+of each session, and is kept up to date by the uevents of sessions and
+block devices when pyudev is available. Without pyudev sysfs is walked
+again on every lookup, which still runs no subprocess.
+
+A single greenthread reads the uevents, eventlet refuses several
+greenthreads waiting on the same socket; the others wait for it to
+apply them through an Event.
+"""
+
+import glob
+import os
+import re
+
+import eventlet
+from eventlet import event
+from eventlet.green import select
+
+from nova.openstack.common.gettextutils import _  # noqa
+from nova.openstack.common import importutils
+from nova.openstack.common import log as logging
+
+pyudev = importutils.try_import('pyudev')
+
+LOG = logging.getLogger(__name__)
+
+SESSION_DIR = '/sys/class/iscsi_session'
+SESSION_RE = re.compile(r'/(session\d+)(/|$)')
+LUN_RE = re.compile(r'/session\d+/target\d+:\d+:\d+/\d+:\d+:\d+:(\d+)'
+                    r'/block/([^/]+)$')
+
+
+def _read(path):
+    try:
+        with open(path, 'r') as fp:
+            return fp.read().strip()
+    except (IOError, OSError):
+        return ''
+
+
+def normalize_portal(portal):
+    """Strip the target portal group tag from an ip:port portal."""
+    return portal.split(',')[0]
+
+
+def read_session(session_dir):
+    """Return the (portal, iqn) of a session directory of sysfs."""
+    iqn = _read(os.path.join(session_dir, 'targetname'))
+    device = os.path.realpath(os.path.join(session_dir, 'device'))
+    for conn in glob.glob(os.path.join(device, 'connection*',
+                                       'iscsi_connection', 'connection*')):
+        address = _read(os.path.join(conn, 'persistent_address'))
+        port = _read(os.path.join(conn, 'persistent_port'))
+        if address:
+            if ':' in address:
+                address = '[%s]' % address
+            return ('%s:%s' % (address, port), iqn)
+    return (None, iqn)
+
+
+def read_session_luns(session_dir):
+    """Return {lun: block device name} of a session directory of sysfs."""
+    device = os.path.realpath(os.path.join(session_dir, 'device'))
+    luns = {}
+    for block in glob.glob(os.path.join(device, 'target*', '*:*:*:*',
+                                        'block', '*')):
+        lun = int(os.path.basename(os.path.dirname(
+            os.path.dirname(block))).split(':')[-1])
+        luns[lun] = os.path.basename(block)
+    return luns
+
+
+class ISCSIIndex(object):
+    """Sessions, LUNs and the instances using them.
+
+    Targets are keyed by their (portal, iqn). The LUNs come from sysfs,
+    so the LUNs logged in to before a restart of nova-compute are still
+    there. The instances using each LUN are kept in memory: they are
+    rebuilt from the block device mappings of the host by set_users()
+    and, until then, a LUN without known users is treated as in use.
+    """
+
+    def __init__(self, session_dir=SESSION_DIR):
+        self.session_dir = session_dir
+        # session name -> (portal, iqn)
+        self._sessions = {}
+        # (portal, iqn) -> {lun: block device name}
+        self._luns = {}
+        # (portal, iqn, lun) -> set of instance uuids
+        self._users = {}
+        self._users_known = False
+        self._monitor = None
+        self._reader = None
+        # sent, and replaced, every time uevents have been applied
+        self._uevent = event.Event()
+        self._loaded = False
+
+    def _start_monitor(self):
+        if pyudev is None or self._monitor is not None:
+            return
+        try:
+            monitor = pyudev.Monitor.from_netlink(pyudev.Context())
+            monitor.filter_by('block')
+            monitor.filter_by('iscsi_session')
+            monitor.start()
+        except Exception:
+            LOG.exception(_('Failed to monitor iSCSI uevents, falling '
+                            'back to sysfs scans'))
+            return
+        self._monitor = monitor
+        self._reader = eventlet.spawn(self._read_uevents)
+
+    def _read_uevents(self):
+        """Apply the uevents as they come and wake up their waiters."""
+        while True:
+            try:
+                select.select([self._monitor], [], [])
+                while select.select([self._monitor], [], [], 0)[0]:
+                    device = self._monitor.poll(timeout=0)
+                    if device is None:
+                        break
+                    self._handle_event(device)
+            except Exception:
+                LOG.exception(_('Failed to read iSCSI uevents, falling '
+                                'back to sysfs scans'))
+                self._monitor = None
+                self._reader = None
+                return
+            finally:
+                uevent, self._uevent = self._uevent, event.Event()
+                uevent.send(True)
+
+    def load(self):
+        """Rebuild the index from sysfs."""
+        self._start_monitor()
+        self._sessions = {}
+        self._luns = {}
+        if os.path.isdir(self.session_dir):
+            for name in os.listdir(self.session_dir):
+                self._add_session(name)
+        self._loaded = True
+
+    def _add_session(self, name):
+        session_dir = os.path.join(self.session_dir, name)
+        target = read_session(session_dir)
+        if target[0] is None:
+            return
+        self._sessions[name] = target
+        self._luns.setdefault(target, {}).update(
+            read_session_luns(session_dir))
+
+    def _remove_session(self, name):
+        target = self._sessions.pop(name, None)
+        if target is not None and target not in self._sessions.values():
+            self._luns.pop(target, None)
+
+    def _handle_event(self, device):
+        path = device.sys_path
+        session = SESSION_RE.search(path)
+        if session is None:
+            return
+        name = session.group(1)
+        if device.subsystem == 'iscsi_session':
+            if device.action == 'remove':
+                self._remove_session(name)
+            else:
+                self._add_session(name)
+            return
+
+        lun = LUN_RE.search(path)
+        target = self._sessions.get(name)
+        if lun is None or target is None:
+            if device.action != 'remove':
+                # a session that was not seen being added yet
+                self._add_session(name)
+            return
+        luns = self._luns.setdefault(target, {})
+        if device.action == 'remove':
+            luns.pop(int(lun.group(1)), None)
+        else:
+            luns[int(lun.group(1))] = lun.group(2)
+
+    def sync(self):
+        """Rescan sysfs, unless uevents are monitored.
+
+        The uevents are then applied by the reader greenthread as they
+        come in.
+        """
+        if not self._loaded or self._monitor is None:
+            self.load()
+
+    def wait_for_uevents(self, timeout):
+        """Wait up to timeout seconds for uevents and apply them.
+
+        Returns False at once when uevents are not monitored, so the
+        caller has to poll instead.
+        """
+        if not self._loaded:
+            self.load()
+        if self._monitor is None:
+            return False
+        with eventlet.Timeout(timeout, False):
+            self._uevent.wait()
+        return True
+
+    def get_target(self, iscsi_properties):
+        """Return the (portal, iqn) key of the target of a volume."""
+        return (normalize_portal(iscsi_properties['target_portal']),
+                iscsi_properties['target_iqn'])
+
+    def has_session(self, iscsi_properties):
+        self.sync()
+        return self.get_target(iscsi_properties) in self._luns
+
+    def get_device(self, iscsi_properties):
+        """Return the /dev path of the LUN of a volume, or None."""
+        self.sync()
+        name = self._luns.get(self.get_target(iscsi_properties), {}).get(
+            int(iscsi_properties.get('target_lun', 0)))
+        return '/dev/%s' % name if name else None
+
+    def _get_lun_key(self, iscsi_properties):
+        return self.get_target(iscsi_properties) + (
+            int(iscsi_properties.get('target_lun', 0)),)
+
+    def set_users(self, users):
+        """Replace the users of the LUNs by (properties, uuid) pairs."""
+        self._users = {}
+        for iscsi_properties, instance_uuid in users:
+            self.attach(iscsi_properties, instance_uuid)
+        self._users_known = True
+
+    def attach(self, iscsi_properties, instance_uuid):
+        key = self._get_lun_key(iscsi_properties)
+        self._users.setdefault(key, set()).add(instance_uuid)
+
+    def detach(self, iscsi_properties, instance_uuid):
+        """Forget an instance using a LUN.
+
+        Returns True when no other instance uses the LUN any more. Until
+        set_users() was called, LUNs nobody attached since the start are
+        assumed to be used by someone else.
+        """
+        key = self._get_lun_key(iscsi_properties)
+        if key not in self._users:
+            return self._users_known
+        users = self._users[key]
+        users.discard(instance_uuid)
+        if users:
+            return False
+        self._users.pop(key, None)
+        return True
+
+    def remove_lun(self, iscsi_properties):
+        """Drop a deleted LUN, return True if its target has no LUN left."""
+        self.sync()
+        target = self.get_target(iscsi_properties)
+        luns = self._luns.get(target, {})
+        luns.pop(int(iscsi_properties.get('target_lun', 0)), None)
+        return not luns
+
+    def remove_target(self, iscsi_properties):
+        target = self.get_target(iscsi_properties)
+        self._luns.pop(target, None)
+        for name, session in list(self._sessions.items()):
+            if session == target:
+                del self._sessions[name]
@@ -23,17 +23,21 @@ example:
   ubuntu veth br100 128
 """
 
-import os
 import argparse
+import os
 import sys
 import tempfile
 
 from nova.openstack.common import lockutils
 
 ETC_LXC_USERNET = "/etc/lxc/lxc-usernet"
+HEADER = "# USERNAME TYPE BRIDGE COUNT"
+OPS = ("set", "inc", "dec")
 
 
 class UserNetLine(object):
+    __slots__ = ('user', 'ntype', 'bridge', 'count', 'comment', 'error')
+
     def __init__(self, line):
         self.error = None
         line = line.rstrip("\n")
@@ -64,6 +68,10 @@ class UserNetLine(object):
         self.count = count
         self.comment = comment
 
+    @property
+    def key(self):
+        return (self.user, self.ntype, self.bridge)
+
     def __repr__(self):
         return(self.__str__())
 
@@ -80,27 +88,129 @@ class UserNetLine(object):
         return self.comment
 
 
+class UserNetFile(object):
+    """The lines of a lxc-usernet file indexed by (user, type, bridge).
+
+    Updates only touch the index and the line they change; deleted lines
+    are left as None until the file is saved, so that the positions in
+    the index stay valid.
+    """
+
+    def __init__(self, fname=ETC_LXC_USERNET):
+        self.fname = fname
+        self.lines = []
+        # (user, ntype, bridge) -> positions of its lines in self.lines
+        self.index = {}
+        self.changed = False
+        if os.path.exists(fname):
+            with open(fname, "r") as fp:
+                for line in fp:
+                    self._append(UserNetLine(line))
+        else:
+            self._append(UserNetLine(HEADER))
+            self.changed = True
+
+    def _append(self, line):
+        if line.user:
+            self.index.setdefault(line.key, []).append(len(self.lines))
+        self.lines.append(line)
+
+    def get(self, user, bridge, ntype="veth"):
+        positions = self.index.get((user, ntype, bridge))
+        if positions:
+            return self.lines[positions[-1]]
+        return None
+
+    def update(self, user, bridge, op, count=1, ntype="veth", strict=False):
+        if op not in OPS:
+            raise TypeError("op = '%s'. must be one of %s" %
+                            (op, ','.join(OPS)))
+
+        key = (user, ntype, bridge)
+        positions = self.index.get(key, [])
+        if strict and not positions and op != "set":
+            raise ValueError("EntryNotFound: user=%s, bridge=%s, ntype=%s" %
+                             (user, bridge, ntype))
+
+        if not positions:
+            if op == "dec" or int(count) == 0:
+                # decrement non-existing, assume zero
+                return
+            newline = UserNetLine("")
+            newline.user = user
+            newline.ntype = ntype
+            newline.bridge = bridge
+            newline.count = int(count)
+            self._append(newline)
+            self.changed = True
+            return
+
+        # update the last one, the others are deleted
+        line = self.lines[positions[-1]]
+        old = (len(positions), str(line.count))
+        if op == "inc":
+            line.count = int(line.count) + int(count)
+        elif op == "dec":
+            line.count = int(line.count) - int(count)
+        elif op == "set":
+            line.count = int(count)
+        drop = positions[:-1]
+        if int(line.count) <= 0:
+            drop = positions
+        if (1, str(line.count)) == old and not drop:
+            return
+        for position in drop:
+            self.lines[position] = None
+        self.index[key] = positions[len(drop):] or None
+        if not self.index[key]:
+            del self.index[key]
+        self.changed = True
+
+    def filter(self, user=None, bridge=None, count=None, ntype="veth"):
+        ret = []
+        for f in self.lines:
+            if f is None or not f.user:
+                continue
+            if user is not None and f.user != user:
+                continue
+            if bridge is not None and f.bridge != bridge:
+                continue
+            if count is not None and str(f.count) != str(count):
+                continue
+            if ntype is not None and f.ntype != ntype:
+                continue
+            ret.append(f)
+        return ret
+
+    def save(self):
+        """Write the file if it changed, replacing it atomically."""
+        if not self.changed:
+            return
+        write_usernet(self.fname, [l for l in self.lines if l is not None])
+        self.changed = False
+
+
+def usernet_lock(fname=ETC_LXC_USERNET):
+    """Lock a lxc-usernet file against other processes."""
+    return lockutils.lock(os.path.basename(fname) + ".lock", external=True,
+                          lock_path=os.path.dirname(fname))
+
+
 def load_usernet(fname):
-    lines = []
-    with open(fname, "r") as fp:
-        for line in fp:
-            lines.append(UserNetLine(line))
-    return lines
+    return [l for l in UserNetFile(fname).lines if l is not None]
 
 
 def write_usernet(fname, lines, drop=None):
     if drop:
-        nlines = []
-        for i, l in enumerate(lines):
-            if i not in drop:
-                nlines.append(l)
-        lines = nlines
+        lines = [l for i, l in enumerate(lines) if i not in drop]
     tf = None
     try:
-        tf = tempfile.NamedTemporaryFile(dir=os.path.dirname(fname),
+        tf = tempfile.NamedTemporaryFile(mode="w",
+                                         dir=os.path.dirname(fname),
                                          delete=False)
-        for l in lines:
-            tf.write(str(l) + "\n")
+        tf.write("".join(str(l) + "\n" for l in lines))
+        tf.flush()
+        os.fsync(tf.fileno())
         tf.close()
 
         if os.path.isfile(fname):
@@ -116,67 +226,48 @@ def write_usernet(fname, lines, drop=None):
             os.unlink(tf.name)
 
 
-def update_usernet(user, bridge, op, count=1, ntype="veth",
-                   strict=False, fname=ETC_LXC_USERNET):
+def batch_update(ops, strict=False, fname=ETC_LXC_USERNET):
+    """Apply (op, user, bridge, count[, ntype]) operations at once.
 
-    ops = ("set", "inc", "dec")
-    if op not in ops:
-        raise TypeError("op = '%s'. must be one of %s",
-                        (op, ','.join(ops)))
+    The operations are applied under the lock of the file and written
+    with a single rename, or not at all if one of them fails.
+    """
+    with usernet_lock(fname):
+        usernet = UserNetFile(fname)
+        for entry in ops:
+            op, user, bridge, count = entry[:4]
+            ntype = entry[4] if len(entry) > 4 else "veth"
+            usernet.update(user, bridge, op, count=count, ntype=ntype,
+                           strict=strict)
+        usernet.save()
 
-    minfo = "user=%s, bridge=%s, ntype=%s" % (user, bridge, ntype)
-    lines = load_usernet(fname)
 
-    found = []
-    for i, l in enumerate(lines):
-        if (user != l.user or bridge != l.bridge or l.ntype != ntype):
-            continue
-        found.append(i)
+def update_usernet(user, bridge, op, count=1, ntype="veth",
+                   strict=False, fname=ETC_LXC_USERNET):
+    batch_update([(op, user, bridge, count, ntype)], strict=strict,
+                 fname=fname)
 
-    if strict and not found and op != "set":
-        raise ValueError("EntryNotFound: %s" % minfo)
 
-    if not found:
-        if op == "dec":
-            # decrement non-existing, assume zero
-            return
-        newline = UserNetLine("")
-        newline.user = user
-        newline.ntype = ntype
-        newline.bridge = bridge
-        newline.count = int(count)
-        lines.append(newline)
-    else:
-        # update the last one (others deleted on write)
-        line = lines[found[-1]]
-        if op == "inc":
-            line.count = int(line.count) + int(count)
-        elif op == "dec":
-            line.count = int(line.count) - int(count)
-        elif op == "set":
-            if len(found) == 1 and line.count == count and count != 0:
-                return
-            line.count = count
-        if line.count == 0:
-            # set or dec to '0'. add this line to found, for delete
-            found.append(found[-1])
-
-    write_usernet(fname, lines, found[:-1])
+def lfilter(fname, user=None, bridge=None, count=None, ntype="veth"):
+    return UserNetFile(fname).filter(user=user, bridge=bridge, count=count,
+                                     ntype=ntype)
 
 
-def lfilter(fname, user=None, bridge=None, count=None, ntype="veth"):
-    ret = []
-    for f in load_usernet(fname):
-        if user is not None and f.user != user:
-            continue
-        if bridge is not None and f.bridge != bridge:
+def parse_batch(lines, ntype="veth"):
+    """Parse "<op> <user> <bridge> [<count>]" lines into operations."""
+    ops = []
+    for line in lines:
+        fields = line.split()
+        if not fields or fields[0].startswith("#"):
             continue
-        if count is not None and str(f.count) != str(count):
-            continue
-        if ntype is not None and f.ntype != ntype:
-            continue
-        ret.append(f)
-    return ret
+        if len(fields) not in (3, 4):
+            raise ValueError("Bad operation: %s" % line.strip())
+        op, user, bridge = fields[:3]
+        count = fields[3] if len(fields) == 4 else 1
+        if op == "del":
+            op, count = "set", 0
+        ops.append((op, user, bridge, count, ntype))
+    return ops
 
 
 def manage_main():
@@ -185,13 +276,22 @@ def manage_main():
     parser = argparse.ArgumentParser()
     parser.add_argument("--type", "-t", help="nic type (default: 'veth')",
                         default="veth", dest="ntype")
-    parser.add_argument('operation', choices=("set", "inc", "dec", "del", "get"))
-    parser.add_argument('user', help="username")
-    parser.add_argument('bridge', help="bridge")
+    parser.add_argument('operation',
+                        choices=("set", "inc", "dec", "del", "get", "batch"),
+                        help="'batch' reads '<op> <user> <bridge> [<count>]' "
+                             "lines from stdin and applies them at once")
+    parser.add_argument('user', nargs="?", help="username")
+    parser.add_argument('bridge', nargs="?", help="bridge")
     parser.add_argument('count', nargs="?", help="number to operate with.",
                         default=None, const=int)
 
     args = parser.parse_args()
+    if args.operation == "batch":
+        batch_update(parse_batch(sys.stdin, ntype=args.ntype), fname=fname)
+        return 0
+    if args.user is None or args.bridge is None:
+        parser.error("user and bridge are required")
+
     if args.operation == "del":
         args.operation = "set"
         args.count = 0
@@ -207,8 +307,6 @@ def manage_main():
             print(str(l))
         return 0
 
-    with lockutils.lock(str(fname)):
-        if not os.path.exists(fname):
-            fp.write("# USERNAME TYPE BRIDGE COUNT\n")
-        update_usernet(user=args.user, bridge=args.bridge, op=args.operation,
-                       count=args.count, ntype=args.ntype, fname=fname)
+    update_usernet(user=args.user, bridge=args.bridge, op=args.operation,
+                   count=args.count, ntype=args.ntype, fname=fname)
+    return 0
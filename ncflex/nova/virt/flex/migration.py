@@ -0,0 +1,189 @@
+# Copyright (c) 2014 Canonical Ltd
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Live migration of containers with btrfs send and CRIU.
+
+The root filesystem is copied while the container keeps running, as a
+read only snapshot sent with btrfs send. The container is then
+checkpointed, which stops it, and only the blocks changed since the
+first snapshot are sent along with the checkpoint. The destination
+restores the container from the checkpoint instead of booting it.
+
+Both hosts need ssh access between the nova users, the same
+instances_path and the same subordinate id map.
+"""
+
+import os
+import shlex
+import tempfile
+
+from eventlet.green import subprocess
+import lxc
+from oslo.config import cfg
+
+from . import config
+from . import images
+from . import utils as container_utils
+from nova import exception
+from nova.openstack.common import excutils
+from nova.openstack.common import fileutils
+from nova.openstack.common.gettextutils import _  # noqa
+from nova.openstack.common import log as logging
+from nova import utils
+
+CONF = cfg.CONF
+
+LOG = logging.getLogger(__name__)
+
+
+def get_migration_dir(instance):
+    return os.path.join(container_utils.get_instance_path(instance),
+                        'migration')
+
+
+def _get_root_helper():
+    return shlex.split(utils.get_root_helper())
+
+
+def _pipe(send_cmd, receive_cmd):
+    """Run send_cmd | receive_cmd, raising if either fails."""
+    send_err = tempfile.TemporaryFile()
+    receive_err = tempfile.TemporaryFile()
+    sender = subprocess.Popen(send_cmd, stdout=subprocess.PIPE,
+                              stderr=send_err, close_fds=True)
+    receiver = subprocess.Popen(receive_cmd, stdin=sender.stdout,
+                                stderr=receive_err, close_fds=True)
+    sender.stdout.close()
+    try:
+        for proc, cmd, err in ((receiver, receive_cmd, receive_err),
+                               (sender, send_cmd, send_err)):
+            exit_code = proc.wait()
+            if exit_code != 0:
+                err.seek(0)
+                raise exception.NovaException(
+                    _('%(cmd)s failed with %(code)s: %(err)s') %
+                    {'cmd': ' '.join(cmd), 'code': exit_code,
+                     'err': err.read()})
+    finally:
+        for proc in (sender, receiver):
+            if proc.poll() is None:
+                proc.kill()
+                proc.wait()
+        send_err.close()
+        receive_err.close()
+
+
+class MigrationOps(object):
+    def __init__(self, containers):
+        self.containers = containers
+
+    def pre_live_migration(self, context, instance, network_info):
+        """Prepare the destination to receive a container."""
+        fileutils.ensure_tree(get_migration_dir(instance))
+        self.containers.start_network(instance, network_info)
+
+    def live_migration(self, context, instance, dest, post_method,
+                       recover_method, block_migration=False,
+                       migrate_data=None):
+        migration_dir = get_migration_dir(instance)
+        base = os.path.join(migration_dir, 'rootfs.0')
+        final = os.path.join(migration_dir, 'rootfs.1')
+        checkpoint = container_utils.get_container_checkpoint(instance)
+        checkpointed = False
+        try:
+            fileutils.ensure_tree(migration_dir)
+            # bulk copy while the container is running
+            self._snapshot_rootfs(instance, base)
+            self._send_subvolume(dest, base, migration_dir)
+
+            self.containers.checkpoint_container(instance)
+            checkpointed = True
+            self._snapshot_rootfs(instance, final)
+            self._send_subvolume(dest, final, migration_dir, parent=base)
+            self._send_checkpoint(dest, checkpoint)
+            container_utils.execute('rm', '-rf', checkpoint,
+                                    run_as_root=True)
+        except Exception:
+            with excutils.save_and_reraise_exception():
+                LOG.exception(_('Live migration to %s failed'), dest,
+                              instance=instance)
+                if checkpointed:
+                    self.containers.restore_container(instance)
+                recover_method(context, instance, dest, block_migration,
+                               migrate_data)
+        finally:
+            self._delete_migration_dir(migration_dir)
+
+        post_method(context, instance, dest, block_migration, migrate_data)
+
+    def post_live_migration_at_destination(self, context, instance,
+                                           network_info):
+        """Build the container from what was received and restore it."""
+        migration_dir = get_migration_dir(instance)
+        container_utils.execute('btrfs', 'subvolume', 'snapshot',
+                                os.path.join(migration_dir, 'rootfs.1'),
+                                container_utils.get_container_rootfs(
+                                    instance),
+                                run_as_root=True)
+        self._delete_migration_dir(migration_dir)
+
+        container = lxc.Container(instance['uuid'])
+        container.set_config_path(CONF.instances_path)
+        image_meta = utils.get_image_from_system_metadata(
+            instance['system_metadata'])
+        placement = self.containers.numa.place(
+            instance, container_utils.get_flavor(instance))
+        config.LXCConfig(container, instance, image_meta, network_info,
+                         self.containers.idmap, placement).get_config()
+        self.containers.restore_container(instance)
+
+    def rollback_live_migration_at_destination(self, context, instance,
+                                               network_info):
+        self.containers.teardown_network(instance, network_info)
+        self._delete_migration_dir(get_migration_dir(instance))
+        container_utils.execute('rm', '-rf',
+                                container_utils.get_container_checkpoint(
+                                    instance),
+                                run_as_root=True)
+
+    def _snapshot_rootfs(self, instance, snapshot):
+        container_utils.execute('btrfs', 'subvolume', 'snapshot', '-r',
+                                container_utils.get_container_rootfs(
+                                    instance),
+                                snapshot, run_as_root=True)
+
+    def _send_subvolume(self, dest, subvolume, target_dir, parent=None):
+        send_cmd = _get_root_helper() + ['btrfs', 'send']
+        if parent:
+            send_cmd += ['-p', parent]
+        send_cmd.append(subvolume)
+        receive_cmd = (['ssh', dest] + _get_root_helper() +
+                       ['btrfs', 'receive', target_dir])
+        _pipe(send_cmd, receive_cmd)
+
+    def _send_checkpoint(self, dest, checkpoint):
+        send_cmd = _get_root_helper() + ['tar', '--directory', checkpoint,
+                                         '-cf', '-', '.']
+        receive_cmd = (['ssh', dest, 'mkdir', '-p', checkpoint, '&&'] +
+                       _get_root_helper() +
+                       ['tar', '--directory', checkpoint, '-xpf', '-'])
+        _pipe(send_cmd, receive_cmd)
+
+    def _delete_migration_dir(self, migration_dir):
+        if not os.path.isdir(migration_dir):
+            return
+        for name in os.listdir(migration_dir):
+            images.delete_image_dir(os.path.join(migration_dir, name))
+        os.rmdir(migration_dir)
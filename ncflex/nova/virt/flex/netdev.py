@@ -0,0 +1,221 @@
+# Copyright (c) 2014 Canonical Ltd
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Backends managing the linux bridges and veth pairs of hybrid OVS VIFs.
+
+ExecNetDev drives ip, brctl and tee through rootwrap. NetlinkNetDev
+talks rtnetlink over one long lived socket instead, which turns each
+operation into a syscall rather than a sudo+rootwrap fork/exec; it has
+to run with CAP_NET_ADMIN and needs pyroute2. PrivHelperNetDev runs
+NetlinkNetDev inside flex-priv-helper for unprivileged nova-compute.
+"""
+
+import errno
+import os
+
+from eventlet import semaphore
+
+from . import privhelper
+from . import utils as container_utils
+from nova import exception
+from nova.openstack.common.gettextutils import _
+from nova.openstack.common import importutils
+from nova.openstack.common import log as logging
+
+pyroute2 = importutils.try_import('pyroute2')
+
+LOG = logging.getLogger(__name__)
+
+# sysfs attributes of the per-VIF hybrid bridges, all set to 0:
+# no forwarding delay, no spanning tree, no multicast snooping.
+HYBRID_BRIDGE_ATTRS = ('forward_delay', 'stp_state', 'multicast_snooping')
+
+IFF_UP = 0x1
+IFF_PROMISC = 0x100
+
+
+def device_exists(device):
+    return os.path.exists('/sys/class/net/%s' % device)
+
+
+def get_bridge_attr_paths(br_names):
+    return ['/sys/class/net/%s/bridge/%s' % (br_name, attr)
+            for br_name in br_names for attr in HYBRID_BRIDGE_ATTRS]
+
+
+def set_bridge_attrs(br_names):
+    """Set the HYBRID_BRIDGE_ATTRS of bridges to 0.
+
+    The sysfs files are only writable by root, so they are written
+    directly when running as root, e.g. in flex-priv-helper, and with a
+    privileged tee otherwise. Attributes missing from the kernel are
+    skipped, any other failure is logged.
+    """
+    paths = get_bridge_attr_paths(br_names)
+    if not paths:
+        return
+    if os.geteuid() != 0:
+        out, err = container_utils.execute('tee', *paths, process_input='0',
+                                           run_as_root=True,
+                                           check_exit_code=[0, 1])
+        # tee reports each file it failed to write on its own line
+        for line in (err or '').splitlines():
+            if os.strerror(errno.ENOENT) not in line:
+                LOG.warn(_('Failed to set bridge attribute: %s'), line)
+        return
+
+    for path in paths:
+        try:
+            with open(path, 'w') as fp:
+                fp.write('0')
+        except (IOError, OSError) as e:
+            if e.errno == errno.ENOENT:
+                LOG.debug('Bridge attribute %s does not exist', path)
+            else:
+                LOG.warn(_('Failed to set bridge attribute %(path)s: '
+                           '%(error)s'), {'path': path, 'error': e})
+
+
+class ExecNetDev(object):
+    def device_exists(self, device):
+        return device_exists(device)
+
+    def ensure_hybrid_bridges(self, pairs, mtu=None):
+        """Create the bridges and veth pairs of hybrid VIFs.
+
+        pairs is a list of (bridge, bridge side veth, OVS side veth).
+        Everything missing is created with a single ip -batch and a
+        single tee. Returns the OVS side veths that were created.
+        """
+        ip_cmds = []
+        new_bridges = []
+        created = []
+        for br_name, v1_name, v2_name in pairs:
+            if not device_exists(br_name):
+                ip_cmds.append('link add %s type bridge' % br_name)
+                new_bridges.append(br_name)
+
+            if not device_exists(v2_name):
+                if device_exists(v1_name):
+                    # stale half of a previous pair
+                    ip_cmds.append('link delete %s' % v1_name)
+                ip_cmds.append('link add %s type veth peer name %s'
+                               % (v1_name, v2_name))
+                for dev in (v1_name, v2_name):
+                    if mtu:
+                        ip_cmds.append('link set %s mtu %s' % (dev, mtu))
+                    ip_cmds.append('link set %s up' % dev)
+                    ip_cmds.append('link set %s promisc on' % dev)
+                ip_cmds.append('link set %s up' % br_name)
+                ip_cmds.append('link set %s master %s' % (v1_name, br_name))
+                created.append(v2_name)
+
+        if ip_cmds:
+            container_utils.execute('ip', '-batch', '-',
+                                    process_input='\n'.join(ip_cmds) + '\n',
+                                    run_as_root=True)
+        set_bridge_attrs(new_bridges)
+        return created
+
+    def remove_hybrid_bridge(self, br_name, v1_name):
+        if device_exists(br_name):
+            container_utils.execute('brctl', 'delif', br_name, v1_name,
+                                    run_as_root=True)
+            container_utils.execute('ip', 'link', 'set', br_name, 'down',
+                                    run_as_root=True)
+            container_utils.execute('brctl', 'delbr', br_name,
+                                    run_as_root=True)
+
+
+class NetlinkNetDev(object):
+    def __init__(self):
+        if pyroute2 is None:
+            raise exception.NovaException(
+                _('pyroute2 is required by the netlink backend'))
+        self._ipr = pyroute2.IPRoute()
+        # the netlink socket is shared, one request at a time
+        self._lock = semaphore.Semaphore()
+
+    def _index(self, device):
+        indexes = self._ipr.link_lookup(ifname=device)
+        if indexes:
+            return indexes[0]
+        return None
+
+    def device_exists(self, device):
+        return device_exists(device)
+
+    def ensure_hybrid_bridges(self, pairs, mtu=None):
+        created = []
+        with self._lock:
+            for br_name, v1_name, v2_name in pairs:
+                br_index = self._index(br_name)
+                if br_index is None:
+                    self._ipr.link('add', ifname=br_name, kind='bridge')
+                    br_index = self._index(br_name)
+                    set_bridge_attrs([br_name])
+
+                if self._index(v2_name) is not None:
+                    continue
+
+                v1_index = self._index(v1_name)
+                if v1_index is not None:
+                    # stale half of a previous pair
+                    self._ipr.link('del', index=v1_index)
+                self._ipr.link('add', ifname=v1_name, kind='veth',
+                               peer=v2_name)
+                for dev in (v1_name, v2_name):
+                    index = self._index(dev)
+                    if mtu:
+                        self._ipr.link('set', index=index, mtu=int(mtu))
+                    self._ipr.link('set', index=index,
+                                   flags=IFF_UP | IFF_PROMISC,
+                                   change=IFF_UP | IFF_PROMISC)
+                self._ipr.link('set', index=br_index, state='up')
+                self._ipr.link('set', index=self._index(v1_name),
+                               master=br_index)
+                created.append(v2_name)
+        return created
+
+    def remove_hybrid_bridge(self, br_name, v1_name):
+        with self._lock:
+            br_index = self._index(br_name)
+            if br_index is None:
+                return
+            v1_index = self._index(v1_name)
+            if v1_index is not None:
+                self._ipr.link('set', index=v1_index, master=0)
+            self._ipr.link('set', index=br_index, state='down')
+            self._ipr.link('del', index=br_index)
+
+
+class PrivHelperNetDev(object):
+    """Netlink backend hosted in the privileged helper.
+
+    nova-compute does not have CAP_NET_ADMIN, so the netlink socket is
+    held by flex-priv-helper and the operations are forwarded to it.
+    """
+
+    def device_exists(self, device):
+        return device_exists(device)
+
+    def ensure_hybrid_bridges(self, pairs, mtu=None):
+        return privhelper.get_client().call(
+            'netdev_ensure_hybrid_bridges',
+            pairs=[list(pair) for pair in pairs], mtu=mtu)
+
+    def remove_hybrid_bridge(self, br_name, v1_name):
+        privhelper.get_client().call('netdev_remove_hybrid_bridge',
+                                     br_name=br_name, v1_name=v1_name)
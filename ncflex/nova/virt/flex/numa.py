@@ -0,0 +1,166 @@
+# Copyright (c) 2014 Canonical Ltd
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+NUMA topology discovery and placement of containers on NUMA nodes.
+
+A container whose flavor fits in a single node is bound to the cpus and
+memory of the node with the most memory left, so that its memory stays
+local to the cpus it runs on.
+"""
+
+import os
+import re
+
+import lxc
+from oslo.config import cfg
+from oslo.utils import units
+
+from . import cgroups
+from nova.openstack.common.gettextutils import _  # noqa
+from nova.openstack.common import log as logging
+
+numa_opts = [
+    cfg.BoolOpt('numa_placement',
+                default=True,
+                help='Bind containers that fit in one NUMA node to the cpus '
+                     'and memory of the least loaded node. Flavors with '
+                     'flex:cpuset or flex:cpuset_mems are left alone.'),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(numa_opts, 'lxc')
+
+LOG = logging.getLogger(__name__)
+
+NODE_DIR = '/sys/devices/system/node'
+NODE_RE = re.compile(r'^node(\d+)$')
+MEMTOTAL_RE = re.compile(r'MemTotal:\s+(\d+) kB')
+
+
+def _read(path):
+    try:
+        with open(path, 'r') as fp:
+            return fp.read()
+    except (IOError, OSError):
+        return ''
+
+
+def get_host_topology(node_dir=NODE_DIR):
+    """Return the NUMA cells of the host, sorted by id.
+
+    Each cell is a dict with its 'id', its 'cpus' and its 'memory_mb'.
+    Hosts without NUMA support have no cells.
+    """
+    cells = []
+    if not os.path.isdir(node_dir):
+        return cells
+    for name in os.listdir(node_dir):
+        match = NODE_RE.match(name)
+        if match is None:
+            continue
+        path = os.path.join(node_dir, name)
+        memory = MEMTOTAL_RE.search(_read(os.path.join(path, 'meminfo')))
+        cells.append({
+            'id': int(match.group(1)),
+            'cpus': sorted(cgroups.parse_cpuset(
+                _read(os.path.join(path, 'cpulist')))),
+            'memory_mb': int(memory.group(1)) // units.Ki if memory else 0})
+    return sorted(cells, key=lambda cell: cell['id'])
+
+
+class NUMAPlacement(object):
+    """Choose the NUMA node of containers at spawn time.
+
+    The allocations are rebuilt from the cgroups of the running
+    containers the first time a container is placed and then kept up to
+    date by place() and release().
+    """
+
+    def __init__(self):
+        self.cells = None
+        # instance uuid -> (cell id, memory_mb, vcpus)
+        self._allocations = {}
+
+    def _load(self):
+        self.cells = get_host_topology()
+        self._allocations = {}
+        if len(self.cells) < 2:
+            return
+
+        running = lxc.list_containers(active=True, defined=False,
+                                      config_path=CONF.instances_path)
+        for name, path in cgroups.find_container_cgroups(running).items():
+            mems = cgroups.parse_cpuset(
+                cgroups.read_cgroup_item('cpuset', path, 'cpuset.mems'))
+            if len(mems) != 1:
+                continue
+            # the cpuset spans the whole node, the flavor's vcpus are
+            # recovered from cpu.shares, 1024 per vcpu
+            shares = cgroups.read_cgroup_int('cpu', path, 'cpu.shares')
+            memory = cgroups.read_cgroup_int('memory', path,
+                                             'memory.limit_in_bytes')
+            self._allocations[name] = (mems.pop(), memory // units.Mi,
+                                       int(round(shares / 1024.0)))
+
+    def get_usage(self):
+        """Return the memory_mb and vcpus allocated on each cell."""
+        if self.cells is None:
+            self._load()
+        usage = dict((cell['id'], {'memory_mb': 0, 'vcpus': 0})
+                     for cell in self.cells or [])
+        for cell_id, memory_mb, vcpus in self._allocations.values():
+            if cell_id in usage:
+                usage[cell_id]['memory_mb'] += memory_mb
+                usage[cell_id]['vcpus'] += vcpus
+        return usage
+
+    def place(self, instance, flavor):
+        """Return the (cpus, mems) cpusets of a new container, or None.
+
+        None is returned when the container is not to be bound, i.e. on
+        hosts with a single node, for flavors pinned with extra_specs
+        and for flavors that do not fit in any node.
+        """
+        if not CONF.lxc.numa_placement:
+            return None
+        if ('flex:cpuset' in flavor.extra_specs or
+                'flex:cpuset_mems' in flavor.extra_specs):
+            return None
+        if self.cells is None:
+            self._load()
+        if len(self.cells) < 2:
+            return None
+
+        usage = self.get_usage()
+        candidates = [cell for cell in self.cells
+                      if len(cell['cpus']) >= instance['vcpus'] and
+                      cell['memory_mb'] - usage[cell['id']]['memory_mb'] >=
+                      flavor.memory_mb]
+        if not candidates:
+            LOG.debug('Instance %s does not fit in a NUMA node',
+                      instance['uuid'])
+            return None
+
+        cell = max(candidates, key=lambda cell: (
+            cell['memory_mb'] - usage[cell['id']]['memory_mb'],
+            len(cell['cpus']) - usage[cell['id']]['vcpus']))
+        self._allocations[instance['uuid']] = (cell['id'], flavor.memory_mb,
+                                               instance['vcpus'])
+        LOG.info(_('Placing container on NUMA node %d'), cell['id'],
+                 instance=instance)
+        return (cgroups.format_cpuset(cell['cpus']), str(cell['id']))
+
+    def release(self, instance):
+        self._allocations.pop(instance['uuid'], None)
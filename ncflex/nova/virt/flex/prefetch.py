@@ -0,0 +1,90 @@
+# Copyright (c) 2014 Canonical Ltd
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Populate the image cache ahead of time.
+
+A spawn from a cached image only pays for the btrfs snapshot of the
+base subvolume, so images expected to be booted in bulk can be pulled
+and extracted beforehand, either through LXCDriver.prefetch_images or
+with the flex-image-prefetch command on the compute node.
+"""
+
+import eventlet
+from oslo.config import cfg
+from oslo.utils import units
+
+from . import images
+from . import utils as container_utils
+from nova.image import glance
+from nova.openstack.common.gettextutils import _  # noqa
+from nova.openstack.common import log as logging
+
+prefetch_opts = [
+    cfg.IntOpt('image_prefetch_concurrency',
+               default=4,
+               help='Number of images fetched in parallel when '
+                    'prefetching images'),
+    cfg.IntOpt('image_prefetch_max_bandwidth',
+               default=0,
+               help='Aggregate download rate limit in KiB/s when '
+                    'prefetching images, 0 for unlimited. Only applies '
+                    'when stream_images is enabled.'),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(prefetch_opts, 'lxc')
+CONF.import_opt('instances_path', 'nova.compute.manager')
+CONF.import_opt('image_cache_subdirectory_name', 'nova.virt.imagecache')
+
+LOG = logging.getLogger(__name__)
+
+
+def prefetch_images(context, image_refs, idmap, concurrency=None,
+                    bandwidth=None):
+    """Fetch and extract images into the image cache.
+
+    Returns a dict of image_ref to None on success or the error message.
+    bandwidth is in KiB/s and shared by all the downloads.
+    """
+    if concurrency is None:
+        concurrency = CONF.lxc.image_prefetch_concurrency
+    if bandwidth is None:
+        bandwidth = CONF.lxc.image_prefetch_max_bandwidth
+    throttle = images.BandwidthThrottle(bandwidth * units.Ki)
+
+    def _prefetch(image_ref):
+        LOG.info(_('Prefetching image %s'), image_ref)
+        try:
+            image_service, image_id = glance.get_remote_image_service(
+                context, image_ref)
+            image_meta = image_service.show(context, image_id)
+            disk_format = container_utils.get_disk_format(image_meta)
+            if disk_format != 'root-tar':
+                return (image_ref,
+                        _('unsupported disk format %s') % disk_format)
+
+            image = {'image_ref': image_ref,
+                     'user_id': context.user_id,
+                     'project_id': context.project_id}
+            images.fetch_image(context, image, image_meta,
+                               '%s.tar.gz' % image_ref, idmap, None,
+                               throttle)
+        except Exception as ex:
+            LOG.exception(_('Failed to prefetch image %s'), image_ref)
+            return (image_ref, str(ex))
+        return (image_ref, None)
+
+    pool = eventlet.GreenPool(max(concurrency, 1))
+    return dict(pool.imap(_prefetch, image_refs))
@@ -0,0 +1,409 @@
+# Copyright (c) 2014 Canonical Ltd
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Long running privileged helper for the flex driver.
+
+Every utils.execute(..., run_as_root=True) pays for sudo and a
+nova-rootwrap python interpreter. With CONF.lxc.use_priv_helper the
+driver instead starts flex-priv-helper once through rootwrap and sends
+its privileged commands to it over a unix socket.
+
+The helper only runs the commands allowed by the flex rootwrap
+filters file, matched with rootwrap's own filters, and only answers to
+the configured owner. Its settings are read from a root owned file and
+never taken from the command line, so that whoever may start it
+through rootwrap cannot change them. Privileged containers are driven
+in the helper through the lxc.Container API rather than with lxc-*
+commands.
+Requests and replies are JSON documents, one per line:
+
+  {"method": "execute", "kwargs": {"cmd": ["lxc-stop", ...]}}
+  {"result": {"exit_code": 0, "stdout": "", "stderr": ""}}
+  {"error": {"type": "PermissionError", "message": "..."}}
+"""
+
+import argparse
+import json
+import logging as std_logging
+import os
+import pwd
+import random
+import socket
+import stat
+import struct
+import subprocess
+import threading
+import time
+
+from oslo.config import cfg
+from oslo.rootwrap import wrapper
+from six.moves import configparser
+from six.moves import socketserver
+
+from nova.openstack.common.gettextutils import _
+from nova.openstack.common import importutils
+from nova.openstack.common import lockutils
+from nova.openstack.common import log as logging
+from nova.openstack.common import processutils
+from nova import utils
+
+# the helper only trusts root owned files and directories, nothing it is
+# started with: its configuration, with the privhelper_opts and
+# instances_path, and the directory of its socket
+HELPER_CONFIG = '/etc/nova/flex-priv-helper.conf'
+SOCKET_DIR = '/var/run/flex-priv-helper'
+SOCKET_PATH = os.path.join(SOCKET_DIR, 'helper.sock')
+
+privhelper_opts = [
+    cfg.BoolOpt('use_priv_helper',
+                default=False,
+                help='Run privileged commands through the long running '
+                     'flex-priv-helper instead of one rootwrap process each'),
+    cfg.StrOpt('priv_helper_owner',
+               default='nova',
+               help='User allowed to talk to the privileged helper. Only '
+                    'read by the helper, from %s' % HELPER_CONFIG),
+    cfg.StrOpt('priv_helper_filters',
+               default='/etc/nova/rootwrap.d/flex.filters',
+               help='rootwrap filters file listing the commands the '
+                    'privileged helper may run. Only read by the helper, '
+                    'from %s' % HELPER_CONFIG),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(privhelper_opts, 'lxc')
+CONF.import_opt('instances_path', 'nova.compute.manager')
+
+LOG = logging.getLogger(__name__)
+
+lxc = importutils.try_import('lxc')
+
+SO_PEERCRED = getattr(socket, 'SO_PEERCRED', 17)
+
+# where the executables of filters without an absolute path are looked
+# up, the exec_dirs of nova's rootwrap.conf
+EXEC_DIRS = ('/sbin', '/usr/sbin', '/bin', '/usr/bin', '/usr/local/bin',
+             '/usr/local/sbin')
+
+# lxc.Container methods privileged containers may be driven with
+CONTAINER_OPS = ('start', 'stop', 'shutdown', 'reboot', 'freeze',
+                 'unfreeze', 'destroy', 'wait', 'state', 'init_pid',
+                 'set_cgroup_item', 'checkpoint', 'restore')
+
+
+class PrivHelperError(Exception):
+    pass
+
+
+def _check_root_owned(path):
+    """Refuse a file or directory that anyone but root may change."""
+    st = os.lstat(path)
+    if (stat.S_ISLNK(st.st_mode) or st.st_uid != 0 or
+            st.st_mode & (stat.S_IWGRP | stat.S_IWOTH)):
+        raise PrivHelperError(_('%s must be owned and only writable by '
+                                'root') % path)
+
+
+def load_filters(filters_file):
+    """Return the rootwrap filters of a filters file.
+
+    Unknown filter classes are skipped, as rootwrap does, and so are the
+    filters of the helper itself: the helper never starts another one.
+    """
+    parser = configparser.RawConfigParser()
+    parser.read(filters_file)
+    filter_list = []
+    if not parser.has_section('Filters'):
+        return filter_list
+    for name, value in parser.items('Filters'):
+        definition = [arg.strip() for arg in value.split(',')]
+        new_filter = wrapper.build_filter(*definition)
+        if (new_filter is None or
+                os.path.basename(new_filter.exec_path) == 'flex-priv-helper'):
+            continue
+        new_filter.name = name
+        filter_list.append(new_filter)
+    return filter_list
+
+
+class PrivHelper(object):
+    """The RPC surface of the helper, run as root."""
+
+    def __init__(self, filter_list, instances_path, exec_dirs=EXEC_DIRS):
+        self.filters = filter_list
+        self.instances_path = os.path.realpath(instances_path)
+        self.exec_dirs = list(exec_dirs)
+        self.lock = threading.Lock()
+        self._netdev = None
+
+    def _resolve(self, cmd):
+        """Return the command, user and environment a command runs with.
+
+        The command is matched against the filters as rootwrap would, so
+        it is called by the name of its executable. An absolute path is
+        only accepted if it is exactly the executable that name resolves
+        to.
+        """
+        if not cmd:
+            raise PrivHelperError(_('Command not allowed: %s') % cmd)
+        userargs = list(cmd)
+        if os.path.isabs(userargs[0]):
+            userargs[0] = os.path.basename(userargs[0])
+        try:
+            match = wrapper.match_filter(self.filters, userargs,
+                                         self.exec_dirs)
+        except (wrapper.NoFilterMatched, wrapper.FilterMatchNotExecutable):
+            raise PrivHelperError(_('Command not allowed: %s') % cmd)
+        if userargs[0] != cmd[0] and match.get_exec(self.exec_dirs) != cmd[0]:
+            raise PrivHelperError(_('Command not allowed: %s') % cmd)
+        command = match.get_command(userargs, self.exec_dirs)
+        if match.run_as != 'root':
+            # rootwrap switches users with sudo -u, the helper does it
+            command = command[3:]
+        return command, match.run_as, match.get_environment(userargs)
+
+    def execute(self, cmd, process_input=None):
+        command, run_as, env = self._resolve(cmd)
+        preexec_fn = None
+        user = pwd.getpwnam(run_as)
+        if user.pw_uid != os.getuid():
+            def preexec_fn():
+                os.setgroups([])
+                os.setgid(user.pw_gid)
+                os.setuid(user.pw_uid)
+        proc = subprocess.Popen(command,
+                                stdin=subprocess.PIPE,
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE, close_fds=True,
+                                preexec_fn=preexec_fn, env=env)
+        if process_input is not None:
+            process_input = process_input.encode('utf-8')
+        stdout, stderr = proc.communicate(process_input)
+        return {'exit_code': proc.returncode,
+                'stdout': stdout.decode('utf-8', 'replace'),
+                'stderr': stderr.decode('utf-8', 'replace')}
+
+    def _get_netdev(self):
+        if self._netdev is None:
+            from ncflex.nova.virt.flex import netdev
+            self._netdev = netdev.NetlinkNetDev()
+        return self._netdev
+
+    def netdev_ensure_hybrid_bridges(self, pairs, mtu=None):
+        with self.lock:
+            return self._get_netdev().ensure_hybrid_bridges(
+                [tuple(pair) for pair in pairs], mtu)
+
+    def netdev_remove_hybrid_bridge(self, br_name, v1_name):
+        with self.lock:
+            return self._get_netdev().remove_hybrid_bridge(br_name, v1_name)
+
+    def usernet_update(self, ops):
+        """Apply a batch of operations to /etc/lxc/lxc-usernet."""
+        from ncflex.nova.virt.flex import lxc_usernet
+        with self.lock:
+            lxc_usernet.batch_update([tuple(op) for op in ops])
+
+    def container_op(self, name, config_path, op, args=None):
+        """Call a lxc.Container method on a privileged container."""
+        if op not in CONTAINER_OPS:
+            raise PrivHelperError(_('Container operation not allowed: %s')
+                                  % op)
+        # lxc reads <config_path>/<name>/config, only the containers of
+        # the instances may be driven
+        if (os.path.realpath(config_path) != self.instances_path or
+                name in ('', '.', '..') or os.sep in name):
+            raise PrivHelperError(_('Container not allowed: %(path)s '
+                                    '%(name)s') % {'path': config_path,
+                                                   'name': name})
+        if lxc is None:
+            raise PrivHelperError(_('python-lxc is not installed'))
+        container = lxc.Container(name, config_path)
+        if op in ('state', 'init_pid'):
+            return getattr(container, op)
+        if op == 'start':
+            # the container must not inherit the helper's sockets
+            return container.start(close_fds=True)
+        if op == 'destroy' and container.running:
+            container.stop()
+        return getattr(container, op)(*(args or []))
+
+    def dispatch(self, request):
+        method = request.get('method', '')
+        if method.startswith('_') or method == 'dispatch':
+            raise PrivHelperError(_('Unknown method %s') % method)
+        function = getattr(self, method, None)
+        if not callable(function):
+            raise PrivHelperError(_('Unknown method %s') % method)
+        return function(**request.get('kwargs', {}))
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        creds = self.request.getsockopt(socket.SOL_SOCKET, SO_PEERCRED,
+                                        struct.calcsize('3i'))
+        pid, uid, gid = struct.unpack('3i', creds)
+        if uid not in (0, self.server.owner):
+            return
+
+        for line in self.rfile:
+            try:
+                reply = {'result': self.server.helper.dispatch(
+                    json.loads(line.decode('utf-8')))}
+            except Exception as ex:
+                reply = {'error': {'type': ex.__class__.__name__,
+                                   'message': str(ex)}}
+            self.wfile.write((json.dumps(reply) + '\n').encode('utf-8'))
+            self.wfile.flush()
+
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Privileged helper of the flex nova driver, '
+                    'configured by %s' % HELPER_CONFIG)
+    parser.add_argument('--foreground', action='store_true')
+    args = parser.parse_args()
+
+    _check_root_owned(HELPER_CONFIG)
+    CONF([], project='nova', default_config_files=[HELPER_CONFIG])
+    _check_root_owned(CONF.lxc.priv_helper_filters)
+    owner = pwd.getpwnam(CONF.lxc.priv_helper_owner)
+
+    # the owner cannot replace the socket by a link to another file
+    # between its creation and the chown in a directory of root's
+    if not os.path.isdir(SOCKET_DIR):
+        os.mkdir(SOCKET_DIR)
+        os.chmod(SOCKET_DIR, 0o755)
+    _check_root_owned(SOCKET_DIR)
+    if os.path.lexists(SOCKET_PATH):
+        os.unlink(SOCKET_PATH)
+    server = _Server(SOCKET_PATH, _RequestHandler)
+    os.chown(SOCKET_PATH, owner.pw_uid, owner.pw_gid)
+    os.chmod(SOCKET_PATH, 0o600)
+    server.owner = owner.pw_uid
+    server.helper = PrivHelper(load_filters(CONF.lxc.priv_helper_filters),
+                               CONF.instances_path)
+
+    # the socket is ready, the parent returns so that the caller knows
+    if not args.foreground:
+        if os.fork():
+            os._exit(0)
+        os.setsid()
+        devnull = os.open(os.devnull, os.O_RDWR)
+        for fd in (0, 1, 2):
+            os.dup2(devnull, fd)
+    server.serve_forever()
+    return 0
+
+
+class PrivHelperClient(object):
+    def __init__(self, socket_path=SOCKET_PATH):
+        self.socket_path = socket_path
+
+    def start(self):
+        LOG.info(_('Starting the privileged helper on %s'), self.socket_path)
+        utils.execute('flex-priv-helper', run_as_root=True)
+
+    def _open(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self.socket_path)
+        except socket.error:
+            sock.close()
+            raise
+        return sock
+
+    def _connect(self):
+        try:
+            return self._open()
+        except socket.error:
+            with lockutils.lock('flex-priv-helper'):
+                try:
+                    return self._open()
+                except socket.error:
+                    self.start()
+            return self._open()
+
+    def call(self, method, **kwargs):
+        sock = self._connect()
+        try:
+            fp = sock.makefile('rwb')
+            fp.write((json.dumps({'method': method, 'kwargs': kwargs}) +
+                      '\n').encode('utf-8'))
+            fp.flush()
+            line = fp.readline()
+            fp.close()
+        finally:
+            sock.close()
+        if not line:
+            raise PrivHelperError(_('No reply from the privileged helper'))
+        reply = json.loads(line.decode('utf-8'))
+        if 'error' in reply:
+            raise PrivHelperError('%(type)s: %(message)s' % reply['error'])
+        return reply['result']
+
+    def execute(self, *cmd, **kwargs):
+        """Run a command as root, with the semantics of utils.execute.
+
+        Only process_input, check_exit_code, attempts, delay_on_retry and
+        loglevel are supported, TypeError is raised for anything else
+        rather than silently running the command differently.
+        """
+        process_input = kwargs.pop('process_input', None)
+        check_exit_code = kwargs.pop('check_exit_code', [0])
+        attempts = kwargs.pop('attempts', 1)
+        delay_on_retry = kwargs.pop('delay_on_retry', True)
+        loglevel = kwargs.pop('loglevel', std_logging.DEBUG)
+        if kwargs:
+            raise TypeError(_('Arguments not supported by the privileged '
+                              'helper: %s') % ', '.join(sorted(kwargs)))
+        if isinstance(check_exit_code, bool):
+            ignore_exit_code = not check_exit_code
+            check_exit_code = [0]
+        else:
+            ignore_exit_code = False
+            if isinstance(check_exit_code, int):
+                check_exit_code = [check_exit_code]
+
+        cmd = [str(arg) for arg in cmd]
+        while True:
+            attempts -= 1
+            LOG.log(loglevel, 'Running cmd (privhelper): %s', ' '.join(cmd))
+            result = self.call('execute', cmd=cmd,
+                               process_input=process_input)
+            if (ignore_exit_code or
+                    result['exit_code'] in check_exit_code):
+                return (result['stdout'], result['stderr'])
+            if attempts <= 0:
+                raise processutils.ProcessExecutionError(
+                    exit_code=result['exit_code'], stdout=result['stdout'],
+                    stderr=result['stderr'], cmd=' '.join(cmd))
+            LOG.log(loglevel, '%r failed. Retrying.', ' '.join(cmd))
+            if delay_on_retry:
+                time.sleep(random.randint(20, 200) / 100.0)
+
+
+_CLIENT = None
+
+
+def get_client():
+    global _CLIENT
+    if _CLIENT is None:
+        _CLIENT = PrivHelperClient()
+    return _CLIENT
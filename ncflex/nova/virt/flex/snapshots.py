@@ -0,0 +1,169 @@
+# Copyright (c) 2014 Canonical Ltd
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Snapshot container root filesystems to glance.
+
+The root filesystem of a container is a btrfs subvolume, so a read only
+snapshot of it is taken instantly and stays consistent while it is
+uploaded. The snapshot is streamed to glance as a compressed root-tar by
+tar, nothing is staged on disk, and it is deleted once the upload is
+over.
+"""
+
+import os
+import shlex
+import tempfile
+
+from eventlet.green import subprocess
+from oslo.config import cfg
+
+from . import images
+from . import utils as container_utils
+from nova.compute import task_states
+from nova.image import glance
+from nova.openstack.common import excutils
+from nova.openstack.common import fileutils
+from nova.openstack.common.gettextutils import _  # noqa
+from nova.openstack.common import log as logging
+from nova.openstack.common import processutils
+from nova import utils
+
+snapshot_opts = [
+    cfg.BoolOpt('snapshot_seed_image_cache',
+                default=False,
+                help='Seed the local image cache with the images taken of '
+                     'unprivileged instances, so that they spawn on this '
+                     'host without being downloaded'),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(snapshot_opts, 'lxc')
+CONF.import_opt('image_cache_subdirectory_name', 'nova.virt.imagecache')
+
+LOG = logging.getLogger(__name__)
+
+
+def get_snapshot_dir(instance):
+    return os.path.join(container_utils.get_instance_path(instance),
+                        'snapshots')
+
+
+def snapshot_container(context, instance, image_id, update_task_state,
+                       idmap):
+    """Snapshot the root filesystem of a container into a glance image."""
+    image_service, image_id = glance.get_remote_image_service(context,
+                                                              image_id)
+    image = image_service.show(context, image_id)
+    metadata = {'is_public': False,
+                'status': 'active',
+                'name': image['name'],
+                'disk_format': 'root-tar',
+                'container_format': 'bare',
+                'properties': {'image_location': 'snapshot',
+                               'image_state': 'available',
+                               'owner_id': instance['project_id']}}
+
+    snapshot_dir = get_snapshot_dir(instance)
+    fileutils.ensure_tree(snapshot_dir)
+    snapshot = os.path.join(snapshot_dir, image_id)
+    lxc_type = container_utils.get_lxc_security_info(instance)
+
+    update_task_state(task_state=task_states.IMAGE_PENDING_UPLOAD)
+    container_utils.execute('btrfs', 'subvolume', 'snapshot', '-r',
+                            container_utils.get_container_rootfs(instance),
+                            snapshot, run_as_root=True)
+    try:
+        update_task_state(task_state=task_states.IMAGE_UPLOADING,
+                          expected_state=task_states.IMAGE_PENDING_UPLOAD)
+        _upload_snapshot(context, image_service, image_id, metadata,
+                         snapshot, lxc_type, idmap)
+        LOG.info(_('Snapshot image upload complete'), instance=instance)
+
+        # unprivileged root filesystems have the ownership of the image
+        # cache, privileged ones were flattened to root
+        if CONF.lxc.snapshot_seed_image_cache and lxc_type == 'unprivileged':
+            _seed_image_cache(snapshot, image_id)
+    finally:
+        delete_snapshots(instance)
+
+
+def delete_snapshots(instance):
+    """Delete the snapshots of an instance and their directory.
+
+    Also removes the snapshots left behind by an interrupted upload.
+    They are btrfs subvolumes, which lxc-destroy does not remove along
+    with the instance directory.
+    """
+    snapshot_dir = get_snapshot_dir(instance)
+    if not os.path.isdir(snapshot_dir):
+        return
+    for name in os.listdir(snapshot_dir):
+        images.delete_image_dir(os.path.join(snapshot_dir, name))
+    try:
+        os.rmdir(snapshot_dir)
+    except OSError as ex:
+        LOG.warn(_('Failed to remove %(dir)s: %(reason)s'),
+                 {'dir': snapshot_dir, 'reason': ex}, instance=instance)
+
+
+def _get_tar_create(snapshot):
+    return ['tar', '--directory', snapshot, '--numeric-owner',
+            '--use-compress-program', images.get_decompressor(),
+            '-cpf', '-', '.']
+
+
+def _upload_snapshot(context, image_service, image_id, metadata, snapshot,
+                     lxc_type, idmap):
+    """Stream a compressed tarball of a snapshot to glance."""
+    if lxc_type == 'unprivileged':
+        cmd = images.get_nsexec(idmap) + _get_tar_create(snapshot)
+    else:
+        # the output is streamed, which the privileged helper cannot do
+        cmd = shlex.split(utils.get_root_helper()) + _get_tar_create(snapshot)
+
+    stderr = tempfile.TemporaryFile()
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=stderr,
+                            close_fds=True)
+    try:
+        image_service.update(context, image_id, metadata, proc.stdout)
+        exit_code = proc.wait()
+        if exit_code != 0:
+            stderr.seek(0)
+            raise processutils.ProcessExecutionError(
+                exit_code=exit_code, stderr=stderr.read(),
+                cmd=' '.join(cmd))
+    except Exception:
+        with excutils.save_and_reraise_exception():
+            if proc.poll() is None:
+                proc.kill()
+                proc.wait()
+    finally:
+        stderr.close()
+
+
+def _seed_image_cache(snapshot, image_id):
+    base_dir = os.path.join(CONF.instances_path,
+                            CONF.image_cache_subdirectory_name)
+    image_dir = os.path.join(base_dir, image_id)
+    with images.image_lock(image_id):
+        if os.path.exists(image_dir):
+            return
+        fileutils.ensure_tree(base_dir)
+        staging = '%s.partial' % image_dir
+        if os.path.exists(staging):
+            images.delete_image_dir(staging)
+        container_utils.execute('btrfs', 'subvolume', 'snapshot', snapshot,
+                                staging, run_as_root=True)
+        os.rename(staging, image_dir)
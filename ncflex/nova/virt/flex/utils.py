@@ -17,11 +17,12 @@ import grp
 import getpass
 import pwd
 import os
-
+import time
 
 from oslo.config import cfg
 from oslo.utils import units
 
+from . import privhelper
 from nova.openstack.common.gettextutils import _  # noqa
 from nova.openstack.common import log as logging
 from nova.openstack.common import lockutils
@@ -31,8 +32,19 @@ from nova import utils
 
 LOG = logging.getLogger(__name__)
 
+flavor_opts = [
+    cfg.IntOpt('flavor_cache_ttl',
+               default=300,
+               help='Number of seconds a flavor looked up for a container '
+                    'is cached before it is fetched again. 0 disables '
+                    'the cache.'),
+]
 
 CONF = cfg.CONF
+CONF.register_opts(flavor_opts, 'lxc')
+
+# instance_type_id -> (timestamp, flavor)
+_FLAVOR_CACHE = {}
 
 
 def get_container_rootfs(instance):
@@ -53,6 +65,15 @@ def get_container_logfile(instance):
                         'container.logfile')
 
 
+def get_container_checkpoint(instance):
+    return os.path.join(CONF.instances_path, instance['uuid'], 'checkpoint')
+
+
+def get_container_soft_limit(instance):
+    return os.path.join(CONF.instances_path, instance['uuid'],
+                        'memory.soft_limit_in_bytes')
+
+
 def get_instance_path(instance):
     return os.path.join(CONF.instances_path, instance['uuid'])
 
@@ -60,10 +81,38 @@ def get_instance_path(instance):
 def get_disk_format(image_meta):
     return image_meta.get('disk_format')
 
-def get_lxc_security_info(instance):
+
+def get_flavor(instance):
+    """Return the flavor of an instance.
+
+    Flavors are cached by instance_type_id for CONF.lxc.flavor_cache_ttl
+    seconds so that a single lifecycle operation does not go back to the
+    conductor every time the flavor or its extra_specs are needed.
+    """
+    instance_type_id = int(instance['instance_type_id'])
+    now = time.time()
+    cached = _FLAVOR_CACHE.get(instance_type_id)
+    if cached is not None and now - cached[0] < CONF.lxc.flavor_cache_ttl:
+        return cached[1]
+
     flavor = objects.Flavor.get_by_id(
         nova_context.get_admin_context(read_deleted='yes'),
-        instance['instance_type_id'])
+        instance_type_id)
+    if CONF.lxc.flavor_cache_ttl > 0:
+        _FLAVOR_CACHE[instance_type_id] = (now, flavor)
+    return flavor
+
+
+def invalidate_flavor_cache(instance_type_id=None):
+    """Drop one cached flavor, or all of them if no id is given."""
+    if instance_type_id is None:
+        _FLAVOR_CACHE.clear()
+    else:
+        _FLAVOR_CACHE.pop(int(instance_type_id), None)
+
+
+def get_lxc_security_info(instance):
+    flavor = get_flavor(instance)
 
     if flavor:
         lxc_status = flavor.extra_specs.get('flex:flex_privileged')
@@ -73,6 +122,15 @@ def get_lxc_security_info(instance):
             return 'privileged'
     return 'unprivileged'
 
+
+def get_boot_priority(instance):
+    """Return the flex:boot_priority of an instance, higher boots first."""
+    flavor = get_flavor(instance)
+    try:
+        return int(flavor.extra_specs.get('flex:boot_priority', 0))
+    except (AttributeError, TypeError, ValueError):
+        return 0
+
 def get_container_mem_info(instance, container):
     try:
         mem = int(container.get_cgroup_item('memory.usage_in_bytes'))
@@ -84,11 +142,31 @@ def get_container_cores(instance):
     return int(instance['vcpus'] * 1024)
 
 
+def execute(*cmd, **kwargs):
+    """utils.execute, sending privileged commands to the helper if enabled."""
+    if kwargs.get('run_as_root') and CONF.lxc.use_priv_helper:
+        kwargs.pop('run_as_root')
+        return privhelper.get_client().execute(*cmd, **kwargs)
+    return utils.execute(*cmd, **kwargs)
+
+
 def write_lxc_usernet(instance, bridge, user=None, count=1):
+    write_lxc_usernet_batch(instance, [bridge], user=user, count=count)
+
+
+def write_lxc_usernet_batch(instance, bridges, user=None, count=1):
+    """Allow user count veths on each bridge in one lxc-usernet update."""
     if user is None:
         user = getpass.getuser()
-    utils.execute('lxc-usernet-manage', 'set', user, bridge, str(count),
-                  run_as_root=True, check_exit_code=[0])
+    ops = [['set', user, bridge, count] for bridge in bridges]
+    if not ops:
+        return
+    if CONF.lxc.use_priv_helper:
+        privhelper.get_client().call('usernet_update', ops=ops)
+        return
+    execute('lxc-usernet-manage', 'batch',
+            process_input=''.join('%s %s %s %s\n' % tuple(op) for op in ops),
+            run_as_root=True, check_exit_code=[0])
 
 
 class LXCIdMap(object):
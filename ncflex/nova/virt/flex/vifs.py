@@ -14,26 +14,97 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import eventlet
 from oslo.config import cfg
 
 from . import utils as container_utils
 
 from nova import exception
-from nova import utils
 from nova.network import manager
 from nova.network import linux_net
 from nova.network import model as network_model
 from nova.openstack.common.gettextutils import _
+from nova.openstack.common import importutils
 from nova.openstack.common import log as logging
+from nova.openstack.common import processutils
+
+vif_opts = [
+    cfg.StrOpt('netdev_driver',
+               default='ncflex.nova.virt.flex.netdev.ExecNetDev',
+               help='Backend creating the bridges and veth pairs of '
+                    'hybrid OVS VIFs'),
+]
 
 CONF = cfg.CONF
+CONF.register_opts(vif_opts, 'lxc')
 CONF.import_opt('vlan_interface', 'nova.manager')
 CONF.import_opt('flat_interface', 'nova.manager')
+CONF.import_opt('network_device_mtu', 'nova.network.linux_net')
+CONF.import_opt('ovs_vsctl_timeout', 'nova.network.linux_net')
 
 LOG = logging.getLogger(__name__)
 
 
 class LXCGenericDriver(object):
+    def __init__(self):
+        self.netdev = importutils.import_object(CONF.lxc.netdev_driver)
+
+    def plug_vifs(self, instance, network_info):
+        """Plug all the VIFs of an instance at once.
+
+        The hybrid OVS VIFs are plugged in one batch: the netdev backend
+        creates every bridge and veth pair in one go and a single
+        ovs-vsctl transaction adds the OVS ports.
+        The remaining VIFs are independent of each other and plugged
+        concurrently, the first failure is raised.
+        """
+        ovs_vifs = [vif for vif in network_info
+                    if vif['type'] == network_model.VIF_TYPE_OVS]
+        other_vifs = [vif for vif in network_info
+                      if vif['type'] != network_model.VIF_TYPE_OVS]
+
+        if ovs_vifs:
+            self.plug_ovs_batch(instance, ovs_vifs)
+        if other_vifs:
+            pool = eventlet.GreenPool()
+            # consumed, so that the first VIF failing to plug is raised
+            for _ in pool.imap(self.plug, [instance] * len(other_vifs),
+                               other_vifs):
+                pass
+
+    def plug_ovs_batch(self, instance, vifs):
+        pairs = []
+        ovs_vifs = {}
+        for vif in vifs:
+            v1_name, v2_name = self.get_veth_pair_names(vif['id'])
+            pairs.append((self.get_br_name(vif['id']), v1_name, v2_name))
+            ovs_vifs[v2_name] = vif
+        created = self.netdev.ensure_hybrid_bridges(
+            pairs, mtu=CONF.network_device_mtu)
+
+        ovs_cmds = []
+        for v2_name in created:
+            ovs_cmds.extend(self.get_ovs_port_cmds(
+                instance, ovs_vifs[v2_name], v2_name))
+        if ovs_cmds:
+            container_utils.execute('ovs-vsctl',
+                                    '--timeout=%s' % CONF.ovs_vsctl_timeout,
+                                    *ovs_cmds, run_as_root=True)
+
+        container_utils.write_lxc_usernet_batch(
+            instance, [self.get_br_name(vif['id']) for vif in vifs])
+
+    def get_ovs_port_cmds(self, instance, vif, dev):
+        """ovs-vsctl commands doing what linux_net.create_ovs_vif_port does."""
+        bridge = self.get_bridge_name(vif)
+        return ['--', '--if-exists', 'del-port', dev,
+                '--', 'add-port', bridge, dev,
+                '--', 'set', 'Interface', dev,
+                'external-ids:iface-id=%s' % self.get_ovs_interfaceid(vif),
+                'external-ids:iface-status=active',
+                'external-ids:attached-mac=%s' % vif['address'],
+                'external-ids:vm-uuid=%s' % instance['uuid']]
+
     def plug(self, instance, vif):
         vif_type = vif['type']
 
@@ -63,30 +134,7 @@ class LXCGenericDriver(object):
         of the veth device just like a normal OVS port.  Then boot the
         VIF on the linux bridge using standard LXC mechanisms.
         """
-        iface_id = self.get_ovs_interfaceid(vif)
-        br_name = self.get_br_name(vif['id'])
-        v1_name, v2_name = self.get_veth_pair_names(vif['id'])
-
-        if not linux_net.device_exists(br_name):
-            utils.execute('brctl', 'addbr', br_name, run_as_root=True)
-            utils.execute('brctl', 'setfd', br_name, 0, run_as_root=True)
-            utils.execute('brctl', 'stp', br_name, 'off', run_as_root=True)
-            utils.execute('tee',
-                          ('/sys/class/net/%s/bridge/multicast_snooping' %
-                           br_name),
-                           process_input='0',
-                           run_as_root=True,
-                           check_exit_code=[0, 1])
-
-        if not linux_net.device_exists(v2_name):
-            linux_net._create_veth_pair(v1_name, v2_name)
-            utils.execute('ip', 'link', 'set', br_name, 'up', run_as_root=True)
-            utils.execute('brctl', 'addif', br_name, v1_name, run_as_root=True)
-            linux_net.create_ovs_vif_port(self.get_bridge_name(vif),
-                                          v2_name, iface_id, vif['address'],
-                                          instance['uuid'])
-
-        container_utils.write_lxc_usernet(instance, br_name)
+        self.plug_ovs_batch(instance, [vif])
 
     def get_bridge_name(self, vif):
         return vif['network']['bridge']
@@ -155,13 +203,7 @@ class LXCGenericDriver(object):
             br_name = self.get_br_name(vif['id'])
             v1_name, v2_name = self.get_veth_pair_names(vif['id'])
 
-            if linux_net.device_exists(br_name):
-                utils.execute('brctl', 'delif', br_name, v1_name,
-                              run_as_root=True)
-                utils.execute('ip', 'link', 'set', br_name, 'down',
-                              run_as_root=True)
-                utils.execute('brctl', 'delbr', br_name,
-                              run_as_root=True)
+            self.netdev.remove_hybrid_bridge(br_name, v1_name)
 
             linux_net.delete_ovs_vif_port(self.get_bridge_name(vif),
                                           v2_name)
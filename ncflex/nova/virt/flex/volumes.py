@@ -16,29 +16,77 @@
 import os
 import time
 
+import eventlet
 from oslo.config import cfg
 
+from . import iscsi
+from . import utils as container_utils
 from nova import exception
 from nova.openstack.common.gettextutils import _
 from nova.openstack.common import log as logging
 from nova.openstack.common import processutils
-from nova import utils
+
+volume_opts = [
+    cfg.IntOpt('iscsi_device_timeout',
+               default=30,
+               help='Number of seconds to wait for the block device of an '
+                    'iSCSI volume to appear'),
+    cfg.BoolOpt('iscsi_use_multipath',
+                default=False,
+                help='Log in to every portal of multipath iSCSI volumes and '
+                     'attach the multipath device'),
+    cfg.IntOpt('iscsi_multipath_min_paths',
+               default=1,
+               help='Number of paths of a multipath iSCSI volume that must '
+                    'be up before the volume is attached'),
+]
 
 CONF = cfg.CONF
+CONF.register_opts(volume_opts, 'lxc')
 LOG = logging.getLogger(__name__)
 
 
+def wait_for_devices(paths, count, timeout, rescan=None, index=None):
+    """Wait until count of paths exist and return those that do.
+
+    When index (an iscsi.ISCSIIndex) monitors uevents the wait is woken
+    up by the uevents of block devices, which udev sends once it has
+    created their /dev links; otherwise the paths are checked at a
+    growing interval. rescan is called once if the devices are still
+    missing half way to the deadline.
+    """
+    deadline = time.time() + timeout
+    rescan_at = None if rescan is None else deadline - timeout / 2.0
+    interval = 0.1
+    while True:
+        found = [path for path in paths if os.path.exists(path)]
+        now = time.time()
+        if len(found) >= count or now >= deadline:
+            return found
+
+        if rescan_at is not None and now >= rescan_at:
+            rescan()
+            rescan_at = None
+
+        wait = deadline - now
+        if rescan_at is not None:
+            wait = min(wait, rescan_at - now)
+        if index is None or not index.wait_for_uevents(wait):
+            eventlet.sleep(min(wait, interval))
+            interval = min(interval * 2, 1)
+
+
 class VolumeOps(object):
     def __init__(self):
-        self.num_scan_tries = CONF.lxc.num_iscsi_scan_tries
+        self.index = iscsi.ISCSIIndex()
 
     def _run_iscsiadm(self, iscsi_properties, iscsi_command, **kwargs):
         check_exit_code = kwargs.pop('check_exit_code', 0)
-        (out, err) = utils.execute('iscsiadm', '-m', 'node', '-T',
-                                   iscsi_properties['target_iqn'],
-                                   '-p', iscsi_properties['target_portal'],
-                                   *iscsi_command, run_as_root=True,
-                                   check_exit_code=check_exit_code)
+        (out, err) = container_utils.execute(
+            'iscsiadm', '-m', 'node', '-T', iscsi_properties['target_iqn'],
+            '-p', iscsi_properties['target_portal'],
+            *iscsi_command, run_as_root=True,
+            check_exit_code=check_exit_code)
         LOG.debug("iscsiadm %(command)s: stdout=%(out)s stderr=%(err)s",
                   {'command': iscsi_command, 'out': out, 'err': err})
         return (out, err)
@@ -49,69 +97,148 @@ class VolumeOps(object):
                          '-v', property_value)
         return self._run_iscsiadm(iscsi_properties, iscsi_command, **kwargs)
 
+    def init_users(self, users):
+        """Rebuild the users of the LUNs.
+
+        users are the (connection_info, instance uuid) of the volumes
+        attached to the instances of the host.
+        """
+        self.index.set_users(
+            [(props, instance_uuid)
+             for connection_info, instance_uuid in users
+             for props in self._get_iscsi_paths(connection_info['data'])])
+
     def connect_volume(self, connection_info, instance, mountpoint):
         LOG.debug('Connecting volume instnace=%(instance)s '
                   'connection_info=%(connection_info)s',
                   {'instance': instance,
                    'connection_info': connection_info})
+        return self.connect_volumes([connection_info], instance)[0]
 
-        iscsi_properties = connection_info['data']
-        self._connect_to_iscsi_portal(iscsi_properties)
+    def connect_volumes(self, connection_infos, instance):
+        """Connect many volumes, return their host devices in order.
 
-        # Detect new/resized LUNs for existing sessions
-        self._run_iscsiadm(iscsi_properties, ("--rescan",))
-
-        host_device = self._get_host_device(iscsi_properties)
-
-        # The /dev/disk/by-path/... node is not always present immediately
-        # TODO(justinsb): This retry-with-delay is a pattern, move to utils?
-        tries = 0
-        while not os.path.exists(host_device):
-            if tries >= self.num_scan_tries:
-                raise exception.NovaException(_("iSCSI device not found at %s")
-                                              % (host_device))
-
-            LOG.warn(_("ISCSI volume not yet"
-                       "Will rescan & retry.  Try number: %(tries)s"),
-                     {'tries': tries})
-
-            # The rescan isn't documented as being necessary(?), but it helps
+        The paths of all the volumes are grouped by target, so that
+        volumes sharing a target log in to it once, and the targets are
+        logged in to concurrently.
+        """
+        if not connection_infos:
+            return []
+        volumes = [self._get_iscsi_paths(connection_info['data'])
+                   for connection_info in connection_infos]
+        targets = {}
+        for paths in volumes:
+            for props in paths:
+                targets.setdefault(self.index.get_target(props), props)
+
+        pool = eventlet.GreenPool(len(targets))
+        connected = set(self.index.get_target(props) for props in
+                        pool.imap(self._connect_path, targets.values())
+                        if props is not None)
+        host_devices = []
+        for paths in volumes:
+            paths = [props for props in paths
+                     if self.index.get_target(props) in connected]
+            host_devices.append(self._wait_for_volume(paths, instance))
+        return host_devices
+
+    def _wait_for_volume(self, connected, instance):
+        """Wait for the device of a volume on its connected paths."""
+        if not connected:
+            raise exception.NovaException(
+                _('Failed to log in to any portal of the iSCSI volume'))
+
+        host_devices = [self._get_host_device(props) for props in connected]
+        count = 1
+        if CONF.lxc.iscsi_use_multipath:
+            count = min(max(CONF.lxc.iscsi_multipath_min_paths, 1),
+                        len(host_devices))
+        found = wait_for_devices(host_devices, count,
+                                 CONF.lxc.iscsi_device_timeout,
+                                 rescan=self._rescan_iscsi,
+                                 index=self.index)
+        if len(found) < count:
+            raise exception.NovaException(_("iSCSI device not found at %s")
+                                          % ', '.join(host_devices))
+
+        for props in connected:
+            self.index.attach(props, instance['uuid'])
+
+        if CONF.lxc.iscsi_use_multipath:
+            multipath_device = self._get_multipath_device_name(found[0])
+            if multipath_device and wait_for_devices(
+                    [multipath_device], 1, CONF.lxc.iscsi_device_timeout,
+                    index=self.index):
+                return multipath_device
+            LOG.warn(_('No multipath device for %s, using a single path'),
+                     found[0])
+        return found[0]
+
+    def _get_iscsi_paths(self, iscsi_properties):
+        """Return the properties of every path to an iSCSI volume."""
+        portals = iscsi_properties.get('target_portals')
+        if not (CONF.lxc.iscsi_use_multipath and portals):
+            return [iscsi_properties]
+        iqns = iscsi_properties.get('target_iqns',
+                                    [iscsi_properties['target_iqn']] *
+                                    len(portals))
+        luns = iscsi_properties.get('target_luns',
+                                    [iscsi_properties.get('target_lun', 0)] *
+                                    len(portals))
+        return [dict(iscsi_properties, target_portal=portal,
+                     target_iqn=iqn, target_lun=lun)
+                for portal, iqn, lun in zip(portals, iqns, luns)]
+
+    def _connect_path(self, iscsi_properties):
+        """Log in to one path and rescan it, None if that failed."""
+        try:
+            self._connect_to_iscsi_portal(iscsi_properties)
+            # Detect new/resized LUNs for existing sessions
             self._run_iscsiadm(iscsi_properties, ("--rescan",))
-
-            tries = tries + 1
-            if not os.path.exists(host_device):
-                time.sleep(tries ** 2)
-
-        if tries != 0:
-            LOG.debug("Found iSCSI node "
-                      "(after %(tries)s rescans)",
-                      {'tries': tries})
-
-        return host_device
+        except processutils.ProcessExecutionError:
+            if not CONF.lxc.iscsi_use_multipath:
+                raise
+            # the other paths may do
+            LOG.exception(_('Failed to connect to iSCSI portal %s'),
+                          iscsi_properties['target_portal'])
+            return None
+        return iscsi_properties
 
     def disconnect_volume(self, connection_info, instance, mountpoint):
         LOG.debug('Disconnecting volume instnace=%(instance)s '
                   'connection_info=%(connection_info)s',
                   {'instance': instance,
                    'connection_info': connection_info})
-        iscsi_properties = connection_info['data']
-        host_device = self._get_host_device(iscsi_properties)
-        device_prefix = ("/dev/disk/by-path/ip-%s-iscsi-%s-lun-" %
-                         (iscsi_properties['target_portal'],
-                          iscsi_properties['target_iqn']))
-        devices = self._get_all_block_devices()
-        devices = [dev for dev in devices if dev.startswith(device_prefix)]
-        if not devices:
-            self._disconnect_from_iscsi_portal(iscsi_properties)
-        elif host_device not in devices:
-            # Delete device if LUN is not in use by another instance
-            self._delete_device(host_device)
-
-    def _get_all_block_devices(self):
-        devices = []
-        for device in os.listdir('/dev/disk'):
-            devices.append('/dev/disk/by-path/%s' % device)
-        return devices
+        paths = self._get_iscsi_paths(connection_info['data'])
+        unused = [props for props in paths
+                  if self.index.detach(props, instance['uuid'])]
+        if not unused:
+            # the LUN is still used by another instance
+            return
+
+        if CONF.lxc.iscsi_use_multipath:
+            device = self.index.get_device(unused[0])
+            multipath_device = (device and
+                                self._get_multipath_device_name(device))
+            if multipath_device:
+                self._run_multipath(['-f', multipath_device],
+                                    check_exit_code=[0, 1])
+
+        for props in unused:
+            device = self.index.get_device(props)
+            if device:
+                self._delete_device(device)
+            # log out once the last LUN of the target is gone
+            if self.index.remove_lun(props):
+                self._disconnect_from_iscsi_portal(props)
+                self.index.remove_target(props)
+
+    def _delete_device(self, device):
+        """Remove a SCSI block device from the kernel."""
+        name = os.path.basename(os.path.realpath(device))
+        container_utils.execute('tee', '-a',
+                                '/sys/block/%s/device/delete' % name,
+                                process_input='1', run_as_root=True)
 
     def _connect_to_iscsi_portal(self, iscsi_properties):
         # NOTE(vish): If we are on the same host as nova volume, the
@@ -140,23 +267,9 @@ class VolumeOps(object):
                                   "node.session.auth.password",
                                   iscsi_properties['auth_password'])
 
-        #duplicate logins crash iscsiadm after load,
-        #so we scan active sessions to see if the node is logged in.
-        out = self._run_iscsiadm_bare(["-m", "session"],
-                                      run_as_root=True,
-                                      check_exit_code=[0, 1, 21])[0] or ""
-
-        portals = [{'portal': p.split(" ")[2], 'iqn': p.split(" ")[3]}
-                   for p in out.splitlines() if p.startswith("tcp:")]
-
-        stripped_portal = iscsi_properties['target_portal'].split(",")[0]
-        if len(portals) == 0 or len([s for s in portals
-                                     if stripped_portal ==
-                                     s['portal'].split(",")[0]
-                                     and
-                                     s['iqn'] ==
-                                     iscsi_properties['target_iqn']]
-                                    ) == 0:
+        # duplicate logins crash iscsiadm after load, so check the
+        # session index to see if the node is logged in.
+        if not self.index.has_session(iscsi_properties):
             try:
                 self._run_iscsiadm(iscsi_properties,
                                    ("--login",),
@@ -195,19 +308,22 @@ class VolumeOps(object):
 
         return None
 
-    def _get_iscsi_devices(self):
-        try:
-            devices = list(os.walk('/dev/disk/by-path'))[0][-1]
-        except IndexError:
-            return []
-        return [entry for entry in devices if entry.startswith("ip-")]
+    def _run_multipath(self, multipath_command, **kwargs):
+        check_exit_code = kwargs.pop('check_exit_code', 0)
+        (out, err) = container_utils.execute('multipath',
+                                             *multipath_command,
+                                             run_as_root=True,
+                                             check_exit_code=check_exit_code)
+        LOG.debug("multipath %(command)s: stdout=%(out)s stderr=%(err)s",
+                  {'command': multipath_command, 'out': out, 'err': err})
+        return (out, err)
 
     def _run_iscsiadm_bare(self, iscsi_command, **kwargs):
         check_exit_code = kwargs.pop('check_exit_code', 0)
-        (out, err) = utils.execute('iscsiadm',
-                                   *iscsi_command,
-                                   run_as_root=True,
-                                   check_exit_code=check_exit_code)
+        (out, err) = container_utils.execute('iscsiadm',
+                                             *iscsi_command,
+                                             run_as_root=True,
+                                             check_exit_code=check_exit_code)
         LOG.debug("iscsiadm %(command)s: stdout=%(out)s stderr=%(err)s",
                   {'command': iscsi_command, 'out': out, 'err': err})
         return (out, err)